@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import sys
+import time
+import getopt
+
+import torch
+
+"""
+Benchmark of the CRF of the lstmcrf model: the log partition function (forward and backward pass) and the viterbi
+decoding of CRF are timed against a padded implementation, the former one with two changes (see PaddedCRF), which runs
+every step on the whole padded batch with expanded batch x tags x tags tensors and float masks, on random scores for
+each batch size and tagset size.
+Both implementations are run on the same scores and the differences between their results are reported too.
+The memory kept for the backward pass of the log partition function, by the custom autograd function of the CRF and
+by autograd through the same forward algorithm, is reported for each batch size and tagset size as well, after
+checking the gradients of the custom function with gradcheck.
+"""
+
+sys.path.append("..")  # to make models visible from here
+from models import lstmcrf
+
+
+class PaddedCRF(lstmcrf.CRF):
+    """
+    The former implementation of the CRF, as reference, with two changes: the scores are cast to float32, as CRF does
+    also under bf16 autocast, and sentences that have ended point to their own label through the padding of the batch,
+    as in CRF. The former viterbi decoding followed the pointers of the padding, which changed the last labels of the
+    sentences shorter than the batch, so its paths can not be compared with the ones of CRF.
+    """
+
+    @staticmethod
+    def log_sum_exp(vec, dim=0):
+        max, idx = torch.max(vec, dim)
+        max_exp = max.unsqueeze(-1).expand_as(vec)
+        return max + torch.log(torch.sum(torch.exp(vec - max_exp), dim))
+
+    def forward(self, logits, lens):
+        logits = logits.float()
+        batch_size, seq_len, n_labels = logits.size()
+        alpha = logits.data.new(batch_size, self.n_labels).fill_(-10000)
+        alpha[:, self.start_idx] = 0
+        c_lens = lens.clone()
+
+        logits_t = logits.transpose(1, 0)
+        for logit in logits_t:
+            logit_exp = logit.unsqueeze(-1).expand(batch_size, *self.transitions.size())
+            alpha_exp = alpha.unsqueeze(1).expand(batch_size, *self.transitions.size())
+            trans_exp = self.transitions.unsqueeze(0).expand_as(alpha_exp)
+            mat = trans_exp + alpha_exp + logit_exp
+            alpha_nxt = self.log_sum_exp(mat, 2).squeeze(-1)
+            mask = (c_lens > 0).float().unsqueeze(-1).expand_as(alpha)
+            alpha = mask * alpha_nxt + (1 - mask) * alpha
+            c_lens = c_lens - 1
+
+        alpha = alpha + self.transitions[self.stop_idx].unsqueeze(0).expand_as(alpha)
+        return self.log_sum_exp(alpha, 1).squeeze(-1)
+
+    def viterbi_decode(self, logits, lens):
+        logits = logits.float()
+        batch_size, seq_len, n_labels = logits.size()
+        vit = logits.data.new(batch_size, self.n_labels).fill_(-10000)
+        vit[:, self.start_idx] = 0
+        c_lens = lens.clone()
+
+        logits_t = logits.transpose(1, 0)
+        pointers = []
+        for logit in logits_t:
+            vit_exp = vit.unsqueeze(1).expand(batch_size, n_labels, n_labels)
+            trn_exp = self.transitions.unsqueeze(0).expand_as(vit_exp)
+            vt_max, vt_argmax = (vit_exp + trn_exp).max(2)
+            vit_nxt = vt_max.squeeze(-1) + logit
+            ended = (c_lens <= 0).unsqueeze(-1).expand_as(vt_argmax)
+            vt_argmax = torch.where(ended, torch.arange(n_labels, device=vt_argmax.device).expand_as(vt_argmax),
+                                    vt_argmax)
+            pointers.append(vt_argmax.squeeze(-1).unsqueeze(0))
+
+            mask = (c_lens > 0).float().unsqueeze(-1).expand_as(vit_nxt)
+            vit = mask * vit_nxt + (1 - mask) * vit
+            mask = (c_lens == 1).float().unsqueeze(-1).expand_as(vit_nxt)
+            vit += mask * self.transitions[self.stop_idx].unsqueeze(0).expand_as(vit_nxt)
+            c_lens = c_lens - 1
+
+        pointers = torch.cat(list(reversed(pointers)))
+        scores, idx = vit.max(1, keepdim=True)
+        idx = idx.squeeze(-1)
+        paths = [idx.unsqueeze(1)]
+        for argmax in pointers:
+            idx = torch.gather(argmax, 1, idx.unsqueeze(-1)).squeeze(-1)
+            paths.insert(0, idx.unsqueeze(1))
+        return scores.squeeze(-1), torch.cat(paths[1:], 1)
+
+
+class AutogradCRF(lstmcrf.CRF):
+    """The forward algorithm of the CRF, differentiated by autograd, as reference for the memory."""
+
+    def forward(self, logits, lens):
+        logits = logits.float()
+        batch_size, seq_len, n_labels = logits.size()
+        order, active = lstmcrf.packing.sort_by_length(lens, seq_len)
+        logits = logits[order]
+        alpha = logits.new_full((batch_size, n_labels), -10000)
+        alpha[:, self.start_idx] = 0
+        for step, n in enumerate(active):
+            if n == 0:
+                break
+            alpha_nxt = torch.logsumexp(alpha[:n].unsqueeze(1) + self.transitions.unsqueeze(0), dim=2)
+            alpha_nxt = alpha_nxt + logits[:n, step]
+            alpha = torch.cat([alpha_nxt, alpha[n:]])
+        norm = torch.logsumexp(alpha + self.transitions[self.stop_idx].unsqueeze(0), dim=1)
+        return norm[torch.argsort(order)]
+
+
+def saved_bytes(function):
+    """
+    :param function: Function without arguments, returning a tensor whose graph is kept for the backward pass.
+    :return: Bytes of the tensors saved for the backward pass, each storage is counted once.
+    """
+    storages = dict()
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        function()
+    return sum(storages.values())
+
+
+def check_gradients():
+    """
+    Check the gradients of the log partition function of the CRF with gradcheck, in double precision.
+    """
+    generator = torch.Generator().manual_seed(1337)
+    logits, lengths = random_batch(8, 7, 10, generator)
+    logits = logits.double().requires_grad_()
+    transitions = torch.randn(7, 7, generator=generator, dtype=torch.double, requires_grad=True)
+    ok = torch.autograd.gradcheck(lambda l, t: lstmcrf.LogPartition.apply(l, t, lengths, 5, 6), (logits, transitions))
+    print("gradcheck of the log partition function: %s" % ("ok" if ok else "failed"))
+
+
+def random_batch(batch_size, n_labels, max_length, generator):
+    """
+    :param batch_size: Number of sentences.
+    :param n_labels: Number of labels, including start and stop.
+    :param max_length: Maximum length of a sentence.
+    :param generator: Torch generator.
+    :return: Label scores, size = (batch, padded length, n_labels), and lengths drawn uniformly in 1, ..., max_length,
+    the batch is padded to the longest sentence.
+    """
+    lengths = torch.randint(1, max_length + 1, (batch_size,), generator=generator)
+    logits = torch.randn(batch_size, int(lengths.max()), n_labels, generator=generator)
+    return logits, lengths
+
+
+def time_it(function, repeat):
+    """
+    :param function: Function without arguments.
+    :param repeat: Number of times it is timed, after a first untimed run.
+    :return: Milliseconds per run.
+    """
+    function()
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - start) / repeat * 1000
+
+
+def benchmark(batch_sizes, tagset_sizes, max_length, repeat):
+    """
+    Time the padded and the current CRF and print a table with the results.
+    :param batch_sizes: List of batch sizes.
+    :param tagset_sizes: List of tagset sizes, without start and stop.
+    :param max_length: Maximum length of a sentence.
+    :param repeat: Number of times each function is timed.
+    """
+    generator = torch.Generator().manual_seed(1337)
+    print("%6s %5s %12s %12s %8s %12s %12s %8s %10s %6s" % ("batch", "tags", "old fwd+bwd", "new fwd+bwd", "speedup",
+                                                           "old viterbi", "new viterbi", "speedup", "norm diff",
+                                                           "paths"))
+    for n_tags in tagset_sizes:
+        crf = lstmcrf.CRF("cpu", n_tags)
+        reference = PaddedCRF("cpu", n_tags)
+        reference.load_state_dict(crf.state_dict())
+        for batch_size in batch_sizes:
+            logits, lengths = random_batch(batch_size, n_tags + 2, max_length, generator)
+            logits.requires_grad_()
+            times = []
+            for model in [reference, crf]:
+                times.append(time_it(lambda: model(logits, lengths).sum().backward(), repeat))
+            with torch.no_grad():
+                for model in [reference, crf]:
+                    times.append(time_it(lambda: model.viterbi_decode(logits, lengths), repeat))
+                diff = (reference(logits, lengths) - crf(logits, lengths)).abs().max().item()
+                same = torch.equal(reference.viterbi_decode(logits, lengths)[1], crf.viterbi_decode(logits, lengths)[1])
+            print("%6i %5i %10.2fms %10.2fms %7.1fx %10.2fms %10.2fms %7.1fx %10.2e %6s" %
+                  (batch_size, n_tags, times[0], times[1], times[0] / times[1], times[2], times[3],
+                   times[2] / times[3], diff, "same" if same else "differ"))
+            sys.stdout.flush()
+
+
+def memory(batch_sizes, tagset_sizes, max_length, repeat):
+    """
+    Compare the memory kept for the backward pass and the time of the log partition function of the CRF with the ones
+    of autograd through the same forward algorithm, and print a table with the results.
+    :param batch_sizes: List of batch sizes.
+    :param tagset_sizes: List of tagset sizes, without start and stop.
+    :param max_length: Maximum length of a sentence.
+    :param repeat: Number of times each function is timed.
+    """
+    generator = torch.Generator().manual_seed(1337)
+    print("%6s %5s %14s %14s %9s %12s %12s %10s" % ("batch", "tags", "autograd MB", "custom MB", "reduction",
+                                                   "autograd", "custom", "grad diff"))
+    for n_tags in tagset_sizes:
+        crf = lstmcrf.CRF("cpu", n_tags)
+        reference = AutogradCRF("cpu", n_tags)
+        reference.load_state_dict(crf.state_dict())
+        for batch_size in batch_sizes:
+            logits, lengths = random_batch(batch_size, n_tags + 2, max_length, generator)
+            logits.requires_grad_()
+            sizes = [saved_bytes(lambda: model(logits, lengths)) / 2 ** 20 for model in [reference, crf]]
+            times = [time_it(lambda: model(logits, lengths).sum().backward(), repeat) for model in [reference, crf]]
+            grads = [torch.autograd.grad(model(logits, lengths).sum(), [logits, model.transitions])
+                     for model in [reference, crf]]
+            diff = max((a - b).abs().max().item() for a, b in zip(*grads))
+            print("%6i %5i %14.2f %14.2f %8.1fx %10.2fms %10.2fms %10.2e" %
+                  (batch_size, n_tags, sizes[0], sizes[1], sizes[0] / sizes[1], times[0], times[1], diff))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "", ["batches=", "tags=", "length=", "repeat=", "threads=", "help"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    opts = dict(opts)
+    if "--help" in opts:
+        print("Usage: \n./crf.py [--batches=<comma separated batch sizes, default is 1,20,100>] [--tags=<comma "
+              "separated tagset sizes, default is 20,127>] [--length=<maximum sentence length, default is 50>] "
+              "[--repeat=<runs timed for each measure, default is 10>] [--threads=<torch threads>]")
+        exit()
+
+    batch_sizes = [int(value) for value in opts.get("--batches", "1,20,100").split(",")]
+    tagset_sizes = [int(value) for value in opts.get("--tags", "20,127").split(",")]
+    if "--threads" in opts:
+        torch.set_num_threads(int(opts["--threads"]))
+    check_gradients()
+    benchmark(batch_sizes, tagset_sizes, int(opts.get("--length", 50)), int(opts.get("--repeat", 10)))
+    memory(batch_sizes, tagset_sizes, int(opts.get("--length", 50)), int(opts.get("--repeat", 10)))
@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+import io
+import sys
+import itertools
+import time
+import random
+import contextlib
+
+import numpy as np
+import torch
+
+"""
+Benchmark of the --precision option of run_model.py: every model is trained and tested once with fp32 and once with
+bf16, on the same data and with the same seeds, and the training throughput, the prediction throughput, the memory
+taken by the weights and the F1 score on the test data are reported for both.
+"""
+
+sys.path.append("..")  # to make run_model visible from here
+import run_model
+import conlleval
+from data_manager import PytorchDataset
+
+PRECISIONS = ["fp32", "bf16"]
+
+
+def weights_size(model):
+    """
+    :param model: The nn module.
+    :return: Bytes taken by the parameters and buffers of the model.
+    """
+    tensors = itertools.chain(model.parameters(), model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def run(args, model_name, precision, data):
+    """
+    Train and test a model, the output of run_model is suppressed.
+    :param args: Arguments of run_model.py, without --model and --precision.
+    :param model_name: Model to benchmark.
+    :param precision: Either "fp32" or "bf16".
+    :param data: Data as returned by run_model.load_data, the run gets its own copy of the embeddings (see
+    run_model.trial_data), so that runs with the same data start from the same embeddings even when they train or
+    renormalize them.
+    :return: Dict with the train and predict throughput (sentences per second), the size of the weights in MB and the
+    F1 score on the test data.
+    """
+    data = run_model.trial_data(data)
+    with contextlib.redirect_stdout(io.StringIO()):
+        params = run_model.parse_args(args + ["--model=%s" % model_name, "--precision=%s" % precision])
+        random.seed(1337)
+        np.random.seed(1337)
+        torch.manual_seed(999)
+        class_dict = data["class_dict"]
+        model, init_data_transform, run_data_transform = run_model.generate_model_and_transformers(
+            params, class_dict, data["w2v_vocab"], data["w2v_weights"], data["c2v_vocab"], data["c2v_weights"])
+        train_data = PytorchDataset(data["train"], init_data_transform, batch_transform=run_data_transform)
+        test_data = PytorchDataset(data["test"], init_data_transform)
+        loader_options = {"workers": params["workers"], "prefetch": params["prefetch"],
+                          "persistent_workers": params["persistent_workers"]}
+
+        start = time.time()
+        run_model.train_model(train_data, model, class_dict, None, params["batch"], params["lr"], params["epochs"],
+                              params["decay"], params["bucket"], loader_options, False, precision=precision)
+        train_time = time.time() - start
+
+        model.eval()
+        start = time.time()
+        predictions = run_model.predict(model, test_data, params["predict_batch"], loader_options, precision)
+        predict_time = time.time() - start
+
+    tags = sorted(class_dict, key=class_dict.get)
+    predictions = run_model.fill_predictions(predictions, data["test"].lengths, class_dict)
+    f1 = conlleval.evaluate(data["test"].concepts, np.concatenate(predictions), data["test"].lengths, tags)[2]
+    return {"train": len(train_data) * params["epochs"] / train_time, "predict": len(test_data) / predict_time,
+            "weights": weights_size(model) / 2 ** 20, "f1": f1}
+
+
+def benchmark(args, models):
+    """
+    Benchmark fp32 against bf16 for each model and print a table with the results.
+    :param args: Arguments of run_model.py, without --model and --precision.
+    :param models: List of models to benchmark.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        data = run_model.load_data(run_model.parse_args(args + ["--model=%s" % models[0]]))
+
+    print("%-10s %-5s %14s %14s %12s %8s" % ("model", "prec", "train sent/s", "predict sent/s", "weights MB", "F1"))
+    for model_name in models:
+        for precision in PRECISIONS:
+            res = run(args, model_name, precision, data)
+            print("%-10s %-5s %14.1f %14.1f %12.2f %8.2f" % (model_name, precision, res["train"], res["predict"],
+                                                             res["weights"], res["f1"]))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or "--help" in sys.argv:
+        print("Usage: \n./precision.py <run_model.py arguments> [--models=lstm,gru,...]\nWhere the arguments are the "
+              "ones of run_model.py (i.e. --train, --test, --w2v, --epochs) except --model and --precision, each "
+              "model (all of them by default) is trained and tested with fp32 and with bf16.")
+        exit()
+    else:
+        models = ["lstm", "rnn", "gru", "lstm2ch", "encoder", "attention", "conv", "fcinit", "lstmcrf"]
+        args = []
+        for arg in sys.argv[1:]:
+            if arg.startswith("--models="):
+                models = arg[len("--models="):].split(",")
+            else:
+                args.append(arg)
+        benchmark(args, models)
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+import os
+import sys
+import time
+import getopt
+import contextlib
+
+import numpy as np
+
+import conlleval
+import run_model
+import collect_results
+from sweep import run_trials, to_args
+
+"""
+Script to run the many trainings needed for significance testing and error bars: every model is trained and tested on
+every fold with every seed, runs are scheduled on a pool of processes (see sweep.py) and scored in process.
+The predictions of each run are written to <output>/<model>/<model>_<fold>_<seed>.txt and the scores of the runs of
+each model to <output>/<model>/f1.scores, the same file that collect_results.py writes.
+The data of each fold is preprocessed once, before the runs, into the --cache directory (<output>/cache by default),
+from which every run loads it memory mapped, so that processes running on the same fold share its pages; each run
+maps the embeddings again (see run_model.trial_data), so runs training them do not change the ones of the next runs of
+the same process.
+Runs whose predictions are already there are not run again, their predictions are scored instead.
+"""
+
+
+def campaign_runs(args, models, folds, seeds, output):
+    """
+    Generate the runs of a campaign.
+    :param args: Dict of run_model.py options (without "--") shared by all runs, "{fold}" in their values is replaced
+    by the fold of the run.
+    :param models: List of models.
+    :param folds: List of folds, None to not use folds.
+    :param seeds: List of seeds.
+    :param output: Output directory.
+    :return: Dict mapping the name of each run (i.e. "lstm_0_1") to its options.
+    """
+    runs = dict()
+    for model in models:
+        for fold in (folds if folds is not None else [None]):
+            for seed in seeds:
+                name = "_".join([model] + ([str(fold)] if fold is not None else []) + [str(seed)])
+                options = {key: value.replace("{fold}", str(fold)) if isinstance(value, str) else value
+                           for key, value in args.items()}
+                options.update(model=model, seed=seed,
+                               write_results=os.path.join(output, model, name + ".txt"))
+                runs[name] = options
+    return runs
+
+
+def preprocess(runs):
+    """
+    Preprocess the data of the runs into the cache, once for each distinct set of data files.
+    :param runs: Dict mapping the name of a run to its options.
+    """
+    seen = set()
+    for options in runs.values():
+        files = tuple(options.get(name) for name in ["train", "dev", "test", "w2v", "c2v"])
+        if files not in seen:
+            seen.add(files)
+            with open(os.devnull, "w") as out, contextlib.redirect_stdout(out):
+                run_model.load_data(run_model.parse_args(to_args(options)))
+    print("preprocessed the data of %i folds" % len(seen))
+
+
+def campaign(args, models, folds, seeds, output, procs, threads):
+    """
+    Run the runs of a campaign which do not have predictions yet and write the f1.scores file of each model.
+    :param args: Dict of run_model.py options shared by all runs, see campaign_runs.
+    :param models: List of models.
+    :param folds: List of folds, None to not use folds.
+    :param seeds: List of seeds.
+    :param output: Output directory.
+    :param procs: Number of runs run in parallel.
+    :param threads: Number of threads of each process.
+    """
+    args = dict(args)
+    args.setdefault("cache", os.path.join(output, "cache"))
+    runs = campaign_runs(args, models, folds, seeds, output)
+    for model in models:
+        os.makedirs(os.path.join(output, model), exist_ok=True)
+
+    # maps a model to a dict mapping the predictions file of each of its runs to the f1 score
+    scores = {model: dict() for model in models}
+    pending = dict()
+    for name, options in runs.items():
+        path = options["write_results"]
+        if os.path.isfile(path):
+            counts = conlleval.evaluate_file(path)
+            if counts.token_counter > 0:
+                scores[options["model"]][os.path.basename(path)] = float("%6.2f" % counts.overall()[2])
+                continue
+        pending[name] = options
+    print("%i runs to do, %i already done" % (len(pending), len(runs) - len(pending)))
+    preprocess(pending)
+
+    start = time.time()
+    failed = 0
+    logs = os.path.join(output, "logs")
+    os.makedirs(logs, exist_ok=True)
+    for i, (name, metrics, error) in enumerate(run_trials(pending, procs, threads, logs)):
+        options = pending[name]
+        if error is None:
+            scores[options["model"]][os.path.basename(options["write_results"])] = float("%6.2f" % metrics["test_f1"])
+            print("[%i/%i] %s f1 %.2f in %.0fs" % (i + 1, len(pending), name, metrics["test_f1"], metrics["seconds"]))
+        else:
+            failed += 1
+            print("[%i/%i] %s failed: %r, see %s" % (i + 1, len(pending), name, error,
+                                                     os.path.join(logs, name + ".log")))
+        sys.stdout.flush()
+    print("%i runs in %.0fs, %i failed" % (len(pending), time.time() - start, failed))
+
+    for model in models:
+        if len(scores[model]) > 0:
+            collect_results.write_scores(os.path.join(output, model), scores[model])
+            values = np.array(list(scores[model].values()))
+            print("%s: mean %f, std %f over %i runs" % (model, values.mean(), values.std(), len(values)))
+
+
+def parse_range(value):
+    """
+    :param value: Either a number n, meaning 0, ..., n - 1, or a comma separated list of numbers.
+    :return: List of numbers.
+    """
+    return [int(v) for v in value.split(",")] if "," in value else list(range(int(value)))
+
+
+if __name__ == "__main__":
+    own_options = ["models=", "folds=", "seeds=", "output=", "procs=", "threads=", "help"]
+    # the options that are not of this script are passed to run_model.py
+    own, run_args = [], dict()
+    for arg in sys.argv[1:]:
+        name, equal, value = arg[2:].partition("=")
+        if name + equal in own_options:
+            own.append(arg)
+        else:
+            run_args[name] = value if equal else True
+    try:
+        opts, _ = getopt.getopt(own, "", own_options)
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    opts = dict(opts)
+    if "--help" in opts or "--models" not in opts or "--output" not in opts:
+        print("Usage: \n./campaign.py --models=<comma separated models> --output=<output directory> "
+              "[--folds=<number of folds, or comma separated folds>] [--seeds=<number of seeds, or comma separated "
+              "seeds, default is 1>] [--procs=<runs run in parallel, default is the number of cores>] "
+              "[--threads=<threads of each run, default is 1>] <run_model.py arguments>\n"
+              "Where \"{fold}\" in the run_model.py arguments is replaced by the fold of each run, i.e.:\n"
+              "./campaign.py --models=lstm,gru --folds=10 --seeds=5 --output=../output/atis/error_bars "
+              "--train=\"../data/atis/kfolds/train{fold}.pickle\" --test=\"../data/atis/kfolds/test{fold}.pickle\" "
+              "--w2v=../data/atis/w2v_trimmed.pickle --epochs=10\n"
+              "The f1.scores file of each model is written in <output>/<model>, as collect_results.py does.")
+        exit()
+
+    assert "model" not in run_args and "seed" not in run_args and "write_results" not in run_args, \
+        "--model, --seed and --write_results are set for each run"
+    folds = parse_range(opts["--folds"]) if "--folds" in opts else None
+    assert folds is not None or not any("{fold}" in str(value) for value in run_args.values()), \
+        "{fold} is used but --folds is not passed"
+    seeds = parse_range(opts.get("--seeds", "1"))
+    procs = int(opts.get("--procs", os.cpu_count()))
+    assert procs > 0, "number of processes should be greater than 0"
+    threads = int(opts.get("--threads", 1))
+    assert threads > 0, "number of threads should be greater than 0"
+    campaign(run_args, opts["--models"].split(","), folds, seeds, opts["--output"], procs, threads)
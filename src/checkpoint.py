@@ -0,0 +1,109 @@
+import os
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+"""
+Checkpoints of a training run: model, optimizer and lr scheduler states, the state of the random number generators
+and any other value needed to resume training (i.e. the epoch, the best dev f1 so far).
+Checkpoints are written by a background thread, so that training goes on while they are serialized to disk.
+"""
+
+
+def snapshot(obj):
+    """
+    Copy the tensors contained in obj (nested dicts, lists and tuples) to the cpu, so that the copy is not changed
+    by training while it is being written.
+    :param obj: Object to copy, i.e. a state dict.
+    :return: Copy of the object.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def rng_state():
+    """
+    :return: Dict containing the state of the random number generators of python, numpy and torch.
+    """
+    return {"random": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+
+
+def set_rng_state(state):
+    """
+    Restore the state of the random number generators.
+    :param state: Dict returned by rng_state.
+    """
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+
+
+def load(path, device="cpu"):
+    """
+    Load a checkpoint written by a CheckpointWriter.
+    :param path: Path of the checkpoint.
+    :param device: Device to which tensors are mapped.
+    :return: Dict that was saved.
+    """
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints from a background thread, a checkpoint is first written to a temporary file which then replaces
+    the previous checkpoint, so that an interrupted run always leaves a complete checkpoint behind.
+    If checkpoints are saved faster than they are written, save blocks until the previous ones are written.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the checkpoint file.
+        """
+        self.path = path
+        self.error = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            state = self._queue.get()
+            if state is None:
+                break
+            try:
+                tmp = self.path + ".tmp"
+                torch.save(state, tmp)
+                os.replace(tmp, self.path)
+            except Exception as err:
+                self.error = err
+            finally:
+                self._queue.task_done()
+
+    def save(self, state):
+        """
+        Write a checkpoint, the tensors of the state are copied before returning, the copy is written in background.
+        :param state: Dict to save, i.e. containing state dicts of the model and the optimizer.
+        """
+        if self.error is not None:
+            raise self.error
+        self._queue.put(snapshot(state))
+
+    def wait(self):
+        """Wait for the checkpoints to be written."""
+        self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Wait for the checkpoints to be written and stop the background thread."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
@@ -4,10 +4,12 @@ import sys
 import operator
 import numpy as np
 
+import conlleval
+
 """
-Script to collect f1 scores of different output files that are in the provided directory, the script conlleval.pl in the
-output directory is used; the provided directory will afterwards contain a file named f1.scores, containing the sorted
-scores of the different files, their mean and std.
+Script to collect f1 scores of different output files that are in the provided directory, files are scored as the
+script conlleval.pl in the output directory does, see conlleval.py; the provided directory will afterwards contain a
+file named f1.scores, containing the sorted scores of the different files, their mean and std.
 """
 
 
@@ -16,30 +18,39 @@ def collect_results(dir):
     Collects the results in a directory (output files, i.e. random.txt), writing them in a file
     named f1.scores in the same directory.
     """
+    write_scores(dir, score_files(dir))
+
+
+def score_files(dir):
+    """
+    Score the output files in a directory.
+    :return: Dict mapping a file name to its f1 score, rounded as conlleval.pl reports it.
+    """
     dir = dir.rstrip("/") + "/" # make sure the / is there without having two of them
-    f1dir = dir + "f1/"
-    if not os.path.exists(f1dir):
-        os.makedirs(f1dir)
 
-    # list of strings of the form "parameters: f1"
+    # maps a file name to its f1 score
     res = dict()
 
-    # measure performance of each file and retrieve f1 score, writing it to a file in the f1 directory
-    for file in os.listdir(dir):
+    # measure performance of each file and retrieve f1 score, as reported (with 2 decimals) by conlleval.pl
+    for file in sorted(os.listdir(dir)):
         if file.endswith(".txt"):
-            input_name = dir + file
-            output_name = f1dir + file
-            cmd = "../output/conlleval.pl < %s | sed '2q;d' | grep -oE '[^ ]+$' > %s" % (input_name, output_name)
-            os.system(cmd)
+            try:
+                counts = conlleval.evaluate_file(dir + file)
+            except ValueError as err:
+                print("%s: %s" % (file, err))
+                continue
+            if counts.token_counter > 0:
+                res[file] = float("%6.2f" % counts.overall()[2])
+    return res
 
-    # collect different f1 scores in the same file
-    for file in sorted(os.listdir(f1dir)):
-        if file.endswith(".txt"):
-            with open(f1dir + file, "r") as input:
-                name = file
-                for line in input:
-                    res[name] = float(line.strip("\n"))
 
+def write_scores(dir, res):
+    """
+    Write a file named f1.scores in a directory, containing the sorted scores of the files, their mean and std.
+    :param dir: Directory containing the files.
+    :param res: Dict mapping a file name to its f1 score.
+    """
+    dir = dir.rstrip("/") + "/"
     values = np.array([v for v in res.values()])
     mean, std = values.mean(), values.std()
     res = sorted(res.items(), key=operator.itemgetter(1), reverse=True)
@@ -49,14 +60,12 @@ def collect_results(dir):
             output.write(pair[0] + " " + str(pair[1]) + "\n")
         output.close()
 
-    os.system("rm -r %s" % f1dir)
-
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
         print("Usage: \n./collect_results path \nWhere path is a directory containing .txt files with predictions; "
               "this script will collect the F1 score of each prediction file and report them in a file called "
-              "f1.scores; the evaluation script conlleval.pl in the output directory is used.")
+              "f1.scores; files are scored as the evaluation script conlleval.pl in the output directory does.")
         exit()
     else:
         # get to directory and for each sub directory collect results
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+import sys
+import numpy as np
+
+"""
+Python port of the conlleval.pl script in the output directory, which computes the chunk level precision, recall and
+F1 score of predictions in IOB notation, the report printed by this script is identical to the one printed by the perl
+script with its default options.
+Predictions can either be scored from a file (lines with items separated by a space, the last two items are the
+correct tag and the guessed tag, sentences separated by an empty line) or directly from arrays of tag indexes; in the
+latter case chunk starts and ends are looked up in tables computed once for all the pairs of tags, so the predictions
+are scored without looping over their tokens.
+"""
+
+BOUNDARY = "-X-"
+
+
+def split_tag(tag):
+    """
+    Split a tag in its chunk tag and its type, i.e. "B-actor" in "B" and "actor", as conlleval.pl does.
+    :param tag: String.
+    :return: Chunk tag and type, the type of tags without a "-" is "".
+    """
+    prefix, _, chunk_type = tag.partition("-")
+    if prefix == tag:
+        return tag, ""
+    # perl treats "0" as false
+    return prefix, chunk_type if chunk_type != "0" else ""
+
+
+def end_of_chunk(prev_tag, tag, prev_type, chunk_type):
+    """
+    :return: True if a chunk ended between the previous and the current word.
+    """
+    if (prev_tag, tag) in {("B", "B"), ("B", "O"), ("I", "B"), ("I", "O"), ("E", "E"), ("E", "I"), ("E", "O")}:
+        return True
+    if prev_tag != "O" and prev_tag != "." and prev_type != chunk_type:
+        return True
+    # these chunks are assumed to have length 1
+    return prev_tag == "]" or prev_tag == "["
+
+
+def start_of_chunk(prev_tag, tag, prev_type, chunk_type):
+    """
+    :return: True if a chunk started between the previous and the current word.
+    """
+    if (prev_tag, tag) in {("B", "B"), ("I", "B"), ("O", "B"), ("O", "I"), ("E", "E"), ("E", "I"), ("O", "E")}:
+        return True
+    if tag != "O" and tag != "." and prev_type != chunk_type:
+        return True
+    # these chunks are assumed to have length 1
+    return tag == "[" or tag == "]"
+
+
+class ChunkTable(object):
+    """
+    Chunk start and end tables for all the pairs of a list of tags, the last tag of the table is the "O" tag used for
+    sentence boundaries.
+    """
+
+    def __init__(self, tags):
+        """
+        :param tags: List of tags (strings), the ith tag has index i.
+        """
+        self.tags = list(tags) + ["O"]
+        self.boundary = len(self.tags) - 1
+        split = [split_tag(tag) for tag in self.tags]
+        prefixes = {prefix: i for i, prefix in enumerate(sorted(set(prefix for prefix, _ in split)))}
+        self.types = sorted(set(chunk_type for _, chunk_type in split))
+        type_ids = {chunk_type: i for i, chunk_type in enumerate(self.types)}
+        self.prefix = np.array([prefixes[prefix] for prefix, _ in split], dtype=np.int64)
+        self.type = np.array([type_ids[chunk_type] for _, chunk_type in split], dtype=np.int64)
+        self.start = np.array([[start_of_chunk(prev[0], tag[0], prev[1], tag[1]) for tag in split] for prev in split],
+                              dtype=bool)
+        self.end = np.array([[end_of_chunk(prev[0], tag[0], prev[1], tag[1]) for tag in split] for prev in split],
+                            dtype=bool)
+
+
+class ChunkCounts(object):
+    """Counts collected by conlleval.pl, from which it computes its scores."""
+
+    def __init__(self, token_counter, correct_tags, found_correct, found_guessed, correct_chunk):
+        """
+        :param token_counter: Number of tokens.
+        :param correct_tags: Number of tokens whose tag was guessed correctly.
+        :param found_correct: Dict mapping a chunk type to the number of chunks of that type in the corpus.
+        :param found_guessed: Dict mapping a chunk type to the number of guessed chunks of that type.
+        :param correct_chunk: Dict mapping a chunk type to the number of correctly guessed chunks of that type.
+        """
+        self.token_counter = token_counter
+        self.correct_tags = correct_tags
+        self.found_correct = found_correct
+        self.found_guessed = found_guessed
+        self.correct_chunk = correct_chunk
+
+    def overall(self):
+        """
+        :return: Precision, recall and F1 score over all chunk types, in percentages.
+        """
+        correct_chunk = sum(self.correct_chunk.values())
+        found_correct = sum(self.found_correct.values())
+        found_guessed = sum(self.found_guessed.values())
+        return _scores(correct_chunk, found_correct, found_guessed)
+
+    def report(self):
+        """
+        :return: The report printed by conlleval.pl, as a list of lines without the final newlines.
+        """
+        correct_chunk = sum(self.correct_chunk.values())
+        found_correct = sum(self.found_correct.values())
+        found_guessed = sum(self.found_guessed.values())
+        lines = ["processed %d tokens with %d phrases; found: %d phrases; correct: %d." %
+                 (self.token_counter, found_correct, found_guessed, correct_chunk)]
+        if self.token_counter > 0:
+            precision, recall, f1 = _scores(correct_chunk, found_correct, found_guessed)
+            lines.append("accuracy: %6.2f%%; precision: %6.2f%%; recall: %6.2f%%; FB1: %6.2f" %
+                         (100 * self.correct_tags / self.token_counter, precision, recall, f1))
+
+        # types are deduplicated as conlleval.pl does, which does not deduplicate the empty type
+        types, last = [], None
+        for chunk_type in sorted(list(self.found_correct) + list(self.found_guessed)):
+            if not last or last != chunk_type:
+                types.append(chunk_type)
+            last = chunk_type
+        for chunk_type in types:
+            precision, recall, f1 = _scores(self.correct_chunk.get(chunk_type, 0),
+                                            self.found_correct.get(chunk_type, 0),
+                                            self.found_guessed.get(chunk_type, 0))
+            lines.append("%17s: precision: %6.2f%%; recall: %6.2f%%; FB1: %6.2f  %d" %
+                         (chunk_type, precision, recall, f1, self.found_guessed.get(chunk_type, 0)))
+        return lines
+
+
+def _scores(correct_chunk, found_correct, found_guessed):
+    precision = 100 * correct_chunk / found_guessed if found_guessed > 0 else 0.0
+    recall = 100 * correct_chunk / found_correct if found_correct > 0 else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return precision, recall, f1
+
+
+def _count(correct, guessed, boundaries, table):
+    """
+    Count chunks as conlleval.pl does.
+    :param correct: Array of correct tag indexes, including the sentence boundaries.
+    :param guessed: Array of guessed tag indexes, including the sentence boundaries.
+    :param boundaries: Boolean array, True for sentence boundaries.
+    :param table: ChunkTable of the tags.
+    :return: ChunkCounts.
+    """
+    # the tag before the first one is "O"
+    prev_correct = np.concatenate([[table.boundary], correct[:-1]])
+    prev_guessed = np.concatenate([[table.boundary], guessed[:-1]])
+    start_correct = table.start[prev_correct, correct]
+    start_guessed = table.start[prev_guessed, guessed]
+    end_correct = table.end[prev_correct, correct]
+    end_guessed = table.end[prev_guessed, guessed]
+    same_type = table.type[correct] == table.type[guessed]
+
+    # a chunk is being matched from where both chunks start with the same type, it is correct if at the first
+    # token where either chunk ends or types differ (an event) both chunks end
+    starts = start_correct & start_guessed & same_type
+    events = np.flatnonzero(end_correct | end_guessed | ~same_type)
+    started = np.concatenate([[0], np.cumsum(starts)])
+    # there is a match going on at an event if a chunk started after the previous event, or at it
+    previous = np.concatenate([[0], events[:-1]])
+    matched = events[(started[events] > started[previous]) & end_correct[events] & end_guessed[events]]
+    matched_types = table.type[correct[matched - 1]]
+    # a match might still be going on at the end
+    last = events[-1] if len(events) > 0 else 0
+    if started[len(correct)] > started[last]:
+        matched_types = np.append(matched_types, table.type[correct[-1]])
+
+    tokens = ~boundaries
+    correct_tags = tokens & (table.prefix[correct] == table.prefix[guessed]) & same_type
+    n_types = len(table.types)
+    return ChunkCounts(int(tokens.sum()), int(correct_tags.sum()),
+                       _by_type(np.bincount(table.type[correct[start_correct]], minlength=n_types), table),
+                       _by_type(np.bincount(table.type[guessed[start_guessed]], minlength=n_types), table),
+                       _by_type(np.bincount(matched_types, minlength=n_types), table))
+
+
+def _by_type(counts, table):
+    return {table.types[i]: int(count) for i, count in enumerate(counts) if count > 0}
+
+
+def count_chunks(correct, guessed, lengths, tags):
+    """
+    Count chunks of predictions given as arrays of tag indexes, as if they were written one tag per line, each
+    sentence followed by an empty line.
+    :param correct: Array of correct tag indexes, the sentences one after the other.
+    :param guessed: Array of guessed tag indexes, same shape of correct.
+    :param lengths: Array with the length of each sentence.
+    :param tags: Either a list of tags (the ith tag has index i) or a ChunkTable built on them.
+    :return: ChunkCounts.
+    """
+    table = tags if isinstance(tags, ChunkTable) else ChunkTable(tags)
+    correct, guessed = np.asarray(correct, dtype=np.int64), np.asarray(guessed, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    assert len(correct) == len(guessed) == lengths.sum(), "correct, guessed and lengths do not match"
+
+    # insert a boundary after each sentence
+    boundaries = np.zeros(len(correct) + len(lengths), dtype=bool)
+    boundaries[np.cumsum(lengths + 1) - 1] = True
+    correct_all = np.full(len(boundaries), table.boundary, dtype=np.int64)
+    guessed_all = np.full(len(boundaries), table.boundary, dtype=np.int64)
+    correct_all[~boundaries] = correct
+    guessed_all[~boundaries] = guessed
+    return _count(correct_all, guessed_all, boundaries, table)
+
+
+def count_lines(lines):
+    """
+    Count chunks of predictions in the format read by conlleval.pl.
+    :param lines: Iterable of lines, with or without the final newline.
+    :return: ChunkCounts.
+    """
+    tags = dict()
+    correct, guessed, boundaries = [], [], []
+    n_features = 0
+    for line in lines:
+        # split as perl does, dropping trailing empty fields
+        features = line[:-1].split(" ") if line.endswith("\n") else line.split(" ")
+        while len(features) > 0 and features[-1] == "":
+            features.pop()
+        if not n_features:
+            n_features = len(features)
+        elif n_features != len(features) and len(features) != 0:
+            raise ValueError("unexpected number of features: %d (%d)" % (len(features), n_features))
+        if len(features) == 0 or features[0] == BOUNDARY:
+            features = [BOUNDARY, "O", "O"]
+        if len(features) < 2:
+            raise ValueError("unexpected number of features in line %s" % line)
+        boundary = features[0] == BOUNDARY
+        correct.append(tags.setdefault(features[-2], len(tags)))
+        # sentence boundaries are always out of chunks
+        guessed.append(tags.setdefault("O" if boundary else features[-1], len(tags)))
+        boundaries.append(boundary)
+    return _count(np.array(correct, dtype=np.int64), np.array(guessed, dtype=np.int64),
+                  np.array(boundaries, dtype=bool), ChunkTable(list(tags)))
+
+
+def evaluate(correct, guessed, lengths, tags):
+    """
+    Compute the overall chunk scores of predictions given as arrays of tag indexes, see count_chunks.
+    :return: Precision, recall and F1 score, in percentages.
+    """
+    return count_chunks(correct, guessed, lengths, tags).overall()
+
+
+def evaluate_file(path):
+    """
+    Score a file as conlleval.pl does.
+    :param path: Path of the file, lines with items separated by a space, the last two items are the correct and the
+    guessed tag, sentences are separated by an empty line.
+    :return: ChunkCounts.
+    """
+    with open(path, "r") as file:
+        return count_lines(file)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 or "--help" in sys.argv:
+        print("Usage: \n./conlleval.py [file]\nWhere file contains predictions in the format read by conlleval.pl, "
+              "if it is not passed predictions are read from the standard input; the same report of conlleval.pl "
+              "is printed.")
+        exit()
+    else:
+        try:
+            counts = evaluate_file(sys.argv[1]) if len(sys.argv) == 2 else count_lines(sys.stdin)
+        except ValueError as err:
+            print("conlleval: %s" % err, file=sys.stderr)
+            exit(1)
+        print("\n".join(counts.report()))
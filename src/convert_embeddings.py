@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+import os
+import sys
+
+from data_manager import w2v_matrix_vocab_generator, save_embeddings
+
+"""
+Script to convert an embeddings pickle (a dataframe with "token" and "vector" columns) to a float32 .npy matrix plus a
+.vocab sidecar, which can be passed in place of the pickle to run_model.py and to the pycrfsuite scripts; that format
+is memory mapped when loaded, so that it loads instantly and processes on the same host share the same pages.
+"""
+
+
+def convert(pickle, output):
+    """
+    Convert an embeddings pickle to the .npy + .vocab format.
+    :param pickle: Path of the pickle containing the embeddings.
+    :param output: Path of the .npy file to write, the vocabulary is written next to it with a .vocab extension.
+    """
+    vocab, weights = w2v_matrix_vocab_generator(pickle)
+    save_embeddings(output, vocab, weights)
+    print("written %i embeddings of size %i to %s" % (weights.shape[0], weights.shape[1], output))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: \n./convert_embeddings.py embeddings.pickle embeddings.npy\nWhere embeddings.pickle is a pickle "
+              "containing a dataframe with \"token\" and \"vector\" columns, the embeddings are going to be written "
+              "to embeddings.npy and the tokens to embeddings.vocab.")
+        exit()
+    else:
+        pickle, output = sys.argv[1], sys.argv[2]
+        assert os.path.isfile(pickle), "embeddings pickle is not there"
+        assert output.endswith(".npy"), "output should be a .npy file"
+        convert(pickle, output)
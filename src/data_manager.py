@@ -1,30 +1,51 @@
-import random
+import os
+import array
+import pickle
+import hashlib
+import tempfile
+import itertools
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 
 
 class PytorchDataset(Dataset):
     """Dataset to import augmented data."""
 
-    def __init__(self, df, init_transform, getitem_transform=None):
+    def __init__(self, df, init_transform, getitem_transform=None, batch_transform=None):
         """
         :param df Dataframe containing data, must have "concepts" and "tokens" columns, every entry of such a column
         is a list of strings, entries for the same sample must have the same length, given that they are representing
-        the same sentence, either using tokens or concepts.
-        :param init_transform: Transform function to be used on data points at import time.
+        the same sentence, either using tokens or concepts; an already encoded EncodedCorpus can be passed instead.
+        :param init_transform: InitTransform used to encode the whole dataframe at import time, samples retrieved
+        with __getitem__ are not padded, batches of samples are padded by a PadCollate built on the same transform.
         :param getitem_transform: Transform function to be used on data points when they are retrieved with __getitem__.
+        :param batch_transform: Transform function to be used on whole batches by the PadCollate of this dataset.
         """
 
         self.init_transform = init_transform
         self.getitem_transform = getitem_transform
+        self.batch_transform = batch_transform
 
-        # transform and save data
-        self.data = dict()
-        for i in range(len(df)):
-            sample = df.iloc[i, :]
-            self.data[i] = self.init_transform(sample)
+        # encode all the data in one pass, samples are views into the encoded arrays
+        self.data = df if isinstance(df, EncodedCorpus) else self.init_transform.encode_corpus(df)
+
+    @property
+    def lengths(self):
+        """
+        :return: Array containing the length of each sentence.
+        """
+        return self.data.lengths
+
+    @property
+    def char_table(self):
+        """
+        :return: Tensor containing the c2v indexes of each distinct word of the data, see EncodedCorpus, or None.
+        """
+        return self.data.char_table
 
     def __len__(self):
         return len(self.data)
@@ -33,38 +54,500 @@ class PytorchDataset(Dataset):
         return self.getitem_transform(self.data[idx]) if self.getitem_transform is not None else self.data[idx]
 
 
+class StreamingDataset(IterableDataset):
+    """
+    Dataset streaming sentences from a list of shards, for corpora that do not fit in memory, sentences are encoded
+    on the fly. Shards are split among the workers of the DataLoader, if there are fewer shards than workers every
+    worker reads all the shards and keeps a different subset of their sentences.
+    Samples are shuffled through a bounded buffer, so only shuffle_buffer samples are held in memory by each worker.
+    """
+
+    def __init__(self, shards, init_transform, shuffle_buffer=10000, getitem_transform=None, batch_transform=None):
+        """
+        :param shards: List of shards, each one is either a file in 1 word per line format (the first and last columns
+        are used as token and concept, sentences are separated by an empty line) or the path prefix of an
+        EncodedCorpus saved with EncodedCorpus.save (i.e. "dir/name" for "dir/name.tokens.npy" and so on), which must
+        have been encoded with the same vocabularies as init_transform.
+        :param init_transform: InitTransform used to encode the sentences.
+        :param shuffle_buffer: Number of samples in the shuffle buffer, 0 to neither shuffle the samples nor the shards.
+        :param getitem_transform: Transform function to be used on each sample.
+        :param batch_transform: Transform function to be used on whole batches by the PadCollate of this dataset.
+        """
+        assert len(shards) > 0, "no shards to stream from"
+        assert shuffle_buffer >= 0, "shuffle_buffer should be greater or equal to 0"
+        self.shards = list(shards)
+        self.init_transform = init_transform
+        self.shuffle_buffer = shuffle_buffer
+        self.getitem_transform = getitem_transform
+        self.batch_transform = batch_transform
+        # samples carry their own chars, see InitTransform.encode_sentence
+        self.char_table = None
+        # number of iterations over the data, persistent workers keep their copy of the dataset between epochs
+        self._epoch = 0
+
+    def _samples(self, shard):
+        if os.path.isfile(shard + ".tokens.npy"):
+            corpus = EncodedCorpus.load(os.path.dirname(shard), os.path.basename(shard))
+            for idx in range(len(corpus)):
+                sample = corpus[idx]
+                if "words" in sample:
+                    sample["chars"] = corpus.char_table[sample.pop("words").long()]
+                yield sample
+        else:
+            for words, concepts in read_conll(shard):
+                yield self.init_transform.encode_sentence(words, concepts)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, workers = 0, 1
+            seed = shard_seed = int(torch.empty((), dtype=torch.int64).random_())
+        else:
+            # the seed of the workers changes every epoch, unless they are persistent; the shards are shuffled with the
+            # base seed, the same in every worker, so that the workers split the same order of the shards
+            worker_id, workers, seed = worker.id, worker.num_workers, worker.seed + self._epoch
+            shard_seed = worker.seed - worker.id + self._epoch
+        self._epoch += 1
+        rng = np.random.RandomState(seed % 2 ** 32)
+
+        shards = self.shards
+        if self.shuffle_buffer > 0:
+            shards = [shards[i] for i in np.random.RandomState(shard_seed % 2 ** 32).permutation(len(shards))]
+        if len(shards) >= workers:
+            samples = itertools.chain.from_iterable(self._samples(shard) for shard in shards[worker_id::workers])
+        else:
+            samples = itertools.chain.from_iterable(self._samples(shard) for shard in shards)
+            samples = itertools.islice(samples, worker_id, None, workers)
+
+        for sample in self._shuffle(samples, rng):
+            yield self.getitem_transform(sample) if self.getitem_transform is not None else sample
+
+    def _shuffle(self, samples, rng):
+        if self.shuffle_buffer == 0:
+            yield from samples
+            return
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+            else:
+                idx = rng.randint(self.shuffle_buffer)
+                yield buffer[idx]
+                buffer[idx] = sample
+        for idx in rng.permutation(len(buffer)):
+            yield buffer[idx]
+
+
+def read_conll(file):
+    """
+    Stream the sentences of a file in 1 word per line format, the first column is the token and the last one is the
+    concept, sentences are separated by an empty line.
+    :param file: Path of the file.
+    :return: Generator of (tokens, concepts) pairs, lists of strings.
+    """
+    with open(file, "r") as f:
+        words, concepts = [], []
+        for line in f:
+            split = line.split()
+            if len(split) > 0:
+                words.append(split[0])
+                concepts.append(split[-1])
+            elif len(words) > 0:
+                yield words, concepts
+                words, concepts = [], []
+        if len(words) > 0:
+            yield words, concepts
+
+
+class PadCollate(object):
+    """
+    Collate function to be passed to the DataLoader, pads a list of samples from a PytorchDataset only up to the
+    length of the longest sentence in the batch, see InitTransform.pad_batch, then optionally transforms the batch.
+    """
+
+    def __init__(self, init_transform, max_length=None, batch_transform=None, char_table=None):
+        """
+        :param init_transform: InitTransform used to encode the samples.
+        :param max_length: Sentences longer than this are cut, None to never cut them.
+        :param batch_transform: Transform function to be used on the padded batch (i.e. a DropTransform).
+        :param char_table: Char table of the EncodedCorpus the samples come from, needed if they contain words.
+        """
+        self.init_transform = init_transform
+        self.max_length = max_length
+        self.batch_transform = batch_transform
+        self.char_table = char_table
+
+    def __call__(self, samples):
+        batch = self.init_transform.pad_batch(samples, self.max_length, self.char_table)
+        return self.batch_transform(batch) if self.batch_transform is not None else batch
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups sentences of similar length in the same batch, so that batches padded to their
+    longest sentence contain little padding. Indexes are shuffled, split in pools of bucket_batches batches, each
+    pool is sorted by length and split in batches, then the order of the batches is shuffled.
+    Batches can also be split among the processes of a distributed run, as a DistributedSampler does with samples.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_batches=50, same_length=False, num_replicas=1,
+                 rank=0, seed=0):
+        """
+        :param lengths: Length of each sentence of the dataset.
+        :param batch_size: Size of the batches.
+        :param shuffle: If False the sentences are sorted by length over the whole dataset and batches are always
+        returned in the same order.
+        :param bucket_batches: Number of batches in each pool of sentences sorted by length.
+        :param same_length: If True batches only contain sentences of the same length, so they are not padded at all,
+        batches might then be smaller than batch_size; only supported without shuffling, shuffled pools would split
+        sentences of the same length in a number of batches that depends on the shuffling.
+        :param num_replicas: Number of processes among which batches are split, process rank gets the batches rank,
+        rank + num_replicas, ...; batches are repeated from the first one so that all processes get the same number of
+        batches.
+        With more than 1 process, batches are shuffled with a random state seeded with seed + the epoch set with
+        set_epoch, so that all the processes shuffle them in the same way.
+        :param rank: Rank of the process.
+        :param seed: Seed of the shuffling with more than 1 process.
+        """
+        assert not (same_length and shuffle), "same_length batches can not be shuffled"
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_batches = bucket_batches
+        self.same_length = same_length
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """
+        :param epoch: Epoch of the next iteration, used for shuffling with more than 1 process.
+        """
+        self.epoch = epoch
+
+    def __iter__(self):
+        random_state = np.random if self.num_replicas == 1 else np.random.RandomState(self.seed + self.epoch)
+        if self.shuffle:
+            idxs = random_state.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.bucket_batches
+        else:
+            idxs = np.arange(len(self.lengths))
+            pool_size = len(self.lengths)
+
+        batches = []
+        for start in range(0, len(idxs), pool_size):
+            pool = idxs[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            if self.same_length:
+                groups = np.split(pool, np.flatnonzero(np.diff(self.lengths[pool])) + 1)
+            else:
+                groups = [pool]
+            for group in groups:
+                batches.extend(group[i:i + self.batch_size].tolist() for i in range(0, len(group), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in random_state.permutation(len(batches))]
+        if self.num_replicas > 1:
+            # repeated cyclically, there might be fewer batches than the ones to add
+            total = -(-len(batches) // self.num_replicas) * self.num_replicas
+            batches = [batches[i % len(batches)] for i in range(self.rank, total, self.num_replicas)]
+        return iter(batches)
+
+    def __len__(self):
+        if self.same_length:
+            counts = np.bincount(self.lengths)
+            batches = int(np.sum((counts + self.batch_size - 1) // self.batch_size))
+        else:
+            batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return (batches + self.num_replicas - 1) // self.num_replicas
+
+
+class EncodedCorpus(object):
+    """
+    A corpus encoded as a few contiguous int32 arrays, sentences are stored one after the other without padding:
+    - tokens: w2v index of each token of the corpus, shape (total tokens)
+    - concepts: class index of each token of the corpus, shape (total tokens)
+    - lengths: length of each sentence, shape (number of sentences)
+    - words: index of the distinct word (surface form) of each token, shape (total tokens), optional
+    - char_table: c2v indexes of the characters of each distinct word, shape (distinct words + 1, padded word
+    length), the last row is filled with 0 and is used for padding words, optional
+    Retrieving a sample returns a dict of tensors that are views into those arrays, the characters of the words of
+    a batch of samples are later gathered from the char table, see InitTransform.pad_batch.
+    """
+
+    def __init__(self, tokens, concepts, lengths, words=None, char_table=None):
+        """
+        :param tokens: Array of w2v indexes, one for each token of the corpus.
+        :param concepts: Array of class indexes, one for each token of the corpus.
+        :param lengths: Array containing the length of each sentence, must sum up to the number of tokens.
+        :param words: Array of indexes of rows of the char table, one for each token of the corpus, or None.
+        :param char_table: Array of shape (distinct words + 1, padded word length) containing c2v indexes, or None.
+        """
+        assert len(tokens) == len(concepts) == np.sum(lengths), "tokens, concepts and lengths do not match"
+        assert (words is None) == (char_table is None), "words and char_table must be passed together"
+        self.tokens = tokens
+        self.concepts = concepts
+        self.lengths = lengths
+        self.words = words
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+
+        # tensors sharing memory with the arrays
+        self._tokens = torch.from_numpy(tokens)
+        self._concepts = torch.from_numpy(concepts)
+        self._words = torch.from_numpy(words) if words is not None else None
+        self.char_table = torch.from_numpy(char_table) if char_table is not None else None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def save(self, path, name):
+        """
+        Save the arrays of the corpus as .npy files, named <name>.<array>.npy, in the given directory.
+        :param path: Directory where to save the arrays.
+        :param name: Prefix of the files.
+        """
+        arrays = {"tokens": self.tokens, "concepts": self.concepts, "lengths": self.lengths, "words": self.words,
+                  "char_table": self.char_table.numpy() if self.char_table is not None else None}
+        for key, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(path, "%s.%s.npy" % (name, key)), array)
+
+    @staticmethod
+    def load(path, name, mmap=True):
+        """
+        Load a corpus saved with save.
+        :param path: Directory containing the arrays.
+        :param name: Prefix of the files.
+        :param mmap: If True arrays are memory mapped (copy on write) instead of being read in memory.
+        :return: EncodedCorpus.
+        """
+        arrays = dict()
+        for key in ["tokens", "concepts", "lengths", "words", "char_table"]:
+            file = os.path.join(path, "%s.%s.npy" % (name, key))
+            arrays[key] = np.load(file, mmap_mode="c" if mmap else None) if os.path.isfile(file) else None
+        return EncodedCorpus(**arrays)
+
+    def __getitem__(self, idx):
+        """
+        :param idx: Index of the sentence.
+        :return: Dict with "tokens", "concepts" and (if present) "words" keys, mapping to unpadded int32 tensors
+        of shape (length of sentence).
+        """
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        sample = dict()
+        sample["tokens"] = self._tokens[start:end]
+        sample["concepts"] = self._concepts[start:end]
+        if self._words is not None:
+            sample["words"] = self._words[start:end]
+        return sample
+
+
 def w2v_matrix_vocab_generator(w2v_pickle):
     """
     Creates the w2v dict mapping word to index and a numpy matrix of (num words, size of embedding), words will
     be mapped to their index, such that row ith will be the embedding of the word mapped to the i index.
 
     :param w2v_pickle: Dataframe containing token and vector columns, where token is a string and vector is the
-    embedding vector, each vector must have the same length (and the length must be equal to the argument embedding_dim).
+    embedding vector, each vector must have the same length (and the length must be equal to the argument
+    embedding_dim); a .npy file written by save_embeddings can be passed instead, in which case it is memory mapped.
     :return: A dict, np matrix pair, the dict maps words to indexes, the matrix ith row will contain the embedding
     of the word mapped to the ith index.
     """
+    if w2v_pickle.endswith(".npy"):
+        return load_embeddings(w2v_pickle)
+
     # create internal w2v dictionary
     w2v_df = pd.read_pickle(w2v_pickle)
-    w2v = dict()
+    w2v = dict(zip(w2v_df["token"].values, range(len(w2v_df))))
     embedding_dim = len(w2v_df.iloc[0, 1])
 
-    # shape +2 for unknown and padding tokens
-    w2v_weights = np.zeros(shape=(w2v_df.shape[0] + 2, embedding_dim))
-    for index, data_point in w2v_df.iterrows():
-        curr_index = len(w2v)
-        w2v[data_point["token"]] = curr_index
-        w2v_weights[curr_index, :] = np.array(data_point["vector"])
+    # shape +2 for unknown and padding tokens, vectors are stacked (and cast) directly into the float32 matrix
+    w2v_weights = np.zeros(shape=(w2v_df.shape[0] + 2, embedding_dim), dtype=np.float32)
+    np.stack(w2v_df["vector"].values, out=w2v_weights[:-2])
     w2v["<UNK>"] = len(w2v_weights) - 2
     w2v["<padding>"] = len(w2v_weights) - 1
     return w2v, w2v_weights
 
 
+def vocab_path(path):
+    """
+    :param path: Path of the .npy file of embeddings saved by save_embeddings.
+    :return: Path of its vocabulary sidecar.
+    """
+    return path[:-len(".npy")] + ".vocab"
+
+
+def save_embeddings(path, vocab, weights):
+    """
+    Save embeddings as a float32 .npy matrix and a vocabulary sidecar (same path, .vocab extension) listing the
+    token of each row, one per line.
+    :param path: Path of the .npy file.
+    :param vocab: Dict mapping tokens to their row, as returned by w2v_matrix_vocab_generator.
+    :param weights: Embedding matrix.
+    """
+    assert path.endswith(".npy"), "embeddings must be saved to a .npy file"
+    np.save(path, np.asarray(weights, dtype=np.float32))
+    with open(vocab_path(path), "w", encoding="utf-8") as file:
+        for token in sorted(vocab, key=vocab.get):
+            file.write(token + "\n")
+
+
+def load_embeddings(path):
+    """
+    Load embeddings saved by save_embeddings, the matrix is memory mapped (copy on write) so that processes
+    loading the same file share its pages, as long as they do not modify them.
+    :param path: Path of the .npy file.
+    :return: A dict, np matrix pair, as for w2v_matrix_vocab_generator.
+    """
+    weights = np.load(path, mmap_mode="c")
+    with open(vocab_path(path), "r", encoding="utf-8") as file:
+        vocab = {line.rstrip("\n"): i for i, line in enumerate(file)}
+    assert len(vocab) == len(weights), "the vocabulary does not match the embeddings in %s" % path
+    return vocab, weights
+
+
+def embedding_tensor(weights, shared=False):
+    """
+    Get a float32 tensor from an embedding matrix, copying it unless shared is True and the matrix has been memory
+    mapped copy on write (i.e. by load_embeddings), in which case the tensor wraps its pages, which stay shared between
+    processes.
+    :param weights: Embedding matrix.
+    :param shared: If the tensor is never written, i.e. it is the weight of a FrozenEmbedding; otherwise optimizer
+    steps and max norm renormalization would write into the matrix of the caller.
+    :return: Float tensor.
+    """
+    if shared and isinstance(weights, np.memmap) and weights.mode == "c" and weights.dtype == np.float32:
+        return torch.from_numpy(np.asarray(weights))
+    return torch.tensor(np.asarray(weights, dtype=np.float32))
+
+
+class FrozenEmbedding(torch.nn.Embedding):
+    """
+    Frozen embedding whose table is never written, so that it can wrap the pages of a memory mapped matrix: max_norm
+    is applied to the looked up vectors instead of renormalizing the rows of the table in place, which gives the same
+    vectors.
+    """
+
+    def forward(self, input):
+        res = torch.nn.functional.embedding(input, self.weight, self.padding_idx)
+        if self.max_norm is None:
+            return res
+        norms = res.norm(p=self.norm_type, dim=-1, keepdim=True)
+        return res * torch.where(norms > self.max_norm, self.max_norm / (norms + 1e-7), torch.ones_like(norms))
+
+
+def pretrained_embedding(weights, freeze=True, max_norm=None):
+    """
+    :param weights: Embedding matrix.
+    :param freeze: If the embedding should be frozen instead of trained.
+    :param max_norm: Max norm of the embeddings, None to not renormalize them.
+    :return: Embedding layer initialized with weights; frozen ones are a FrozenEmbedding sharing the pages of weights
+    if it has been memory mapped copy on write (see embedding_tensor), trained ones a nn.Embedding on a copy of them.
+    """
+    if freeze:
+        return FrozenEmbedding.from_pretrained(embedding_tensor(weights, shared=True), freeze=True, max_norm=max_norm)
+    return torch.nn.Embedding.from_pretrained(embedding_tensor(weights), freeze=False, max_norm=max_norm)
+
+
+class DataCache(object):
+    """
+    On disk cache of preprocessed data, each entry is a directory named after a fingerprint of the files and
+    settings used to produce it, containing the encoded train, dev and test corpora and the embedding matrices as .npy
+    files (memory mapped when loaded) and the class dict and vocabularies as a pickle.
+    """
+    version = 2  # bump when the format of the entries changes
+
+    def __init__(self, directory):
+        """
+        :param directory: Directory where the entries of the cache are stored, created if it does not exist.
+        """
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def key(self, files, **settings):
+        """
+        Fingerprint the content of some files and some settings.
+        :param files: Paths of the files to hash, None entries are allowed (i.e. no c2v embeddings); the vocabulary
+        sidecar of .npy embeddings is hashed with them.
+        :param settings: Other values the preprocessing depends on (i.e. the padding lengths).
+        :return: Hex digest.
+        """
+        digest = hashlib.sha1()
+        digest.update(("%i %s" % (self.version, sorted(settings.items()))).encode())
+        for file in files:
+            digest.update(b"|")
+            if file is None:
+                continue
+            for path in [file, vocab_path(file)] if file.endswith(".npy") else [file]:
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        :param key: Key obtained with the key method.
+        :return: None if there is no such entry, otherwise a dict with keys "class_dict", "w2v_vocab", "w2v_weights",
+        "c2v_vocab", "c2v_weights", "train", "dev", "test", corpora are EncodedCorpus objects, "dev" is None if the
+        entry has no dev corpus.
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+        with open(os.path.join(path, "vocabs.pickle"), "rb") as file:
+            entry = pickle.load(file)
+        entry["w2v_weights"] = np.load(os.path.join(path, "w2v.npy"), mmap_mode="c")
+        entry["c2v_weights"] = np.load(os.path.join(path, "c2v.npy"), mmap_mode="c") \
+            if entry["c2v_vocab"] is not None else None
+        entry["train"] = EncodedCorpus.load(path, "train")
+        entry["dev"] = EncodedCorpus.load(path, "dev") if os.path.isfile(os.path.join(path, "dev.tokens.npy")) else None
+        entry["test"] = EncodedCorpus.load(path, "test")
+        return entry
+
+    def save(self, key, class_dict, w2v_vocab, w2v_weights, c2v_vocab, c2v_weights, train, test, dev=None):
+        """
+        Save an entry, the entry is written in a temporary directory which is then renamed, so that concurrent
+        runs never see partially written entries.
+        :param key: Key obtained with the key method.
+        :param class_dict: Dict mapping concepts to their index.
+        :param w2v_vocab: Dict mapping words to their w2v index.
+        :param w2v_weights: w2v embedding matrix.
+        :param c2v_vocab: Dict mapping chars to their c2v index, or None.
+        :param c2v_weights: c2v embedding matrix, or None.
+        :param train: Train EncodedCorpus.
+        :param test: Test EncodedCorpus.
+        :param dev: Dev EncodedCorpus, or None.
+        """
+        tmp = tempfile.mkdtemp(dir=self.directory)
+        with open(os.path.join(tmp, "vocabs.pickle"), "wb") as file:
+            pickle.dump({"class_dict": class_dict, "w2v_vocab": w2v_vocab, "c2v_vocab": c2v_vocab}, file,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        np.save(os.path.join(tmp, "w2v.npy"), w2v_weights)
+        if c2v_weights is not None:
+            np.save(os.path.join(tmp, "c2v.npy"), c2v_weights)
+        train.save(tmp, "train")
+        if dev is not None:
+            dev.save(tmp, "dev")
+        test.save(tmp, "test")
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError:
+            # somebody else saved the same entry in the meantime
+            for file in os.listdir(tmp):
+                os.remove(os.path.join(tmp, file))
+            os.rmdir(tmp)
+
+
 class Data(object):
     """
     Class to contain data, once initialized it is organized in this way:
     - properties that allow you to get counter maps for words, lemmas, pos tags, concepts, and pairs
     - properties that allow you to get words, lemmas, pos tags, concepts lexicon
     - methods that allow you to get the counter for a specific word, lemma, pos tags, concept or pair
+    The file is streamed, words and concepts are interned to integer ids and counts are kept in numpy arrays, the
+    counter maps are built from those arrays only when they are first needed.
     note: this class is something i copy pasted from an old project of mine, not really that useful in here, mostly used
     for the wfst script.
     """
@@ -74,56 +557,75 @@ class Data(object):
         Inits the structure, importing the file
         and elaborating all the counts.
         :param file: File to pass, format should be
-        token lemma pos concept for each line, separated
+        token lemma pos concept for each line (the first and last columns are used), separated
         by an empty line to signal the end of a phrase.
         """
-        self._data = []  # list of phrases, each phrase is a list of data points (word lemma pos concept)
+        self.__words = dict()  # word to id
+        self.__concepts = dict()  # concept to id
+        word_ids = array.array("i")
+        concept_ids = array.array("i")
+        lengths = array.array("i")
         with open(file, 'r') as file:
-            phrase = []
+            length = 0
             for line in file:
                 split = line.split()
                 if len(split) > 0:
                     # keep building current phrase
-                    phrase.append(split)
+                    word_ids.append(self.__words.setdefault(split[0], len(self.__words)))
+                    concept_ids.append(self.__concepts.setdefault(split[-1], len(self.__concepts)))
+                    length += 1
                 else:
-                    # end of phrase, append it to data
-                    self._data.append(phrase)
-                    phrase = []
+                    # end of phrase
+                    lengths.append(length)
+                    length = 0
+            if length > 0:
+                lengths.append(length)
+
+        self._word_ids = np.frombuffer(word_ids, dtype=np.int32)
+        self._concept_ids = np.frombuffer(concept_ids, dtype=np.int32)
+        self._lengths = np.frombuffer(lengths, dtype=np.int32)
 
         """
-        init and compute counters
+        compute counters
         """
         # singletons
-        self.__words_counter = dict()
-        self.__concepts_counter = dict()
-        self.__concepts_clean_counter = dict()  # concepts without IOB notation
-        # pairs of stuff
-        self.__word_concept_counter = dict()
-
-        for phrase in self._data:
-            for data_point in phrase:
-                word, concept = data_point
-                # singletons
-                self.__words_counter[word] = 1 + self.__words_counter.get(word, 0)
-                self.__concepts_counter[concept] = 1 + self.__concepts_counter.get(concept, 0)
-                clean_c = concept if concept == "O" else concept[2:]
-                self.__concepts_clean_counter[clean_c] = 1 + self.__concepts_clean_counter.get(clean_c, 0)
-                # pairs of stuff
-                self.__word_concept_counter[word + " " + concept] = 1 + self.__word_concept_counter.get(
-                    word + " " + concept, 0)
+        self.__words_counts = np.bincount(self._word_ids, minlength=len(self.__words))
+        self.__concepts_counts = np.bincount(self._concept_ids, minlength=len(self.__concepts))
+        # concepts without IOB notation
+        self.__clean_concepts = dict()
+        clean_ids = np.array([self.__clean_concepts.setdefault(concept if concept == "O" else concept[2:],
+                                                               len(self.__clean_concepts))
+                              for concept in self.__concepts], dtype=np.int64)
+        self.__concepts_clean_counts = np.bincount(clean_ids, weights=self.__concepts_counts,
+                                                   minlength=len(self.__clean_concepts)).astype(np.int64)
+        # pairs of stuff, keyed by word id * number of concepts + concept id, in order of first appearance
+        keys = self._word_ids.astype(np.int64) * len(self.__concepts) + self._concept_ids
+        keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        order = np.argsort(first, kind="stable")
+        self.__pair_keys = keys[order]
+        self.__pair_counts = counts[order]
+        self.__pairs = dict(zip(self.__pair_keys.tolist(), self.__pair_counts.tolist()))
+
+        # counter maps, built when needed
+        self.__words_counter = None
+        self.__concepts_counter = None
+        self.__concepts_clean_counter = None
+        self.__word_concept_counter = None
 
     @property
     def size(self):
         """
         :return: Number of phrases stored.
         """
-        return len(self._data)
+        return len(self._lengths)
 
     @property
     def counter_words(self):
         """
         :return: Dictionary that maps a word to its counter.
         """
+        if self.__words_counter is None:
+            self.__words_counter = dict(zip(self.__words, self.__words_counts.tolist()))
         return self.__words_counter
 
     @property
@@ -131,6 +633,8 @@ class Data(object):
         """
         :return: Dictionary that maps a concept to its counter.
         """
+        if self.__concepts_counter is None:
+            self.__concepts_counter = dict(zip(self.__concepts, self.__concepts_counts.tolist()))
         return self.__concepts_counter
 
     @property
@@ -138,6 +642,8 @@ class Data(object):
         """
         :return: Dictionary that maps a concept (no IOB) to its counter.
         """
+        if self.__concepts_clean_counter is None:
+            self.__concepts_clean_counter = dict(zip(self.__clean_concepts, self.__concepts_clean_counts.tolist()))
         return self.__concepts_clean_counter
 
     @property
@@ -145,6 +651,13 @@ class Data(object):
         """
         :return: Dictionary that maps a word + concept pair to its counter, separated by space.
         """
+        if self.__word_concept_counter is None:
+            words = self.lexicon_words
+            concepts = self.lexicon_concepts
+            self.__word_concept_counter = dict()
+            for key, count in zip(self.__pair_keys.tolist(), self.__pair_counts.tolist()):
+                word, concept = divmod(key, len(concepts))
+                self.__word_concept_counter[words[word] + " " + concepts[concept]] = count
         return self.__word_concept_counter
 
     @property
@@ -152,35 +665,35 @@ class Data(object):
         """
         :return: List of words in the corpus.<epsilon> and <unk> not included.
         """
-        return list(self.counter_words.keys())
+        return list(self.__words.keys())
 
     @property
     def lexicon_concepts(self):
         """
         :return: List of concepts in the corpus.<epsilon> and <unk> not included.
         """
-        return list(self.counter_concepts.keys())
+        return list(self.__concepts.keys())
 
     @property
     def lexicon_clean_concepts(self):
         """
         :return: List of clean concepts  (no IOB notation ) in the corpus.<epsilon> and <unk> not included.
         """
-        return list(self.__concepts_clean_counter.keys())
+        return list(self.__clean_concepts.keys())
 
     def word(self, word):
         """
         :param word: Word for which to return the count for.
         :return: Count of the word, >= 0.
         """
-        return self.__words_counter.get(word, 0)
+        return int(self.__words_counts[self.__words[word]]) if word in self.__words else 0
 
     def concept(self, concept):
         """
         :param concept: Concept for which to return the count for.
         :return: Count of the concept, >= 0.
         """
-        return self.__concepts_counter.get(concept, 0)
+        return int(self.__concepts_counts[self.__concepts[concept]]) if concept in self.__concepts else 0
 
     def word_concept(self, word, concept):
         """
@@ -188,33 +701,46 @@ class Data(object):
         :param concept: Concept of the word - concept pair.
         :return: Count of the word - concept pair >= 0.
         """
-        return self.__word_concept_counter.get(word + " " + concept, 0)
+        if word not in self.__words or concept not in self.__concepts:
+            return 0
+        return self.__pairs.get(self.__words[word] * len(self.__concepts) + self.__concepts[concept], 0)
 
     def to_dataframe(self):
         """
-        Transform the data to a df containing the tokens, lemmas, pos and concepts columns.
+        Transform the data to a df containing the tokens and concepts columns.
         Each sentence will correspond to a row, each column (for each row) contains a list of strings.
         :return: Dataframe transposition of this data object.
         """
-        df = pd.DataFrame(columns=["tokens", "concepts"])
-        for i, phrase in enumerate(self._data):
-            words = []
-            concepts = []
-            for data_point in phrase:
-                word, concept = data_point
-                words.append(word)
-                concepts.append(concept)
-            df.loc[i] = [words, concepts]
-        return df
+        offsets = np.cumsum(self._lengths)[:-1]
+        words = np.array(self.lexicon_words, dtype=object)[self._word_ids]
+        concepts = np.array(self.lexicon_concepts, dtype=object)[self._concept_ids]
+        if self.size == 0:
+            return pd.DataFrame(columns=["tokens", "concepts"])
+        return pd.DataFrame({"tokens": [sentence.tolist() for sentence in np.split(words, offsets)],
+                             "concepts": [sentence.tolist() for sentence in np.split(concepts, offsets)]},
+                            columns=["tokens", "concepts"])
+
+    def encode(self, init_transform):
+        """
+        Encode the data without going through a dataframe, see InitTransform.encode_corpus.
+        :param init_transform: InitTransform to use.
+        :return: EncodedCorpus containing the data.
+        """
+        return init_transform.encode_interned(self.lexicon_words, self._word_ids, self.lexicon_concepts,
+                                              self._concept_ids, self._lengths)
 
 
 def batch_sequence(batch, device):
     """
     Given a batch return sequence data, labels and chars data (if present) in a "batched" way, as a tensor
     where the first dimension is the dimension of the batch.
-    :param batch: List of sample points, each sample point should contain "tokens" and "concepts" data, list
-    of integers, it may also contain "chars" data, which is a list of integers.
+    :param batch: Either a batch as returned by PadCollate or a list of sample points, each sample point should
+    contain "tokens" and "concepts" data, list of integers, it may also contain "chars" data, which is a list of
+    integers.
     """
+    if isinstance(batch, dict):
+        char_data = batch["chars"].to(device) if "chars" in batch else None
+        return batch["tokens"].to(device), batch["concepts"].to(device), char_data
     list_of_data_tensors = [sample["tokens"].unsqueeze(0) for sample in batch]
     data = torch.cat(list_of_data_tensors, dim=0)
     list_of_labels_tensors = [sample["concepts"].unsqueeze(0) for sample in batch]
@@ -228,7 +754,10 @@ def batch_sequence(batch, device):
 
 class DropTransform(object):
     """ Transformer class to be passed to the pytorch dataset class to transform data at run time, it randomly
-    drops word indexes to 'simulate' unknown words."""
+    drops word indexes to 'simulate' unknown words.
+    It works on whole batches at once (as a batch_transform), but also on single samples; random numbers are drawn
+    from the torch generator, which the DataLoader seeds differently for each worker (and epoch) starting from the
+    seed of the main process."""
 
     def __init__(self, drop_chance, unk_idx, preserve_idx):
         """
@@ -240,38 +769,108 @@ class DropTransform(object):
         self.unk_idx = unk_idx
         self.preserve_idx = preserve_idx
 
-    def _might_drop(self, idx):
-        """
-        Drop idx by chance and if its not the index to preserve.
-        :param idx:
-        :return:
+    def __call__(self, sample):
         """
-        return self.unk_idx if (random.uniform(0, 1) < self.drop_chance and idx != self.preserve_idx) else idx
+        Get a sample (or a batch), concepts and char embeddings idxs (if present) are preserved, each token is instead
+        replaced by a chance equal to self._drop_chance, with a single masked operation.
 
-    def __call__(self, sample):
+        :param sample: Dict containing a "tokens" tensor of any shape.
+        :return: Transformed sample, the other keys map to the same tensors as in sample.
         """
-        Get a sample, concepts and char embeddings idxs (if present) are preserved, each token is instead
-        replaced by a chance equal to self._drop_chance.
-
-        :param sample:
-        :return:
-        """
-        tsample = dict()
-        seq = sample["tokens"].clone()
-        for i in range(len(seq)):
-            seq[i] = self._might_drop(sample["tokens"][i].item())
-        tsample["tokens"] = seq
-        tsample["concepts"] = sample["concepts"]
-        tsample["sequence_extra"] = sample["sequence_extra"]
-        if "chars" in sample:
-            tsample["chars"] = sample["chars"]
+        tsample = dict(sample)
+        tokens = sample["tokens"]
+        mask = (torch.rand(tokens.size()) < self.drop_chance) & (tokens != self.preserve_idx)
+        tsample["tokens"] = tokens.masked_fill(mask, self.unk_idx)
         return tsample
 
 
+class VocabResolver(object):
+    """
+    Resolves strings to their index in a vocabulary, falling back to the title case version of the string, to the
+    index of "number" for digits and to the <UNK> index otherwise.
+    Resolved indexes are cached, so that the fallbacks are computed once per surface form; the cache is bounded, the
+    least recently used strings are evicted first.
+    """
+
+    def __init__(self, vocab, number_idx=None, unk_idx=None, cache_size=100000):
+        """
+        :param vocab: Dict mapping strings to an index.
+        :param number_idx: Index used for digits (and strings containing "DIGIT") that are not in vocab, None to treat
+        them as any other unknown string.
+        :param unk_idx: Index used for unknown strings, might be None.
+        :param cache_size: Max number of strings whose index is cached.
+        """
+        assert cache_size > 0, "cache_size should be positive"
+        self.vocab = vocab
+        self.number_idx = number_idx
+        self.unk_idx = unk_idx
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.oov = 0
+
+    def _lookup(self, word):
+        if word in self.vocab:
+            return self.vocab[word]
+        title = word.title()
+        if title in self.vocab:
+            return self.vocab[title]
+        if self.number_idx is not None and (word.isdigit() or word.find("DIGIT") != -1):
+            return self.number_idx
+        return self.unk_idx
+
+    def __call__(self, word):
+        """
+        :param word: String to look up.
+        :return: Index of the string, unk_idx if it could not be resolved.
+        """
+        try:
+            idx = self._cache[word]
+            self._cache.move_to_end(word)
+            self.hits += 1
+        except KeyError:
+            idx = self._lookup(word)
+            self._cache[word] = idx
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self.misses += 1
+        if idx == self.unk_idx:
+            self.oov += 1
+        return idx
+
+    @property
+    def lookups(self):
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    @property
+    def oov_rate(self):
+        """Fraction of the lookups that resolved to unk_idx."""
+        return self.oov / self.lookups if self.lookups > 0 else 0.0
+
+    def clear(self):
+        """Empty the cache and reset the counters."""
+        self._cache.clear()
+        self.hits = self.misses = self.oov = 0
+
+    def __getstate__(self):
+        # do not ship the cache to dataloader workers
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        return state
+
+    def __repr__(self):
+        return "VocabResolver(lookups=%i, hit rate=%.4f, oov rate=%.4f)" % (self.lookups, self.hit_rate, self.oov_rate)
+
+
 class InitTransform(object):
-    """ Transformer class to be passed to the PytorchDataset class to transform data at import time, given a sample,
-    returns a transformed sample, which is a dict mapping keys to tensors of either w2v indexes, c2v indexes, concept
-    indexes, see this class __call__ method for more info.
+    """ Transformer class to be passed to the PytorchDataset class to encode data at import time, whole corpora
+    (encode_corpus) or single sentences (encode_sentence) are encoded to w2v, c2v and concept indexes, which are padded
+    per batch by pad_batch.
     """
 
     def __init__(self, w2v_vocab, class_vocab, c2v_vocab=None, sentence_length_cap=50, word_length_cap=30,
@@ -282,132 +881,134 @@ class InitTransform(object):
         :param class_vocab: Dictionary that maps classes from column "concepts" to an integer, their index.
         :param c2v_vocab: Dict mapping chars to their c2v index (of the c2v_weights matrix passed to the constructor
         of the neural network class).
-        :param sentence_length_cap: Sentences shorter than this cap will be padded, if longer will be cut.
+        :param sentence_length_cap: Sentences shorter than this cap will be padded, if longer will be cut, in the
+        "sequence_extra" matrix of batches (pad_batch).
         :param word_length_cap: Words shorter than this cap will be padded, if longer will be cut, only used if
         c2v embeddings are being used.
-        :param add_matrix: If True, the transformed sample will also have a key "sequence_extra" which maps
-        to the sentence seen as a matrix of shape (padded number of words, embedding size).
+        :param add_matrix: If True, batches will also have a key "sequence_extra", see pad_batch.
         """
         self.w2v_vocab = w2v_vocab
         self.c2v_vocab = c2v_vocab
         self.class_vocab = class_vocab
+        self.w2v_resolver = VocabResolver(w2v_vocab, w2v_vocab.get("number"), w2v_vocab["<UNK>"])
+        self.c2v_resolver = None if c2v_vocab is None else VocabResolver(c2v_vocab, unk_idx=c2v_vocab["<UNK>"])
         self.pad_sentence_length = sentence_length_cap
         self.pad_word_length = word_length_cap
         self.add_matrix = add_matrix
 
-    def _to_w2v_indexes(self, sentence):
-        """
-        Given a list of strings returns a tensor of shape (length of sentence).
-        For each string in the sentence the corresponding w2v index that is going to be part of the final tensor
-        is obtained from the w2v vocabulary if there exist a word-index pair, otherwise the word is either treated
-        as <unk>, returning the <unk> idx.
-        :param sentence: List of strings.
-        :return: Tensor of shape (length of sentence) containing w2v indexes for each word in the sentence.
-        """
-
-        vectors = []
-        for word in sentence:
-            if word in self.w2v_vocab:
-                vectors.append(self.w2v_vocab[word])
-            elif word.title() in self.w2v_vocab:
-                vectors.append(self.w2v_vocab[word.title()])
-            elif word.isdigit() or word.find("DIGIT") != -1:
-                vectors.append(self.w2v_vocab["number"])
-            else:
-                vectors.append(self.w2v_vocab["<UNK>"])
-
-        if len(vectors) > self.pad_sentence_length:
-            vectors = vectors[:self.pad_sentence_length]
-        elif len(vectors) < self.pad_sentence_length:
-            vectors.extend([self.w2v_vocab["<padding>"]] * (self.pad_sentence_length - len(vectors)))
-        return torch.LongTensor(vectors)
-
-    def _to_vocab_indexes(self, dictionary, sentence):
-        """
-        Given a dictionary mapping words to an index returns a tensor of shape (length of sentence) containing
-        the indexes of those words.
-        Assumes each word in the sentence has a mapping (this is usually used for concepts).
-        :param dictionary: Dict mapping words in sentence to an index, must contain every word in sentence.
-        :param sentence: List of strings.
-        :return: Tensor of indexes.
-        """
-        idxs = [dictionary[word] for word in sentence]
-        if len(idxs) > self.pad_sentence_length:
-            idxs = idxs[:self.pad_sentence_length]
-        elif len(idxs) < self.pad_sentence_length:
-            idxs.extend([-1] * (self.pad_sentence_length - len(idxs)))
-        return torch.tensor(idxs, dtype=torch.long)
-
-    def _to_matrix(self, sentence, vocab, pad_length):
-        """
-        Given a list of strings returns a tensor of shape (1, padded length, 1).
-        The length of the sentence is padded if it does not reach pad_length.
-        For each string in the sentence the corresponding w2v (or c2v) index that is going to be part of the final tensor
-        is obtained from the vocabulary if there exist a word-index pair, otherwise the word is either treated
-        as <UNK> or <padding> (if it is a padding word) and their index is used.
-        :param sentence: List of strings.
-        :param vocab: Dict mapping strings to an index.
-        :param pad_length: Length to which sentences (list of strings) will be padded to by using the index vocab["<padding>"].
-        :return: Tensor of shape (1, pad_length, 1) containing w2v indexes for each word in the sentence.
-        """
-
-        vectors = []
-        for word in sentence:
-            if word in vocab:
-                vectors.append(vocab[word])
-            elif word.title() in vocab:
-                vectors.append(vocab[word.title()])
-            elif word.isdigit() or word.find("DIGIT") != -1:  # or any(char.isdigit() for char in word):
-                vectors.append(self.w2v_vocab["number"])
-            else:
-                vectors.append(vocab["<UNK>"])
-        if len(vectors) > pad_length:
-            vectors = vectors[:pad_length]
-        elif len(vectors) < pad_length:
-            vectors.extend([vocab["<padding>"]] * (pad_length - len(vectors)))
-        tensor = torch.tensor(vectors).view(1, pad_length)
-        return tensor
-
-    def _words_to_char_embeddings(self, sentence):
-        """
-        Given a sentence, return a tensor of size (1, 1, padded sentence length, padded word length) where
-        values are indexes of char embeddings from the c2v vocab.
-        :param sentence: List of strings.
-        :return:
-        """
-        tensors_list = []
-        res = torch.zeros(1, 1, self.pad_sentence_length, self.pad_word_length).long()
-        curr_word = 0
-        for word in sentence:
-            char_matrix = self._to_matrix(word, self.c2v_vocab, self.pad_word_length)
-            res[0, 0, curr_word, :] = char_matrix[0, :]
-            tensors_list.append(char_matrix)
-            curr_word += 1
-
-        return res
-
-    def __call__(self, sample):
-        """
-        Given a sample, a dict which has keys:
-        "tokens" : mapping to list of strings (tokens)
-        "concepts" : mapping to list of strings (concepts)
-        return a transformed sample, which is another dict, which has keys:
-        "tokens" : mapping to a list of w2v indices of the tokens in the sample
-        "concepts" : mapping to a list of indices which represent classes (concepts in the sample)
-        if the instance of class was init with add_matrix=True the transformed sample will also contain:
-            "sequence_extra": mapping to a matrix of shape (1, length of words (padded)), containing w2v indices of the tokens
-        if the instance of class was init with c2v_vocab different than None the transformed sample will also contain:
-            "chars" : mapping to a matrix of #tokens in the sentence (padded) * characters in each token (padded), in order
-            to later use c2v embeddings with convolution 
-        passed with the sample, put in this way in order to later use w2v embeddings with convolution.
-        :param sample:dict with sequence and concepts keys, mapping to list of strings.
-        :return:
-        """
-        tsample = dict()
-        tsample["tokens"] = self._to_w2v_indexes(sample["tokens"])
-        tsample["concepts"] = self._to_vocab_indexes(self.class_vocab, sample["concepts"])
-        if self.add_matrix:
-            tsample["sequence_extra"] = self._to_matrix(sample["tokens"], self.w2v_vocab, self.pad_sentence_length)
+    def _to_char_indexes(self, word):
+        """
+        Given a word returns the list of c2v indexes of its characters, padded (or cut) to the padded word length.
+        :param word: String.
+        :return: List of c2v indexes.
+        """
+        idxs = [self.c2v_resolver(char) for char in word[:self.pad_word_length]]
+        idxs.extend([self.c2v_vocab["<padding>"]] * (self.pad_word_length - len(idxs)))
+        return idxs
+
+    def encode_corpus(self, df):
+        """
+        Encode the "tokens" and "concepts" columns of a dataframe in one pass, each distinct word is looked up only
+        once, sentences are neither padded nor cut.
+        :param df: Dataframe with "tokens" and "concepts" columns, entries are lists of strings.
+        :return: EncodedCorpus containing the data of the dataframe.
+        """
+        tokens = df["tokens"].values
+        lengths = np.fromiter((len(sentence) for sentence in tokens), dtype=np.int32, count=len(tokens))
+        total = int(lengths.sum())
+
+        # map each token and concept to the id of its surface form
+        words = dict()
+        word_ids = np.fromiter((words.setdefault(word, len(words)) for word in itertools.chain(*tokens)),
+                               dtype=np.int32, count=total)
+        concepts = dict()
+        concept_ids = np.fromiter((concepts.setdefault(concept, len(concepts))
+                                   for concept in itertools.chain(*df["concepts"].values)), dtype=np.int32, count=total)
+        return self.encode_interned(list(words), word_ids, list(concepts), concept_ids, lengths)
+
+    def encode_interned(self, words, word_ids, concepts, concept_ids, lengths):
+        """
+        Encode a corpus whose words and concepts have already been mapped to integer ids, each distinct word and
+        concept is looked up only once.
+        :param words: List of distinct words, the ith word has id i.
+        :param word_ids: Array with the id of the word of each token of the corpus.
+        :param concepts: List of distinct concepts, the ith concept has id i.
+        :param concept_ids: Array with the id of the concept of each token of the corpus.
+        :param lengths: Array containing the length of each sentence.
+        :return: EncodedCorpus containing the corpus.
+        """
+        word_ids = np.asarray(word_ids, dtype=np.int32)
+        lengths = np.asarray(lengths, dtype=np.int32)
+        w2v_idxs = np.fromiter((self.w2v_resolver(word) for word in words), dtype=np.int32, count=len(words))
+        class_idxs = np.fromiter((self.class_vocab[concept] for concept in concepts), dtype=np.int32,
+                                 count=len(concepts))
+        tokens = w2v_idxs[word_ids]
+        concepts = class_idxs[np.asarray(concept_ids)]
+
+        if self.c2v_vocab is None:
+            return EncodedCorpus(tokens, concepts, lengths)
+
+        # chars of each distinct word, plus a row of 0s for padding words
+        char_table = np.zeros((len(words) + 1, self.pad_word_length), dtype=np.int32)
+        if len(words) > 0:
+            char_table[:-1] = [self._to_char_indexes(word) for word in words]
+        return EncodedCorpus(tokens, concepts, lengths, word_ids, char_table)
+
+    def encode_sentence(self, tokens, concepts):
+        """
+        Encode a single sentence, neither padding nor cutting it, used when streaming sentences.
+        :param tokens: List of strings.
+        :param concepts: List of strings, the concept of each token.
+        :return: Dict with "tokens" and "concepts" keys mapping to int32 tensors of shape (length of sentence), if
+        c2v embeddings are being used also a "chars" key mapping to an int32 tensor of shape (length of sentence,
+        word_length_cap) of c2v indexes.
+        """
+        sample = dict()
+        sample["tokens"] = torch.tensor([self.w2v_resolver(word) for word in tokens], dtype=torch.int32)
+        sample["concepts"] = torch.tensor([self.class_vocab[concept] for concept in concepts], dtype=torch.int32)
         if self.c2v_vocab is not None:
-            tsample["chars"] = self._words_to_char_embeddings(sample["tokens"])
-        return tsample
+            chars = [self._to_char_indexes(word) for word in tokens]
+            sample["chars"] = torch.tensor(chars, dtype=torch.int32).view(len(tokens), self.pad_word_length)
+        return sample
+
+    def pad_batch(self, samples, max_length=None, char_table=None):
+        """
+        Pad a list of samples retrieved from an EncodedCorpus to the length of the longest sentence among them.
+        :param samples: List of dicts with "tokens", "concepts" and optionally "words" keys, as returned by an
+        EncodedCorpus, or with "tokens", "concepts" and optionally "chars" keys, as returned by encode_sentence.
+        :param max_length: Sentences longer than this are cut, None to never cut them.
+        :param char_table: Char table of the EncodedCorpus, used to gather the chars of the words of the samples.
+        :return: A batch, which is a dict with keys:
+        "tokens": mapping to a tensor of shape (batch, padded length) of w2v indexes, padded with the <padding> index
+        "concepts": mapping to a tensor of shape (batch, padded length) of concept indexes, padded with -1
+        "lengths": mapping to a tensor of shape (batch) with the length of each sentence
+        if the instance of class was init with add_matrix=True the batch will also contain:
+            "sequence_extra": mapping to a tensor of shape (batch, 1, sentence_length_cap) of w2v indexes, sentences
+            are padded or cut to sentence_length_cap regardless of the other sentences in the batch
+        if the samples contain words (or chars) the batch will also contain:
+            "chars": mapping to a tensor of shape (batch, 1, padded length, word_length_cap) of c2v indexes, padding
+            words are filled with 0
+        """
+        lengths = [len(sample["tokens"]) if max_length is None else min(len(sample["tokens"]), max_length)
+                   for sample in samples]
+        padding = self.w2v_vocab["<padding>"]
+
+        batch = dict()
+        batch["tokens"] = pad_sequence([sample["tokens"][:length] for sample, length in zip(samples, lengths)],
+                                       batch_first=True, padding_value=padding).long()
+        batch["concepts"] = pad_sequence([sample["concepts"][:length] for sample, length in zip(samples, lengths)],
+                                         batch_first=True, padding_value=-1).long()
+        batch["lengths"] = torch.tensor(lengths, dtype=torch.long)
+        if self.add_matrix:
+            matrix = batch["tokens"][:, :self.pad_sentence_length]
+            matrix = torch.nn.functional.pad(matrix, (0, self.pad_sentence_length - matrix.size(1)), value=padding)
+            batch["sequence_extra"] = matrix.unsqueeze(1)
+        if "words" in samples[0]:
+            words = pad_sequence([sample["words"][:length] for sample, length in zip(samples, lengths)],
+                                 batch_first=True, padding_value=len(char_table) - 1)
+            batch["chars"] = char_table[words.long()].long().unsqueeze(1)
+        elif "chars" in samples[0]:
+            chars = pad_sequence([sample["chars"][:length] for sample, length in zip(samples, lengths)],
+                                 batch_first=True, padding_value=0)
+            batch["chars"] = chars.long().unsqueeze(1)
+        return batch
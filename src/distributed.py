@@ -0,0 +1,107 @@
+import os
+import socket
+import contextlib
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+"""
+Helpers for data parallel training on the cpu: N local processes are launched and joined in a gloo process group,
+each one trains a replica of the model on its share of the batches while gradients are averaged among them.
+Rank 0 is the one reporting, only its output is printed.
+"""
+
+
+def is_distributed():
+    """
+    :return: True if this process is part of a process group.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def rank():
+    """
+    :return: Rank of this process, 0 if it is not part of a process group.
+    """
+    return dist.get_rank() if is_distributed() else 0
+
+
+def world_size():
+    """
+    :return: Number of processes in the process group, 1 if this process is not part of one.
+    """
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _worker(process_rank, function, nprocs, port, args, results):
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:%i" % port, rank=process_rank, world_size=nprocs)
+    # the cores are split among the processes, instead of each one using all of them
+    torch.set_num_threads(max(1, torch.get_num_threads() // nprocs))
+    try:
+        if process_rank == 0:
+            results.put(function(*args, rank=process_rank))
+        else:
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                function(*args, rank=process_rank)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(function, nprocs, *args):
+    """
+    Run function(*args, rank=<rank>) in nprocs processes joined in a gloo process group, waiting for all of them to
+    end; an exception raised by any process is raised again here.
+    :param function: Function to run, it must be importable from the new processes (i.e. defined at module level).
+    :param nprocs: Number of processes.
+    :param args: Arguments of the function, they are pickled for each process.
+    :return: Value returned by the function in rank 0, it must be picklable.
+    """
+    results = mp.get_context("spawn").SimpleQueue()
+    mp.spawn(_worker, args=(function, nprocs, _free_port(), args, results), nprocs=nprocs)
+    return results.get()
+
+
+def gather(obj):
+    """
+    Gather an object from each process to rank 0, all processes must call this.
+    :param obj: Picklable object.
+    :return: On rank 0 the list of the objects of each process, in rank order, None on the others.
+    """
+    if not is_distributed():
+        return [obj]
+    objs = [None] * dist.get_world_size() if dist.get_rank() == 0 else None
+    dist.gather_object(obj, objs, dst=0)
+    return objs
+
+
+def broadcast(obj):
+    """
+    Send an object from rank 0 to all processes, all processes must call this.
+    :param obj: Picklable object, ignored on ranks other than 0.
+    :return: The object of rank 0.
+    """
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=0)
+    return objs[0]
+
+
+def sum_over_processes(values):
+    """
+    Sum values over all processes, all processes must call this.
+    :param values: List of numbers.
+    :return: List with the sums.
+    """
+    if not is_distributed():
+        return values
+    totals = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(totals)
+    return totals.tolist()
@@ -3,12 +3,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import data_manager
+from models import packing
 
 
 class Attention(nn.Module):
 
     def __init__(self, device, w2v_weights, decoder_embedding_size, hidden_dim, tagset_size, drop_rate=0.5, bidirectional=False,
-                 freeze=True, max_norm_emb1=10, max_norm_emb2=1, padded_sentence_length=25):
+                 freeze=True, max_norm_emb1=10, max_norm_emb2=1, padded_sentence_length=25, packed=True):
         """
         :param device: Device to which to map tensors (GPU or CPU).
         :param w2v_weights: Matrix of w2v w2v_weights, ith row contains the embedding for the word mapped to the ith index, the
@@ -21,7 +22,9 @@ class Attention(nn.Module):
         :param freeze: If the embedding parameters should be frozen or trained during training.
         :param max_norm_emb1 Max norm of the embeddings of tokens (used by the encoder), default 10.
         :param max_norm_emb2 Max norm of the embeddings of tags (used by the decoder), default 10.
-        :param padded_sentence_length Length to which sentences are padded.
+        :param padded_sentence_length Max length of the sentences, batches can be padded to shorter lengths.
+        :param packed: If the encoder and the decoder should only run on the real tokens of each sentence, instead of
+        also running on the padding, which is then also left out of the attention.
         """
         super(Attention, self).__init__()
 
@@ -33,14 +36,14 @@ class Attention(nn.Module):
         self.max_length = padded_sentence_length  # max length over any phrase
         self.w2v_weights = w2v_weights
         self.bidirectional = bidirectional
+        self.packed = packed
 
         self.drop_rate = drop_rate
         self.drop = nn.Dropout(self.drop_rate)
 
         # encoder section, gru layer accepts inputs of size hiddendim and as hidden state of the same shape
         # embeddings for the input tokens
-        self.embedding_encoder = nn.Embedding.from_pretrained(torch.FloatTensor(w2v_weights), freeze=freeze)
-        self.embedding_encoder.max_norm = max_norm_emb1
+        self.embedding_encoder = data_manager.pretrained_embedding(w2v_weights, freeze, max_norm_emb1)
         self.gru_encoder = nn.GRU(self.embedding_dim, self.hidden_dim // (1 if not bidirectional else 2),
                                   batch_first=True, bidirectional=bidirectional)
 
@@ -69,12 +72,14 @@ class Attention(nn.Module):
             state = torch.zeros(self.gru_encoder.num_layers, batch_size, self.hidden_dim).to(self.device)
         return state
 
-    def decoder_forward(self, starting_input, hidden, encoder_outputs):
+    def decoder_forward(self, starting_input, hidden, encoder_outputs, mask=None):
         """
         Forward function of the decoder section, meant to be used on inputs of a sequence being passed one at a time.
         :param starting_input: Input of the form (batch, 1, hidden dim).
         :param hidden: Hidden state from a previous iteration.
         :param encoder_outputs: Outputs of the encoder, to be used with attention.
+        :param mask: Mask of the real tokens of each sentence, the padding is left out of the attention, None to attend
+        to the padding too.
         :return: Output for the current token of size (batch, tagset) and a new hidden state.
         """
         tag_embedded = self.embedding_decoder(starting_input)
@@ -82,8 +87,11 @@ class Attention(nn.Module):
 
         # apply attention
         lookat = torch.cat((tag_embedded, hidden.squeeze(0).unsqueeze(1)), dim=2)
-        # softmax so that they sum to one
-        attn_weights = F.softmax(self.attn(lookat), dim=2)
+        # softmax so that they sum to one, only over the length of the (padded) sentences in the batch
+        attn_weights = self.attn(lookat)[:, :, :encoder_outputs.size(1)]
+        if mask is not None:
+            attn_weights = attn_weights.masked_fill(~mask.unsqueeze(1), float("-inf"))
+        attn_weights = F.softmax(attn_weights, dim=2)
         attn_applied = torch.bmm(attn_weights, encoder_outputs)
         decoder_input = torch.cat((tag_embedded, attn_applied), 2)
         decoder_input = self.attn_combine(decoder_input)
@@ -101,27 +109,58 @@ class Attention(nn.Module):
         decoder_output = self.softmax(decoder_output)
         return decoder_output, hidden
 
+    def decode_packed(self, decoder_input, hidden_decoder, encoder_outputs, lengths, max_length):
+        """
+        Decode 1 word at a time, each step only on the sentences that have not ended yet.
+        :param decoder_input: First input of the decoder, size = (batch, 1).
+        :param hidden_decoder: Hidden state passed by the encoder.
+        :param encoder_outputs: Outputs of the encoder, zero on padding.
+        :param lengths: Length of each sentence, size = (batch).
+        :param max_length: Padded length of the batch.
+        :return: Scores of each class for each word, size = (batch, max_length, tagset size), zero on padding.
+        """
+        # sentences are sorted by decreasing length, so the ones that have ended are dropped from the end of the batch
+        order, steps = packing.sort_by_length(lengths, max_length)
+        decoder_input, hidden_decoder = decoder_input[order], hidden_decoder[:, order]
+        encoder_outputs = encoder_outputs[order]
+        mask = packing.token_mask(lengths[order], max_length)
+
+        results = []
+        for sentences in steps:
+            hidden_decoder = hidden_decoder[:, :sentences].contiguous()
+            decoder_output, hidden_decoder = self.decoder_forward(decoder_input[:sentences], hidden_decoder,
+                                                                  encoder_outputs[:sentences], mask[:sentences])
+
+            _, topi = decoder_output.topk(1)  # extract predicted label
+            decoder_input = topi.squeeze(1).detach()  # detach from history as input
+            results.append(decoder_output.squeeze(1))
+
+        return packing.scatter_steps(torch.cat(results), lengths, order, max_length)
+
     def forward(self, batch):
         """
         Forward pass given data.
-        :param batch: List of samples containing data as transformed by the init transformer of this class.
+        :param batch: Batch of samples as returned by data_manager.PadCollate.
         :return: A (batch of) vectors of length equal to tagset, scoring each possible class for each word in a sentence,
         for all sentences; a tensor containing the true label for each word and a tensor containing the lengths
         of the sequences in descending order.
         """
         # init hidden layer for the encoder
-        hidden_encoder = self.init_hidden_encoder(len(batch))
-
         # pack data into a batch
         data, labels, _ = data_manager.batch_sequence(batch, self.device)
+        hidden_encoder = self.init_hidden_encoder(data.size(0))
         data = self.embedding_encoder(data)
         data = self.drop(data)
 
         # encode
-        encoder_output, hidden_encoder = self.gru_encoder(data, hidden_encoder)
+        if self.packed:
+            lengths = packing.batch_lengths(batch, labels).to(self.device)
+            encoder_output, hidden_encoder = packing.run_packed(self.gru_encoder, data, lengths, hidden_encoder)
+        else:
+            encoder_output, hidden_encoder = self.gru_encoder(data, hidden_encoder)
 
         # set first token passed to decoder as tagset_size, mapped to the last row of the embedding
-        decoder_input = torch.zeros(len(batch), 1).long()
+        decoder_input = torch.zeros(labels.size(0), 1).long()
         torch.add(decoder_input, self.tagset_size, decoder_input)  # special start character
         decoder_input = decoder_input.to(self.device)
 
@@ -131,6 +170,10 @@ class Attention(nn.Module):
         else:
             hidden_decoder = hidden_encoder
 
+        if self.packed:
+            results = self.decode_packed(decoder_input, hidden_decoder, encoder_output, lengths, data.size(1))
+            return results.view(-1, self.tagset_size), labels.view(-1)
+
         # decode
         results = []
         for di in range(encoder_output.size()[1]):  # max length of any phrase in the batch
@@ -0,0 +1,244 @@
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+import data_manager
+from models import packing
+
+
+class CharCNN(nn.Module):
+    """
+    Convolutional network on the characters of words, shared by the models using c2v embeddings: convolutions on
+    single characters, pairs of characters and 3x characters are max pooled over the word and mapped to a feature
+    vector, which the models concatenate to the embedding of the word.
+    All the words of a batch are convolved at once, padding words are skipped.
+    At inference (in eval mode, without gradients) the features of a word only depend on its characters, so they are
+    cached: the features of known words (i.e. the words of the corpus to predict) can be computed once with precompute
+    and are kept, the ones of other words are kept in a cache of the least recently used cache_size words; a batch then
+    only convolves on the words that are not in the cache, the features of the others are gathered from it.
+    The cache is emptied when the module is set to training mode or its weights are loaded.
+    The weights of a CharCNN with Conv2d layers can be loaded in one with Conv1d layers, they are converted with
+    conv2d_to_conv1d.
+    """
+
+    def __init__(self, c2v_weights, drop_rate, pad_word_length=16, freeze=True, embedding_norm=10., conv1d=False,
+                 cache_size=0, float32_convs=False):
+        """
+        :param c2v_weights: Matrix of c2v weights, ith row contains the embedding for the char mapped to the ith index,
+        the last row should correspond to the padding character.
+        :param drop_rate: Drop rate for regularization.
+        :param pad_word_length: Length to which each word is padded to, needed for the size of the maxpooling window.
+        :param freeze: If the char embeddings should be frozen or trained during training.
+        :param embedding_norm: Max norm of the char embeddings.
+        :param conv1d: If the convolutions should be Conv1d over the chars of a word, with the char embedding as
+        channels, instead of Conv2d with kernels as wide as the char embedding; the two are equivalent, see
+        conv2d_to_conv1d.
+        :param cache_size: Number of words (besides the precomputed ones) whose features are cached at inference, 0 to
+        only cache the precomputed ones.
+        :param float32_convs: If the convolutions should run in float32 also under autocast, see run_float32.
+        """
+        super(CharCNN, self).__init__()
+
+        self.char_embedding_dim = c2v_weights.shape[1]
+        self.pad_word_length = pad_word_length
+        self.conv1d = conv1d
+        self.float32_convs = float32_convs
+        self.feats = 20  # for the output channels of the conv layers
+        self.output_dim = 50
+
+        self.char_embedding = data_manager.pretrained_embedding(c2v_weights, freeze, embedding_norm)
+
+        self.drop_rate = drop_rate
+        self.drop = nn.Dropout(self.drop_rate)
+
+        # conv layers for single character, pairs of characters, 3x characters
+        self.ngram1 = self.ngram(1, self.feats * 1)
+        self.ngram2 = self.ngram(2, self.feats * 2)
+        self.ngram3 = self.ngram(3, self.feats * 3)
+
+        # seq layers to elaborate on the output of conv layers
+        self.fc1 = nn.Sequential(
+            nn.Linear(self.feats, 10),
+        )
+        self.fc2 = nn.Sequential(
+            nn.Linear(self.feats * 2, 20),
+        )
+        self.fc3 = nn.Sequential(
+            nn.Linear(self.feats * 3, 20),
+        )
+
+        self.cache_size = cache_size
+        self.clear_cache()
+
+    def clear_cache(self):
+        """
+        Empty the cache of word features, including the precomputed ones.
+        """
+        # map the chars of a word (as bytes) to its row in the table, known words come first and are never evicted
+        self.known = dict()
+        self.recent = OrderedDict()
+        self.table = None
+
+    def train(self, mode=True):
+        if mode:
+            self.clear_cache()
+        return super(CharCNN, self).train(mode)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self.clear_cache()
+        # the state dict of the convolutions is read after this, so converting it in place is enough
+        if self.conv1d and state_dict.get(prefix + "ngram1.0.weight", torch.empty(0)).dim() == 4:
+            state_dict.update(conv2d_to_conv1d(state_dict, prefix))
+        super(CharCNN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _new_table(self, rows, device):
+        # created outside inference mode, so that it can also be updated outside of it
+        with torch.inference_mode(False):
+            return torch.zeros(rows, self.output_dim, device=device)
+
+    def precompute(self, chars, batch_size=4096):
+        """
+        Compute the features of known words and keep them in the cache until it is emptied, the module must be in eval
+        mode; words cached before are dropped.
+        :param chars: Char indexes of the words, i.e. the char table of an EncodedCorpus, size = (words, pad word
+        length).
+        :param batch_size: Number of words convolved at once.
+        """
+        assert not self.training, "features can only be precomputed in eval mode"
+        self.clear_cache()
+        chars = torch.unique(chars.long().to(self.char_embedding.weight.device), dim=0)
+        table = self._new_table(len(chars) + self.cache_size, chars.device)
+        with torch.inference_mode():
+            for start in range(0, len(chars), batch_size):
+                end = min(start + batch_size, len(chars))
+                table[start:end] = self.word_features(chars[start:end]).float()
+        self.known = {key: i for i, key in enumerate(self._keys(chars))}
+        self.table = table
+
+    @staticmethod
+    def _keys(chars):
+        return [row.tobytes() for row in chars.cpu().numpy()]
+
+    def cached_features(self, chars):
+        """
+        :param chars: Char indexes of words, size = (words, pad word length).
+        :return: Features of each word, from the cache or computed and cached, size = (words, output_dim).
+        """
+        unique, inverse = torch.unique(chars, dim=0, return_inverse=True)
+        keys = self._keys(unique)
+        rows = []
+        for key in keys:
+            row = self.known.get(key)
+            if row is None:
+                row = self.recent.get(key)
+                if row is not None:
+                    self.recent.move_to_end(key)
+            rows.append(row)
+
+        features = unique.new_empty((len(keys), self.output_dim), dtype=torch.float32)
+        hits = [i for i, row in enumerate(rows) if row is not None]
+        if len(hits) > 0:
+            features[hits] = self.table[[rows[i] for i in hits]]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if len(missing) > 0:
+            features[missing] = self.word_features(unique[missing]).float()
+            self._store([keys[i] for i in missing], features[missing])
+        return features[inverse]
+
+    def _store(self, keys, features):
+        if self.cache_size == 0:
+            return
+        if self.table is None:
+            self.table = self._new_table(self.cache_size, features.device)
+        # only the last cache_size words fit, the least recently used words are evicted to make room for them
+        keys, features = keys[-self.cache_size:], features[-self.cache_size:]
+        rows = []
+        for key in keys:
+            if len(self.recent) < self.cache_size:
+                row = len(self.known) + len(self.recent)
+            else:
+                _, row = self.recent.popitem(last=False)
+            self.recent[key] = row
+            rows.append(row)
+        self.table[rows] = features
+
+    def ngram(self, n, channels):
+        """
+        :param n: Number of characters convolved at once.
+        :param channels: Output channels of the convolution.
+        :return: Convolution, dropout, max pooling over the word and activation.
+        """
+        if self.conv1d:
+            return nn.Sequential(
+                nn.Conv1d(self.char_embedding_dim, channels, kernel_size=n),
+                nn.Dropout1d(p=self.drop_rate),
+                nn.MaxPool1d(kernel_size=self.pad_word_length - n + 1),
+                nn.Tanh(),
+            )
+        return nn.Sequential(
+            nn.Conv2d(1, channels, kernel_size=(n, self.char_embedding_dim), stride=(1, self.char_embedding_dim),
+                      padding=0),
+            nn.Dropout2d(p=self.drop_rate),
+            nn.MaxPool2d(kernel_size=(self.pad_word_length - n + 1, 1)),
+            nn.Tanh(),
+        )
+
+    def word_features(self, chars):
+        """
+        :param chars: Char indexes of words, size = (words, pad word length).
+        :return: Features of each word, size = (words, output_dim).
+        """
+        c = self.char_embedding(chars)
+        c = self.drop(c)
+        # Conv1d takes the char embeddings as channels, Conv2d a single channel of chars x char embeddings
+        c = c.transpose(1, 2) if self.conv1d else c.unsqueeze(1)
+        ngram1 = self.fc1(run_float32(self.ngram1, c, self.float32_convs).view(c.size(0), -1))
+        ngram2 = self.fc2(run_float32(self.ngram2, c, self.float32_convs).view(c.size(0), -1))
+        ngram3 = self.fc3(run_float32(self.ngram3, c, self.float32_convs).view(c.size(0), -1))
+        return torch.cat([ngram1, ngram2, ngram3], dim=1)
+
+    def forward(self, char_data, mask=None):
+        """
+        :param char_data: Char indexes of the words of a batch, as in the "chars" of a batch returned by PadCollate,
+        size = (batch, 1, padded length, pad word length).
+        :param mask: Mask of the real words, see packing.token_mask, None to also convolve on padding words.
+        :return: Features of each word, zero for padding words, size = (batch, padded length, output_dim).
+        """
+        batch_size, _, words, word_length = char_data.size()
+        chars = char_data.view(-1, word_length)
+        cached = not self.training and not torch.is_grad_enabled() and (self.cache_size > 0 or len(self.known) > 0)
+        features = self.cached_features if cached else self.word_features
+        if mask is None:
+            return features(chars).view(batch_size, words, -1)
+        return packing.scatter_tokens(features(chars[mask.view(-1)]), mask)
+
+
+def run_float32(layer, data, enabled=True):
+    """
+    Run a layer in float32 also under autocast, i.e. the convolutions of the models under bf16 autocast: they convolve
+    on windows as wide as the embeddings, for which the onednn bfloat16 kernels are much slower than the float32 ones
+    and were seen to output NaNs.
+    :param layer: The nn module.
+    :param data: Input of the layer.
+    :param enabled: If False the layer is just run on data.
+    :return: Output of the layer, in float32 if enabled.
+    """
+    if not enabled:
+        return layer(data)
+    with torch.autocast(data.device.type, enabled=False):
+        return layer(data.float())
+
+
+def conv2d_to_conv1d(state_dict, prefix=""):
+    """
+    Convert the weights of a CharCNN with Conv2d layers to the ones of the equivalent CharCNN with Conv1d layers.
+    :param state_dict: State dict of the CharCNN with Conv2d layers, or of a model containing it.
+    :param prefix: Prefix of the names of the CharCNN weights in state_dict, i.e. "char_cnn." for a model containing it.
+    :return: State dict for the CharCNN with Conv1d layers.
+    """
+    res = dict(state_dict)
+    for name in ["ngram1.0.weight", "ngram2.0.weight", "ngram3.0.weight"]:
+        # (channels, 1, chars, char embedding) to (channels, char embedding, chars)
+        res[prefix + name] = state_dict[prefix + name].squeeze(1).transpose(1, 2).contiguous()
+    return res
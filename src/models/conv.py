@@ -2,11 +2,12 @@ import torch
 import torch.nn as nn
 
 import data_manager
+from models import charcnn, packing
 
 
 class CONV(nn.Module):
     def __init__(self, device, w2v_weights, hidden_dim, tagset_size, pad_sentence_length, drop_rate=0.5, bidirectional=False,
-                 freeze=True, embedding_norm=10):
+                 freeze=True, embedding_norm=10, packed=True, float32_convs=False):
         """
         :param device: Device to which to map tensors (GPU or CPU).
         :param w2v_weights: Matrix of w2v w2v_weights, ith row contains the embedding for the word mapped to the ith index, the
@@ -18,6 +19,9 @@ class CONV(nn.Module):
         :param bidirectional: If the recurrent should be bidirectional.
         :param freeze: If the embedding parameters should be frozen or trained during training.
         :param embedding_norm: Max norm of the embeddings.
+        :param packed: If the recurrent layer and the tag head should only run on the real tokens of each sentence,
+        instead of also running on the padding.
+        :param float32_convs: If the convolutions should run in float32 also under autocast, see charcnn.run_float32.
         """
         super(CONV, self).__init__()
 
@@ -27,9 +31,10 @@ class CONV(nn.Module):
         self.pad_sentence_length = pad_sentence_length
         self.w2v_weights = w2v_weights
         self.bidirectional = bidirectional
+        self.packed = packed
+        self.float32_convs = float32_convs
 
-        self.embedding = nn.Embedding.from_pretrained(torch.FloatTensor(w2v_weights), freeze=freeze)
-        self.embedding.max_norm = embedding_norm
+        self.embedding = data_manager.pretrained_embedding(w2v_weights, freeze, embedding_norm)
 
         self.drop_rate = drop_rate
         self.drop = nn.Dropout(self.drop_rate)
@@ -73,6 +78,8 @@ class CONV(nn.Module):
         )
 
     def prepare_batch(self, batch):
+        if isinstance(batch, dict):
+            return batch["sequence_extra"].to(self.device)
         seq_list = []
         for sample in batch:
             seq = sample["sequence_extra"].unsqueeze(1)
@@ -83,7 +90,7 @@ class CONV(nn.Module):
     def forward(self, batch):
         """
         Forward pass given data.
-        :param batch: List of samples containing data as transformed by the init transformer of this class.
+        :param batch: Batch of samples as returned by data_manager.PadCollate.
         :return: A (batch of) vectors of length equal to tagset, scoring each possible class for each word in a sentence,
         for all sentences; a tensor containing the true label for each word and a tensor containing the lengths
         of the sequences in descending order.
@@ -94,9 +101,9 @@ class CONV(nn.Module):
         embedded = self.drop(embedded)
 
         # convolution on data
-        n1 = self.ngram1(embedded)
-        n2 = self.ngram2(embedded)
-        n3 = self.ngram3(embedded)
+        n1 = charcnn.run_float32(self.ngram1, embedded, self.float32_convs)
+        n2 = charcnn.run_float32(self.ngram2, embedded, self.float32_convs)
+        n3 = charcnn.run_float32(self.ngram3, embedded, self.float32_convs)
 
         # combine result in a vector that will be the initial hidden state of the recurrent layer
         batch_size = embedded.size()[0]
@@ -105,15 +112,27 @@ class CONV(nn.Module):
         n3 = n3.view(batch_size, -1)
         hidden = torch.cat((n1, n2, n3), dim=1).unsqueeze(0)
         if self.bidirectional:
-            hidden = hidden.view(2, hidden.size()[1], -1)
+            # split the state of each sentence in the states of the two directions
+            hidden = hidden.view(hidden.size(1), 2, -1).transpose(0, 1).contiguous()
 
         data, labels, _ = data_manager.batch_sequence(batch, self.device)
         data = self.embedding(data)
         data = self.drop(data)
-        lstm_out, hidden = self.lstm(data, hidden)
-
-        # send output to fc layer(s)
-        tag_space = self.to_tag_space(lstm_out.unsqueeze(1).contiguous())
-        tag_scores = torch.nn.functional.log_softmax(tag_space, dim=3)
+        if not self.packed:
+            lstm_out, hidden = self.lstm(data, hidden)
+
+            # send output to fc layer(s)
+            tag_space = self.to_tag_space(lstm_out.unsqueeze(1).contiguous())
+            tag_scores = torch.nn.functional.log_softmax(tag_space, dim=3)
+            return tag_scores.view(-1, self.tagset_size), labels.view(-1)
+
+        lengths = packing.batch_lengths(batch, labels)
+        lstm_out, hidden = packing.run_packed(self.lstm, data, lengths, hidden, final_state=False)
+
+        # send the output of the real tokens to fc layer(s), padding gets 0 scores
+        mask = packing.token_mask(lengths.to(self.device), data.size(1))
+        tag_space = self.to_tag_space(lstm_out[mask].view(1, 1, -1, lstm_out.size(2)))
+        tag_scores = torch.nn.functional.log_softmax(tag_space, dim=3).view(-1, self.tagset_size)
+        tag_scores = packing.scatter_tokens(tag_scores, mask)
 
         return tag_scores.view(-1, self.tagset_size), labels.view(-1)
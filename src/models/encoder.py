@@ -3,12 +3,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import data_manager
+from models import packing
 
 
 class EncoderDecoderRNN(nn.Module):
 
     def __init__(self, device, w2v_weights, decoder_embedding_size, hidden_dim, tagset_size, drop_rate=0.5, bidirectional=False,
-                 freeze=True, max_norm_emb1=10, max_norm_emb2=10):
+                 freeze=True, max_norm_emb1=10, max_norm_emb2=10, packed=True):
         """
         :param device: Device to which to map tensors (GPU or CPU).
         :param w2v_weights: Matrix of w2v w2v_weights, ith row contains the embedding for the word mapped to the ith index, the
@@ -21,6 +22,8 @@ class EncoderDecoderRNN(nn.Module):
         :param freeze: If the embedding parameters should be frozen or trained during training.
         :param max_norm_emb1 Max norm of the embeddings of tokens (used by the encoder), default 10.
         :param max_norm_emb2 Max norm of the embeddings of tags (used by the decoder), default 10.
+        :param packed: If the encoder and the decoder should only run on the real tokens of each sentence, instead of
+        also running on the padding.
         """
         super(EncoderDecoderRNN, self).__init__()
 
@@ -31,14 +34,14 @@ class EncoderDecoderRNN(nn.Module):
         self.decoder_embedding_size = decoder_embedding_size
         self.w2v_weights = w2v_weights
         self.bidirectional = bidirectional
+        self.packed = packed
 
         self.drop_rate = drop_rate
         self.drop = nn.Dropout(self.drop_rate)
 
         # encoder section, gru layer accepts inputs of size hiddendim and as hidden state of the same shape
         # embeddings for the input tokens
-        self.embedding_encoder = nn.Embedding.from_pretrained(torch.FloatTensor(w2v_weights), freeze=freeze)
-        self.embedding_encoder.max_norm = max_norm_emb1
+        self.embedding_encoder = data_manager.pretrained_embedding(w2v_weights, freeze, max_norm_emb1)
         self.gru_encoder = nn.GRU(self.embedding_dim, self.hidden_dim // (1 if not bidirectional else 2),
                                   batch_first=True, bidirectional=bidirectional)
 
@@ -80,27 +83,54 @@ class EncoderDecoderRNN(nn.Module):
         decoder_output = self.softmax(decoder_output)
         return decoder_output, hidden
 
+    def decode_packed(self, decoder_input, hidden_decoder, lengths, max_length):
+        """
+        Decode 1 word at a time, each step only on the sentences that have not ended yet.
+        :param decoder_input: First input of the decoder, size = (batch, 1).
+        :param hidden_decoder: Hidden state passed by the encoder.
+        :param lengths: Length of each sentence, size = (batch).
+        :param max_length: Padded length of the batch.
+        :return: Scores of each class for each word, size = (batch, max_length, tagset size), zero on padding.
+        """
+        # sentences are sorted by decreasing length, so the ones that have ended are dropped from the end of the batch
+        order, steps = packing.sort_by_length(lengths, max_length)
+        decoder_input, hidden_decoder = decoder_input[order], hidden_decoder[:, order]
+
+        results = []
+        for sentences in steps:
+            hidden_decoder = hidden_decoder[:, :sentences].contiguous()
+            decoder_output, hidden_decoder = self.decoder_forward(decoder_input[:sentences], hidden_decoder)
+
+            _, topi = decoder_output.topk(1)  # extract predicted label
+            decoder_input = topi.squeeze(1).detach()  # detach from history as input
+            results.append(decoder_output.squeeze(1))
+
+        return packing.scatter_steps(torch.cat(results), lengths, order, max_length)
+
     def forward(self, batch):
         """
         Forward pass given data.
-        :param batch: List of samples containing data as transformed by the init transformer of this class.
+        :param batch: Batch of samples as returned by data_manager.PadCollate.
         :return: A (batch of) vectors of length equal to tagset, scoring each possible class for each word in a sentence,
         for all sentences; a tensor containing the true label for each word and a tensor containing the lengths
         of the sequences in descending order.
         """
         # init hidden layers for both encoder and decoder section
-        hidden_encoder = self.init_hidden_encoder(len(batch))
-
         # pack data into a batch
         data, labels, _ = data_manager.batch_sequence(batch, self.device)
+        hidden_encoder = self.init_hidden_encoder(data.size(0))
         data = self.embedding_encoder(data)
         data = self.drop(data)
 
         # encode
-        encoder_output, hidden_encoder = self.gru_encoder(data, hidden_encoder)
+        if self.packed:
+            lengths = packing.batch_lengths(batch, labels).to(self.device)
+            encoder_output, hidden_encoder = packing.run_packed(self.gru_encoder, data, lengths, hidden_encoder)
+        else:
+            encoder_output, hidden_encoder = self.gru_encoder(data, hidden_encoder)
 
         # set first token passed to decoder as tagset_size, mapped to the last row of the embedding
-        decoder_input = torch.zeros(len(batch), 1).long()
+        decoder_input = torch.zeros(labels.size(0), 1).long()
         torch.add(decoder_input, self.tagset_size, decoder_input)  # special start character
         decoder_input = decoder_input.to(self.device)
 
@@ -110,6 +140,10 @@ class EncoderDecoderRNN(nn.Module):
         else:
             hidden_decoder = hidden_encoder
 
+        if self.packed:
+            results = self.decode_packed(decoder_input, hidden_decoder, lengths, data.size(1))
+            return results.view(-1, self.tagset_size), labels.view(-1)
+
         # decode and output 1 word at a time
         results = []
         for di in range(encoder_output.size()[1]):  # max length of any phrase in the batch
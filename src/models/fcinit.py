@@ -2,11 +2,12 @@ import torch
 import torch.nn as nn
 
 import data_manager
+from models import packing
 
 
 class FCINIT(nn.Module):
     def __init__(self, device, w2v_weights, hidden_dim, tagset_size, pad_sentence_length, drop_rate, bidirectional=False,
-                 freeze=True, embedding_norm=10):
+                 freeze=True, embedding_norm=10, packed=True):
         """
         :param device: Device to which to map tensors (GPU or CPU).
         :param w2v_weights: Matrix of w2v w2v_weights, ith row contains the embedding for the word mapped to the ith index, the
@@ -17,6 +18,8 @@ class FCINIT(nn.Module):
         :param bidirectional: If the recurrent should be bidirectional.
         :param freeze: If the embedding parameters should be frozen or trained during training.
         :param embedding_norm: Max norm of the embeddings.
+        :param packed: If the recurrent layer and the tag head should only run on the real tokens of each sentence,
+        instead of also running on the padding.
         """
         super(FCINIT, self).__init__()
 
@@ -28,9 +31,9 @@ class FCINIT(nn.Module):
         self.bidirectional = bidirectional
         self.pad_sentence_length = pad_sentence_length
         self.bidirectional = bidirectional
+        self.packed = packed
 
-        self.embedding = nn.Embedding.from_pretrained(torch.FloatTensor(w2v_weights), freeze=freeze)
-        self.embedding.max_norm = embedding_norm
+        self.embedding = data_manager.pretrained_embedding(w2v_weights, freeze, embedding_norm)
 
         self.drop_rate = drop_rate
         self.drop = nn.Dropout(self.drop_rate)
@@ -70,6 +73,8 @@ class FCINIT(nn.Module):
         return state
 
     def prepare_batch(self, batch):
+        if isinstance(batch, dict):
+            return batch["sequence_extra"].to(self.device)
         seq_list = []
         for sample in batch:
             seq = sample["sequence_extra"].unsqueeze(1)
@@ -83,16 +88,28 @@ class FCINIT(nn.Module):
         embedded = self.embedding(sequence).view(sequence.size()[0], -1)
         hidden = self.fc(embedded).unsqueeze(0)
         if self.bidirectional:
-            hidden = hidden.view(2, hidden.size()[1], -1)
+            # split the state of each sentence in the states of the two directions
+            hidden = hidden.view(hidden.size(1), 2, -1).transpose(0, 1).contiguous()
 
         # output scores for each input embedding, use the pre-elaborated hidden state
         data, labels, char_data = data_manager.batch_sequence(batch, self.device)
         data = self.embedding(data)
         data = self.drop(data)
-        rec_out, hidden = self.recurrent(data, hidden)
+        if not self.packed:
+            rec_out, hidden = self.recurrent(data, hidden)
 
-        # from output of the recurrent layer to a fc layer to map to tag space
-        tag_space = self.to_tag_space(rec_out.unsqueeze(1).contiguous())
-        tag_scores = torch.nn.functional.log_softmax(tag_space, dim=3)
+            # from output of the recurrent layer to a fc layer to map to tag space
+            tag_space = self.to_tag_space(rec_out.unsqueeze(1).contiguous())
+            tag_scores = torch.nn.functional.log_softmax(tag_space, dim=3)
+            return tag_scores.view(-1, self.tagset_size), labels.view(-1)
+
+        lengths = packing.batch_lengths(batch, labels)
+        rec_out, hidden = packing.run_packed(self.recurrent, data, lengths, hidden, final_state=False)
+
+        # from output of the real tokens to a fc layer to map to tag space, padding gets 0 scores
+        mask = packing.token_mask(lengths.to(self.device), data.size(1))
+        tag_space = self.to_tag_space(rec_out[mask].view(1, 1, -1, rec_out.size(2)))
+        tag_scores = torch.nn.functional.log_softmax(tag_space, dim=3).view(-1, self.tagset_size)
+        tag_scores = packing.scatter_tokens(tag_scores, mask)
 
         return tag_scores.view(-1, self.tagset_size), labels.view(-1)
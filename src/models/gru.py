@@ -3,11 +3,13 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import data_manager
+from models import packing, charcnn
 
 
 class GRU(nn.Module):
     def __init__(self, device, w2v_weights, hidden_dim, tagset_size, drop_rate, bidirectional=False,
-                 freeze=True, embedding_norm=10., c2v_weights=None, pad_word_length=16):
+                 freeze=True, embedding_norm=10., c2v_weights=None, pad_word_length=16, packed=True,
+                 char_conv1d=False, char_cache=0):
         """
         :param device: Device to which to map tensors (GPU or CPU).
         :param w2v_weights: Matrix of w2v w2v_weights, ith row contains the embedding for the word mapped to the ith index, the
@@ -23,6 +25,10 @@ class GRU(nn.Module):
         on character representations add that the obtained feature vector to the embedding vector of the token.
         :param pad_word_length: Length to which each word is padded to, only used if c2v_weights has been passed and
         the network is going to use char representations, it is needed for the size of the maxpooling window.
+        :param packed: If the recurrent layer and the tag head should only run on the real tokens of each sentence,
+        instead of also running on the padding.
+        :param char_conv1d: If the convolutions on characters should use Conv1d instead of Conv2d, see charcnn.CharCNN.
+        :param char_cache: Number of words whose char features are cached at inference, see charcnn.CharCNN.
         """
         super(GRU, self).__init__()
 
@@ -35,9 +41,9 @@ class GRU(nn.Module):
         self.bidirectional = bidirectional
         self.pad_word_length = pad_word_length
         self.bidirectional = bidirectional
+        self.packed = packed
 
-        self.embedding = nn.Embedding.from_pretrained(torch.FloatTensor(w2v_weights), freeze=freeze)
-        self.embedding.max_norm = embedding_norm
+        self.embedding = data_manager.pretrained_embedding(w2v_weights, freeze, embedding_norm)
 
         self.drop_rate = drop_rate
         self.drop = nn.Dropout(self.drop_rate)
@@ -56,54 +62,12 @@ class GRU(nn.Module):
 
         # setup convolution on characters if c2v_weights are passed
         if self.c2v_weights is not None:
-            self.char_embedding_dim = c2v_weights.shape[1]
-            self.char_embedding = nn.Embedding.from_pretrained(torch.FloatTensor(c2v_weights), freeze=freeze)
-            self.char_embedding.max_norm = embedding_norm
-            self.feats = 20  # for the output channels of the conv layers
-
-            self.recurrent = nn.GRU(self.embedding_dim + 50,
+            self.char_cnn = charcnn.CharCNN(c2v_weights, self.drop_rate, self.pad_word_length, freeze, embedding_norm,
+                                            char_conv1d, char_cache)
+            self.recurrent = nn.GRU(self.embedding_dim + self.char_cnn.output_dim,
                                     self.hidden_dim // (1 if not self.bidirectional else 2),
                                     batch_first=True, bidirectional=self.bidirectional)
 
-            # conv layers for single character, pairs of characters, 3x characters
-            self.ngram1 = nn.Sequential(
-                nn.Conv2d(1, self.feats * 1, kernel_size=(1, self.char_embedding_dim),
-                          stride=(1, self.char_embedding_dim),
-                          padding=0),
-                nn.Dropout2d(p=self.drop_rate),
-                nn.MaxPool2d(kernel_size=(self.pad_word_length, 1)),
-                nn.Tanh(),
-            )
-
-            self.ngram2 = nn.Sequential(
-                nn.Conv2d(1, self.feats * 2, kernel_size=(2, self.char_embedding_dim),
-                          stride=(1, self.char_embedding_dim),
-                          padding=0),
-                nn.Dropout2d(p=self.drop_rate),
-                nn.MaxPool2d(kernel_size=(self.pad_word_length - 1, 1)),
-                nn.Tanh(),
-            )
-
-            self.ngram3 = nn.Sequential(
-                nn.Conv2d(1, self.feats * 3, kernel_size=(3, self.char_embedding_dim),
-                          stride=(1, self.char_embedding_dim),
-                          padding=0),
-                nn.Dropout2d(p=self.drop_rate),
-                nn.MaxPool2d(kernel_size=(self.pad_word_length - 2, 1)),
-                nn.Tanh(),
-            )
-
-            # seq layers to elaborate on the output of conv layers
-            self.fc1 = nn.Sequential(
-                nn.Linear(self.feats, 10),
-            )
-            self.fc2 = nn.Sequential(
-                nn.Linear(self.feats * 2, 20),
-            )
-            self.fc3 = nn.Sequential(
-                nn.Linear(self.feats * 3, 20),
-            )
-
     def init_hidden(self, batch_size):
         """
         Inits the hidden state of the recurrent layer.
@@ -119,39 +83,35 @@ class GRU(nn.Module):
     def forward(self, batch):
         """
         Forward pass given data.
-        :param batch: List of samples containing data as transformed by the init transformer of this class.
+        :param batch: Batch of samples as returned by data_manager.PadCollate.
         :return: A (batch of) vectors of length equal to tagset, scoring each possible class for each word in a sentence,
         for all sentences; a tensor containing the true label for each word and a tensor containing the lengths
         of the sequences in descending order.
         """
-        hidden = self.init_hidden(len(batch))
-
         # pack sentences and pass through rnn
         data, labels, char_data = data_manager.batch_sequence(batch, self.device)
+        lengths = packing.batch_lengths(batch, labels)
+        hidden = self.init_hidden(data.size(0))
         data = self.embedding(data)
         data = self.drop(data)
 
         if self.c2v_weights is not None:
-            batched_conv = []
-            char_data = self.char_embedding(char_data)
-            char_data = self.drop(char_data)
-            num_words = char_data.size()[2]
-            for i in range(num_words):
-                # get word for each batch, then convolute on the ith word of each batch and concatenate
-                c = char_data[:, 0, i, :, :].unsqueeze(1)
-                ngram1 = self.ngram1(c).view(char_data.size()[0], 1, 1, -1)
-                ngram2 = self.ngram2(c).view(char_data.size()[0], 1, 1, -1)
-                ngram3 = self.ngram3(c).view(char_data.size()[0], 1, 1, -1)
-                ngram1 = self.fc1(ngram1)
-                ngram2 = self.fc2(ngram2)
-                ngram3 = self.fc3(ngram3)
-                batched_conv.append(torch.cat([ngram1, ngram2, ngram3], dim=3))
-            batched_conv = torch.cat(batched_conv, dim=1).squeeze(2)
-            data = torch.cat([data, batched_conv], dim=2)
-
-        rec_out, hidden = self.recurrent(data, hidden)
-        # send output to fc layer(s)
-        tag_space = self.hidden2tag(rec_out.unsqueeze(1).contiguous())
-        tag_scores = F.log_softmax(tag_space, dim=3)
+            # char features of the real words, padding words get 0 features
+            mask = packing.token_mask(lengths.to(self.device), data.size(1))
+            data = torch.cat([data, self.char_cnn(char_data, mask)], dim=2)
+
+        if not self.packed:
+            rec_out, hidden = self.recurrent(data, hidden)
+            # send output to fc layer(s)
+            tag_space = self.hidden2tag(rec_out.unsqueeze(1).contiguous())
+            tag_scores = F.log_softmax(tag_space, dim=3)
+            return tag_scores.view(-1, self.tagset_size), labels.view(-1)
+
+        rec_out, hidden = packing.run_packed(self.recurrent, data, lengths, hidden, final_state=False)
+        # send the output of the real tokens to fc layer(s), padding gets 0 scores
+        mask = packing.token_mask(lengths.to(self.device), data.size(1))
+        tag_space = self.hidden2tag(rec_out[mask].view(1, 1, -1, rec_out.size(2)))
+        tag_scores = F.log_softmax(tag_space, dim=3).view(-1, self.tagset_size)
+        tag_scores = packing.scatter_tokens(tag_scores, mask)
 
         return tag_scores.view(-1, self.tagset_size), labels.view(-1)
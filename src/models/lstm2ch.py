@@ -3,11 +3,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import data_manager
+from models import packing
 
 
 class LSTM2CH(nn.Module):
     def __init__(self, device, w2v_weights, hidden_dim, tagset_size, drop_rate, bidirectional=False,
-                 embedding_norm=10.):
+                 embedding_norm=10., packed=True):
         """
         :param device: Device to which to map tensors (GPU or CPU).
         :param w2v_weights: Matrix of w2v w2v_weights, ith row contains the embedding for the word mapped to the ith index, the
@@ -17,6 +18,8 @@ class LSTM2CH(nn.Module):
         :param drop_rate: Drop rate for regularization.
         :param bidirectional: If the recurrent should be bidirectional.
         :param embedding_norm: Max norm of the dynamic embeddings.
+        :param packed: If the recurrent layers and the tag head should only run on the real tokens of each sentence,
+        instead of also running on the padding.
         """
         super(LSTM2CH, self).__init__()
 
@@ -26,8 +29,9 @@ class LSTM2CH(nn.Module):
         self.embedding_dim = w2v_weights.shape[1]
         self.w2v_weights = w2v_weights
         self.bidirectional = bidirectional
+        self.packed = packed
 
-        self.embedding_static = nn.Embedding.from_pretrained(torch.FloatTensor(w2v_weights), freeze=True)
+        self.embedding_static = data_manager.pretrained_embedding(w2v_weights)
         self.embedding_dyn = nn.Embedding(w2v_weights.shape[0], w2v_weights.shape[1], max_norm=embedding_norm,
                                           scale_grad_by_freq=True)
 
@@ -62,33 +66,54 @@ class LSTM2CH(nn.Module):
                      torch.zeros(self.recurrent_static.num_layers, batch_size, self.hidden_dim // 2).to(self.device)]
         return state
 
+    def run_recurrent(self, recurrent, data, lengths, hidden):
+        """
+        :param recurrent: One of the two recurrent layers.
+        :param data: Embedded sentences, size = (batch, padded length, embedding dim).
+        :param lengths: Length of each sentence, None to also run on the padding.
+        :param hidden: Initial hidden state.
+        :return: Output and hidden state of the recurrent layer.
+        """
+        if lengths is None:
+            return recurrent(data, hidden)
+        return packing.run_packed(recurrent, data, lengths, hidden, final_state=False)
+
     def forward(self, batch):
         """
         Forward pass given data.
-        :param batch: List of samples containing data as transformed by the init transformer of this class.
+        :param batch: Batch of samples as returned by data_manager.PadCollate.
         :return: A (batch of) vectors of length equal to tagset, scoring each possible class for each word in a sentence,
         for all sentences; a tensor containing the true label for each word and a tensor containing the lengths
         of the sequences in descending order.
         """
-        hidden_static = self.init_hidden(len(batch))
-        hidden_dyn = self.init_hidden(len(batch))
+        data, labels, char_data = data_manager.batch_sequence(batch, self.device)
+        hidden_static = self.init_hidden(data.size(0))
+        hidden_dyn = self.init_hidden(data.size(0))
+        lengths = packing.batch_lengths(batch, labels) if self.packed else None
 
         # embed using static embeddings and pass through the recurrent layer
-        data, labels, char_data = data_manager.batch_sequence(batch, self.device)
         data_static = self.embedding_static(data)
         data_static = self.drop(data_static)
-        lstm_out_static, hidden_static = self.recurrent_static(data_static, hidden_static)
+        lstm_out_static, hidden_static = self.run_recurrent(self.recurrent_static, data_static, lengths, hidden_static)
 
         # embed using dynamic embeddings and pass through the recurrent layer
         data_dynamic = self.embedding_dyn(data)
         data_dynamic = self.drop(data_dynamic)
-        lstm_out_dyn, hidden_dyn = self.recurrent_dyn(data_dynamic, hidden_dyn)
+        lstm_out_dyn, hidden_dyn = self.run_recurrent(self.recurrent_dyn, data_dynamic, lengths, hidden_dyn)
 
         # concatenate results
         output = torch.cat([lstm_out_static, lstm_out_dyn], dim=2)
 
-        # send output to fc layer(s)
-        tag_space = self.hidden2tag(output.unsqueeze(1).contiguous())
-        tag_scores = F.log_softmax(tag_space, dim=3)
+        if not self.packed:
+            # send output to fc layer(s)
+            tag_space = self.hidden2tag(output.unsqueeze(1).contiguous())
+            tag_scores = F.log_softmax(tag_space, dim=3)
+            return tag_scores.view(-1, self.tagset_size), labels.view(-1)
+
+        # send the output of the real tokens to fc layer(s), padding gets 0 scores
+        mask = packing.token_mask(lengths.to(self.device), data.size(1))
+        tag_space = self.hidden2tag(output[mask].view(1, 1, -1, output.size(2)))
+        tag_scores = F.log_softmax(tag_space, dim=3).view(-1, self.tagset_size)
+        tag_scores = packing.scatter_tokens(tag_scores, mask)
 
         return tag_scores.view(-1, self.tagset_size), labels.view(-1)
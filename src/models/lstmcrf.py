@@ -3,10 +3,12 @@ import torch.nn as nn
 from torch.autograd import Variable
 
 import data_manager
+from models import packing, charcnn
 
 
 # recurrent-crf implementation, heavily inspired by the pytorch tutorial and by kaniblu, the CRF class is almost
-# untouched, while the lstm-crf class has substantial changes, among which is the convolution on char embeddings.
+# untouched but for its vectorized forward algorithm and viterbi decoding, while the lstm-crf class has substantial
+# changes, among which is the convolution on char embeddings.
 
 def sequence_mask(lengths, max_len, device):
     batch_size = lengths.size(0)
@@ -19,6 +21,78 @@ def sequence_mask(lengths, max_len, device):
     return mask
 
 
+class LogPartition(torch.autograd.Function):
+    """
+    Log partition function of a linear chain CRF, computed with the forward algorithm; the gradients are the marginals
+    of the labels and of the transitions, computed with the backward algorithm.
+    Autograd would keep the batch x tags x tags scores of every step for the backward pass, this only keeps the alpha
+    vectors, batch x tags for every step, and recomputes the scores of one step at a time in backward.
+    Sentences are sorted by length, so that at each step only the ones that have not ended yet are updated and the
+    loop stops at the longest sentence.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, transitions, lens, start_idx, stop_idx):
+        """
+        :param logits: Label scores of each token, size = (batch, padded length, labels).
+        :param transitions: Transition scores, transitions[i, j] is the score of moving from label j to label i, size =
+        (labels, labels).
+        :param lens: Length of each sentence, size = (batch).
+        :param start_idx: Index of the start label.
+        :param stop_idx: Index of the stop label.
+        :return: Log partition function of each sentence, size = (batch).
+        """
+        batch_size, seq_len, n_labels = logits.size()
+        order, active = packing.sort_by_length(lens, seq_len)
+        logits = logits[order]
+
+        # alphas[t] are the alphas before step t, only the ones of the sentences that have not ended are written
+        alphas = logits.new_empty(seq_len + 1, batch_size, n_labels)
+        alphas[0] = -10000
+        alphas[0, :, start_idx] = 0
+        for step, n in enumerate(active):
+            if n == 0:
+                break
+            alphas[step + 1, :n] = torch.logsumexp(alphas[step, :n].unsqueeze(1) + transitions.unsqueeze(0),
+                                                   dim=2) + logits[:n, step]
+
+        # last step, from the alphas after the last token of each sentence
+        last = alphas[lens[order], torch.arange(batch_size, device=logits.device)]
+        norm = torch.logsumexp(last + transitions[stop_idx].unsqueeze(0), dim=1)
+
+        ctx.save_for_backward(logits, transitions, alphas, last, norm, order)
+        ctx.active = active
+        ctx.stop_idx = stop_idx
+        return norm[torch.argsort(order)]
+
+    @staticmethod
+    def backward(ctx, grad_norm):
+        logits, transitions, alphas, last, norm, order = ctx.saved_tensors
+        batch_size, seq_len, n_labels = logits.size()
+        grad_norm = grad_norm[order]
+        grad_logits = torch.zeros_like(logits)
+        grad_transitions = torch.zeros_like(transitions)
+
+        # betas after the last token of each sentence are the transitions to stop
+        betas = transitions[ctx.stop_idx].unsqueeze(0).repeat(batch_size, 1)
+        grad_transitions[ctx.stop_idx] = (torch.exp(last + betas - norm.unsqueeze(1)) * grad_norm.unsqueeze(1)).sum(0)
+
+        weight = grad_norm.view(-1, 1, 1)
+        for step in range(len(ctx.active) - 1, -1, -1):
+            n = ctx.active[step]
+            if n == 0:
+                continue
+            log_z = norm[:n].view(-1, 1, 1)
+            # marginal of each label at this step
+            grad_logits[:n, step] = torch.exp(alphas[step + 1, :n] + betas[:n] - log_z[:, :, 0]) * weight[:n, :, 0]
+            # scores[b, i, j] of moving from label j to label i at this step and ending the sentence from label i
+            scores = transitions.unsqueeze(0) + (logits[:n, step] + betas[:n]).unsqueeze(2)
+            grad_transitions += (torch.exp(scores + alphas[step, :n].unsqueeze(1) - log_z) * weight[:n]).sum(0)
+            betas[:n] = torch.logsumexp(scores, dim=1)
+
+        return grad_logits[torch.argsort(order)], grad_transitions, None, None, None
+
+
 class CRF(nn.Module):
     def __init__(self, device, vocab_size):
         super(CRF, self).__init__()
@@ -31,101 +105,50 @@ class CRF(nn.Module):
         self.stop_idx = n_labels - 1
         self.transitions = nn.Parameter(torch.randn(n_labels, n_labels), requires_grad=True)
 
-    @staticmethod
-    def log_sum_exp(vec, dim=0):
-        """
-        Numerically stable log sum exp.
-        :param vec: Vector of values.
-        :param dim: Dimension over which the log sum exp is being done.
-        :return: Log sum exp value/s.
-        """
-        max, idx = torch.max(vec, dim)
-        max_exp = max.unsqueeze(-1).expand_as(vec)
-        return max + torch.log(torch.sum(torch.exp(vec - max_exp), dim))
-
     def forward(self, logits, lens):
         """
-        Arguments:
-            logits: [batch_size, seq_len, tagset_size] FloatTensor
-            lens: [batch_size] LongTensor
+        Log partition function of each sentence, with the forward algorithm, see LogPartition.
+        :param logits: Label scores of each token, size = (batch, padded length, tagset size + 2).
+        :param lens: Length of each sentence, size = (batch).
+        :return: Log partition function of each sentence, size = (batch).
         """
-        batch_size, seq_len, n_labels = logits.size()
-        alpha = logits.data.new(batch_size, self.n_labels).fill_(-10000)
-        alpha[:, self.start_idx] = 0
-        c_lens = lens.clone()
-
-        logits_t = logits.transpose(1, 0)
-        for logit in logits_t:
-            # expand tag scores over columns
-            logit_exp = logit.unsqueeze(-1).expand(batch_size,
-                                                   *self.transitions.size())
-            # expand score of tags at previous time step over rows
-            alpha_exp = alpha.unsqueeze(1).expand(batch_size,
-                                                  *self.transitions.size())
-            # expand transitions over batchs
-            trans_exp = self.transitions.unsqueeze(0).expand_as(alpha_exp)
-
-            # obtain scores of tags for this step
-            mat = trans_exp + alpha_exp + logit_exp
-            alpha_nxt = self.log_sum_exp(mat, 2).squeeze(-1)
-
-            # update alpha, get alpha of current step + carry over alphas of sentences that have already been finished
-            mask = (c_lens > 0).float().unsqueeze(-1).expand_as(alpha)
-            alpha = mask * alpha_nxt + (1 - mask) * alpha
-            c_lens = c_lens - 1
-
-        # last step
-        alpha = alpha + self.transitions[self.stop_idx].unsqueeze(0).expand_as(alpha)
-        norm = self.log_sum_exp(alpha, 1).squeeze(-1)
-
-        return norm
+        # the partition function is accumulated in float32 also under bf16 autocast, where the small terms of the
+        # log sum exp would be lost
+        return LogPartition.apply(logits.float(), self.transitions, lens, self.start_idx, self.stop_idx)
 
     def viterbi_decode(self, logits, lens):
         """
-        Arguments:
-            logits: [batch_size, seq_len, tagset_size] FloatTensor
-            lens: [batch_size] LongTensor
+        Best labels of each sentence, with the viterbi algorithm; as in forward, at each step only the sentences that
+        have not ended are updated.
+        :param logits: Label scores of each token, size = (batch, padded length, tagset size + 2).
+        :param lens: Length of each sentence, size = (batch).
+        :return: Score of the best labels of each sentence, size = (batch), and the labels, size = (batch, padded
+        length), where the padding of each sentence repeats its last label.
         """
+        logits = logits.float()
         batch_size, seq_len, n_labels = logits.size()
-        vit = logits.data.new(batch_size, self.n_labels).fill_(-10000)
-        vit[:, self.start_idx] = 0
-        c_lens = lens.clone()
-
-        logits_t = logits.transpose(1, 0)
-        pointers = []
-        for logit in logits_t:
-            vit_exp = vit.unsqueeze(1).expand(batch_size, n_labels, n_labels)
-            trn_exp = self.transitions.unsqueeze(0).expand_as(vit_exp)
-            vit_trn_sum = vit_exp + trn_exp
-            vt_max, vt_argmax = vit_trn_sum.max(2)
-
-            vt_max = vt_max.squeeze(-1)
-            vit_nxt = vt_max + logit
-            pointers.append(vt_argmax.squeeze(-1).unsqueeze(0))
-
-            mask = (c_lens > 0).float().unsqueeze(-1).expand_as(vit_nxt)
-            vit = mask * vit_nxt + (1 - mask) * vit
-
-            mask = (c_lens == 1).float().unsqueeze(-1).expand_as(vit_nxt)
-            vit += mask * self.transitions[self.stop_idx].unsqueeze(0).expand_as(vit_nxt)
-
-            c_lens = c_lens - 1
-
-        pointers = torch.cat(list(reversed(pointers)))
-        scores, idx = vit.max(1, keepdim=True)
-        idx = idx.squeeze(-1)
-        paths = [idx.unsqueeze(1)]
+        order, active = packing.sort_by_length(lens, seq_len)
+        logits = logits[order]
 
-        for argmax in pointers:
-            idx_exp = idx.unsqueeze(-1)
-            idx = torch.gather(argmax, 1, idx_exp)
-            idx = idx.squeeze(-1)
-            paths.insert(0, idx.unsqueeze(1))
-
-        paths = torch.cat(paths[1:], 1)
-        scores = scores.squeeze(-1)
-
-        return scores, paths
+        transitions = self.transitions.unsqueeze(0)
+        vit = logits.new_full((batch_size, n_labels), -10000)
+        vit[:, self.start_idx] = 0
+        # sentences that have ended point to their own label through the padding, so that backtracking skips it
+        pointers = torch.arange(n_labels, device=logits.device).repeat(seq_len, batch_size, 1)
+        for step, n in enumerate(active):
+            if n == 0:
+                break
+            vt_max, pointers[step, :n] = (vit[:n].unsqueeze(1) + transitions).max(2)
+            vit[:n] = vt_max + logits[:n, step]
+
+        scores, idx = (vit + self.transitions[self.stop_idx].unsqueeze(0)).max(1)
+        paths = pointers.new_empty(batch_size, seq_len)
+        for step in range(seq_len - 1, -1, -1):
+            paths[:, step] = idx
+            idx = pointers[step].gather(1, idx.unsqueeze(1)).squeeze(1)
+
+        unsort = torch.argsort(order)
+        return scores[unsort], paths[unsort]
 
     def transition_score(self, labels, lengths):
         """
@@ -170,7 +193,8 @@ class CRF(nn.Module):
 
 class LstmCrf(nn.Module):
     def __init__(self, device, w2v_weights, tag_to_itx, hidden_dim, drop_rate, bidirectional=False, freeze=True,
-                 embedding_norm=6, c2v_weights=None, pad_word_length=16):
+                 embedding_norm=6, c2v_weights=None, pad_word_length=16, packed=True,
+                 char_conv1d=False, char_cache=0):
 
         super(LstmCrf, self).__init__()
 
@@ -182,13 +206,13 @@ class LstmCrf(nn.Module):
         self.c2v_weights = c2v_weights
         self.pad_word_length = pad_word_length
         self.bidirectional = bidirectional
+        self.packed = packed
 
         self.drop_rate = drop_rate
         self.drop = nn.Dropout(self.drop_rate)
 
         # embedding layer
-        self.embeddings = nn.Embedding.from_pretrained(torch.FloatTensor(w2v_weights), freeze=freeze)
-        self.embeddings.max_norm = embedding_norm
+        self.embeddings = data_manager.pretrained_embedding(w2v_weights, freeze, embedding_norm)
 
         # recurrent and mapping to tagset
         self.recurrent = nn.LSTM(input_size=self.embedding_dim,
@@ -203,54 +227,12 @@ class LstmCrf(nn.Module):
 
         # setup convolution on characters if c2v_weights are passed
         if self.c2v_weights is not None:
-            self.char_embedding_dim = c2v_weights.shape[1]
-            self.char_embedding = nn.Embedding.from_pretrained(torch.FloatTensor(c2v_weights), freeze=True)
-            self.char_embedding.max_norm = embedding_norm
-            self.feats = 20  # for the output channels of the conv layers
-
-            self.recurrent = nn.LSTM(self.embedding_dim + 50,
+            self.char_cnn = charcnn.CharCNN(c2v_weights, self.drop_rate, self.pad_word_length, True, embedding_norm,
+                                            char_conv1d, char_cache)
+            self.recurrent = nn.LSTM(self.embedding_dim + self.char_cnn.output_dim,
                                      self.hidden_dim // (1 if not self.bidirectional else 2),
                                      batch_first=True, bidirectional=self.bidirectional)
 
-            # conv layers for single character, pairs of characters, 3x characters
-            self.ngram1 = nn.Sequential(
-                nn.Conv2d(1, self.feats * 1, kernel_size=(1, self.char_embedding_dim),
-                          stride=(1, self.char_embedding_dim),
-                          padding=0),
-                nn.Dropout2d(p=self.drop_rate),
-                nn.MaxPool2d(kernel_size=(self.pad_word_length, 1)),
-                nn.Tanh(),
-            )
-
-            self.ngram2 = nn.Sequential(
-                nn.Conv2d(1, self.feats * 2, kernel_size=(2, self.char_embedding_dim),
-                          stride=(1, self.char_embedding_dim),
-                          padding=0),
-                nn.Dropout2d(p=self.drop_rate),
-                nn.MaxPool2d(kernel_size=(self.pad_word_length - 1, 1)),
-                nn.Tanh(),
-            )
-
-            self.ngram3 = nn.Sequential(
-                nn.Conv2d(1, self.feats * 3, kernel_size=(3, self.char_embedding_dim),
-                          stride=(1, self.char_embedding_dim),
-                          padding=0),
-                nn.Dropout2d(p=self.drop_rate),
-                nn.MaxPool2d(kernel_size=(self.pad_word_length - 2, 1)),
-                nn.Tanh(),
-            )
-
-            # seq layers to elaborate on the output of conv layers
-            self.fc1 = nn.Sequential(
-                nn.Linear(self.feats, 10),
-            )
-            self.fc2 = nn.Sequential(
-                nn.Linear(self.feats * 2, 20),
-            )
-            self.fc3 = nn.Sequential(
-                nn.Linear(self.feats * 3, 20),
-            )
-
     def features_score(self, feats, labels, lengths):
         """
         Given the label scores (feats) of each token and the correct labels,
@@ -306,6 +288,7 @@ class LstmCrf(nn.Module):
         """
         For each word get its scores for each possible label.
         :param data: Input sentences.
+        :param char_data: Chars of each word, None if the model does not use them.
         :param lengths: Lengths of each sentence, needed for packing.
         :return: Labels scores of each token, size = (batch, sentence length, tagset size)
         """
@@ -318,36 +301,33 @@ class LstmCrf(nn.Module):
         embedded = self.drop(embedded)
 
         if self.c2v_weights is not None:
-            batched_conv = []
-            char_data = self.char_embedding(char_data)
-            char_data = self.drop(char_data)
-            num_words = char_data.size()[2]
-            for i in range(num_words):
-                # get word for each batch, then convolute on the ith word of each batch and concatenate
-                c = char_data[:, 0, i, :, :].unsqueeze(1)
-                ngram1 = self.ngram1(c).view(char_data.size()[0], 1, 1, -1)
-                ngram2 = self.ngram2(c).view(char_data.size()[0], 1, 1, -1)
-                ngram3 = self.ngram3(c).view(char_data.size()[0], 1, 1, -1)
-                ngram1 = self.fc1(ngram1)
-                ngram2 = self.fc2(ngram2)
-                ngram3 = self.fc3(ngram3)
-                batched_conv.append(torch.cat([ngram1, ngram2, ngram3], dim=3))
-            batched_conv = torch.cat(batched_conv, dim=1).squeeze(2)
-            embedded = torch.cat([embedded, batched_conv], dim=2)
-
-        # pack, pass through recurrent, unpack
-        packed = nn.utils.rnn.pack_padded_sequence(embedded, sorted(lengths.data.tolist(), reverse=True),
-                                                   batch_first=True)
-        hidden = self.init_hidden(batch_size)
-        output, _ = self.recurrent(packed, hidden)
-        o, lengths = nn.utils.rnn.pad_packed_sequence(output, batch_first=True)
+            # char features of the real words, padding words get 0 features
+            mask = packing.token_mask(lengths, seq_len)
+            embedded = torch.cat([embedded, self.char_cnn(char_data, mask)], dim=2)
 
-        # pass through fc layer and activation
-        o = o.contiguous()
-        o = self.bnorm(o.unsqueeze(1)).squeeze(1)
+        hidden = self.init_hidden(batch_size)
+        if not self.packed:
+            o, _ = self.recurrent(embedded, hidden)
+
+            # pass through fc layer and activation
+            o = o.contiguous()
+            o = self.bnorm(o.unsqueeze(1)).squeeze(1)
+            o = self.fc(o)
+            o = self.bnorm2(o.unsqueeze(1)).squeeze(1)
+            return o.float()
+
+        # pack, pass through recurrent, unpack in the order of the batch
+        o, _ = packing.run_packed(self.recurrent, embedded, lengths, hidden, final_state=False)
+
+        # pass the real tokens through fc layer and activation, padding gets 0 scores, masked out by the crf
+        mask = packing.token_mask(lengths, seq_len)
+        o = o[mask]
+        o = self.bnorm(o.view(1, 1, *o.size())).view(o.size())
         o = self.fc(o)
-        o = self.bnorm2(o.unsqueeze(1)).squeeze(1)
-        return o
+        o = self.bnorm2(o.view(1, 1, *o.size())).view(o.size())
+        o = packing.scatter_tokens(o, mask)
+        # scores are summed over the sentence by the crf, do it in float32 also under bf16 autocast
+        return o.float()
 
     def score(self, feats, labels, lengths):
         """
@@ -379,25 +359,18 @@ class LstmCrf(nn.Module):
         predictions = predictions.expand(*labels.size())
 
         # remove start and stop tags if there are any (mostly for safety, should not happen)
-        predictions[predictions == 43] = 0
-        predictions[predictions == 44] = 0
+        predictions[predictions >= self.tagset_size] = 0
 
         return predictions.view(-1), labels.view(-1)
 
     def get_lengths(self, labels, padding=-1):
         """
         Get length of each sentences.
-        :param labels: Labels of each word for each sentence.
+        :param labels: Labels of each word for each sentence, padding follows the labels of the sentence.
         :param padding: Padding value to use, default -1.
         :return: Length of each sentence, size = (batch).
-        TODO: remove for cycle, make it with matrix operations
         """
-        batchs, _ = labels.size()
-        lengths = torch.zeros(batchs).long().to(self.device)
-        for i in range(batchs):
-            while len(labels[i]) > lengths[i] and labels[i][lengths[i]] != padding:
-                lengths[i] += 1
-        return lengths
+        return (labels != padding).sum(dim=1).to(self.device)
 
     def neg_log_likelihood(self, batch):
         """
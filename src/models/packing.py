@@ -0,0 +1,94 @@
+import torch
+import torch.nn as nn
+
+"""
+Helpers to keep the padding of a batch from changing the predictions of the models: sentences are packed (in any
+order, as with enforce_sorted=False, the packed sequence sorts them and its outputs are put back in the order of the
+batch), so that the backward direction of bidirectional layers starts from the last real token instead of from the
+padding and final hidden states are the ones after the last real token; unidirectional layers whose final state is not
+needed still run over the padding, which comes after the real tokens and so cannot change their outputs; the tag heads
+are run on the real tokens only, so they spend nothing on the padding, which does not enter batch norm statistics
+either.
+"""
+
+
+def batch_lengths(batch, labels):
+    """
+    :param batch: Either a batch as returned by PadCollate or a list of sample points, see data_manager.batch_sequence.
+    :param labels: Labels of the batch, padded with -1, size = (batch, padded length).
+    :return: Length of each sentence, size = (batch).
+    """
+    if isinstance(batch, dict):
+        return batch["lengths"]
+    return (labels != -1).sum(dim=1)
+
+
+def token_mask(lengths, max_length):
+    """
+    :param lengths: Length of each sentence, size = (batch).
+    :param max_length: Padded length of the batch.
+    :return: Bool tensor, True on the real tokens of each sentence, size = (batch, max_length).
+    """
+    return torch.arange(max_length, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
+
+
+def run_packed(recurrent, data, lengths, hidden=None, final_state=True):
+    """
+    Run a recurrent layer so that the padding does not change the outputs of the real tokens nor the final state.
+    The outputs of the real tokens of a unidirectional layer do not depend on the padding that follows them, so when
+    its final hidden state is not needed the padded batch is run as it is, padding included, since the fused kernels
+    of padded batches are faster than the ones of packed sequences (about twice as fast for an LSTM on the cpu).
+    :param recurrent: Recurrent layer with batch_first=True.
+    :param data: Padded input, size = (batch, padded length, input size).
+    :param lengths: Length of each sentence, size = (batch).
+    :param hidden: Initial hidden state, in the order of the batch, None for zeros.
+    :param final_state: If the hidden state after the last real token of each sentence is needed.
+    :return: Output, size = (batch, padded length, output size), whose values on the padding are not meaningful, and
+    the hidden state after the last real token of each sentence (None if final_state is False), both in the order of
+    the batch.
+    """
+    if not recurrent.bidirectional and not final_state:
+        return recurrent(data, hidden)[0], None
+    packed = nn.utils.rnn.pack_padded_sequence(data, lengths.cpu(), batch_first=True, enforce_sorted=False)
+    output, hidden = recurrent(packed, hidden)
+    output, _ = nn.utils.rnn.pad_packed_sequence(output, batch_first=True, total_length=data.size(1))
+    return output, hidden
+
+
+def scatter_tokens(values, mask, fill=0.):
+    """
+    Put values computed on the real tokens of a batch back in their padded positions.
+    :param values: Values of the real tokens, in the order of mask, size = (tokens, features).
+    :param mask: Mask of the real tokens, see token_mask, size = (batch, padded length).
+    :param fill: Value of the padding positions.
+    :return: Tensor of size (batch, padded length, features).
+    """
+    res = values.new_full((mask.size(0), mask.size(1), values.size(1)), fill)
+    res[mask] = values
+    return res
+
+
+def sort_by_length(lengths, max_length):
+    """
+    Order in which the sentences of a batch are decoded one step at a time, so that at each step the sentences that
+    have not ended yet are the first ones and the others can be dropped from the batch.
+    :param lengths: Length of each sentence, size = (batch).
+    :param max_length: Padded length of the batch.
+    :return: Indexes sorting the sentences by decreasing length and list with the number of sentences that have not
+    ended at each step.
+    """
+    order = torch.argsort(lengths, descending=True)
+    return order, token_mask(lengths[order], max_length).sum(dim=0).tolist()
+
+
+def scatter_steps(values, lengths, order, max_length):
+    """
+    Put outputs decoded one step at a time on the sentences sorted by sort_by_length back in the order of the batch.
+    :param values: Outputs of the steps, concatenated, size = (tokens, features).
+    :param lengths: Length of each sentence, size = (batch).
+    :param order: Indexes returned by sort_by_length.
+    :param max_length: Padded length of the batch.
+    :return: Tensor of size (batch, padded length, features), zero on padding.
+    """
+    mask = token_mask(lengths[order], max_length).t()
+    return scatter_tokens(values, mask).transpose(0, 1)[torch.argsort(order)]
@@ -11,7 +11,7 @@ can be later used with pycrsfuite.
 """
 
 sys.path.append("..")  # to make data_manager visible from here
-from data_manager import w2v_matrix_vocab_generator
+from data_manager import w2v_matrix_vocab_generator, VocabResolver
 
 
 def get_data(file):
@@ -42,13 +42,8 @@ def get_w2v_embedding(word):
     :param word:
     :return:
     """
-    if word in w2v_vocab:
-        weights = w2v_weights[w2v_vocab[word]]
-    elif word.title() in w2v_vocab:
-        weights = w2v_weights[w2v_vocab[word.title()]]
-    else:
-        weights = numpy.zeros(300)
-    return weights
+    idx = w2v_resolver(word)
+    return numpy.zeros(300) if idx is None else w2v_weights[idx]
 
 
 def get_c2v_embedding(c):
@@ -58,13 +53,8 @@ def get_c2v_embedding(c):
     :param word:
     :return:
     """
-    if c in w2v_vocab:
-        weights = w2v_weights[w2v_vocab[c]]
-    elif c.title() in w2v_vocab:
-        weights = w2v_weights[w2v_vocab[c.title()]]
-    else:
-        weights = numpy.zeros(20)
-    return weights
+    idx = c2v_resolver(c)
+    return numpy.zeros(20) if idx is None else c2v_weights[idx]
 
 
 def w2vfeatures(sent, i):
@@ -272,6 +262,9 @@ if __name__ == "__main__":
     if use_embeddings:
         w2v_vocab, w2v_weights = w2v_matrix_vocab_generator(sys.argv[3])
         c2v_vocab, c2v_weights = w2v_matrix_vocab_generator(sys.argv[4])
+        # words and chars are resolved once, unknown ones get a vector of 0s
+        w2v_resolver = VocabResolver(w2v_vocab)
+        c2v_resolver = VocabResolver(c2v_vocab)
 
     train = get_data(train)
     test = get_data(test)
@@ -283,6 +276,9 @@ if __name__ == "__main__":
     y_train = [sent2labels(s) for s in train]
 
     X_test = ([pycrfsuite.ItemSequence(sent2features(s, use_embeddings)) for s in test])
+    if use_embeddings:
+        print("w2v resolver stats, one lookup per token and feature: %s" % w2v_resolver)
+        print("c2v resolver stats, one lookup per char and feature: %s" % c2v_resolver)
     y_test = [sent2labels(s) for s in test]
 
     for xseq, yseq in zip(X_train, y_train):
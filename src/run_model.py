@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import os
+import glob
 import random
 import itertools
 
@@ -10,12 +11,21 @@ import getopt
 import sys
 import torch
 from torch.optim.lr_scheduler import ReduceLROnPlateau
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, IterableDataset, DistributedSampler
 
 import data_manager
-from data_manager import PytorchDataset, w2v_matrix_vocab_generator
+import conlleval
+import checkpoint
+import distributed
+from data_manager import PytorchDataset, StreamingDataset, w2v_matrix_vocab_generator
 from models import lstm, gru, rnn, lstm2ch, encoder, attention, conv, fcinit, lstmcrf
 
+# needed for some models, given their architecture, i.e. CONV
+PADDED_SENTENCE_LENGTH = 50
+# needed by models when using c2v embeddings
+PADDED_WORD_LENGTH = 30
+
 
 def worker_init(*args):
     """
@@ -27,31 +37,204 @@ def worker_init(*args):
     np.random.seed(1337)
 
 
-def predict(model, data_to_predict):
+def autocast(model, precision):
+    """
+    Context in which the forward pass of a model runs, with precision "bf16" the operations that are safe in lower
+    precision (i.e. matrix products, convolutions, recurrent layers) run in bfloat16 while the others (i.e. softmax,
+    losses) stay in float32; the trainable weights are always kept in float32, so they are the master copy updated by
+    the optimizer.
+    :param model: The nn module, its device is the one on which autocast is enabled.
+    :param precision: Either "fp32" or "bf16".
+    :return: Context manager.
+    """
+    return torch.autocast(model.device.type, dtype=torch.bfloat16, enabled=precision == "bf16")
+
+
+def _upcast_output(module, inputs, output):
+    return output.float()
+
+
+def prepare_bf16(model):
+    """
+    Prepare a model to run under bf16 autocast. The frozen embedding tables (i.e. w2v and c2v embeddings when not
+    trained) are stored in bfloat16, halving their memory, their output is cast back to float32 since it is also
+    concatenated with float32 tensors; trainable tables are left in float32.
+    The convolutions of the models that have them (conv and the convolutions on characters) are set to run in float32,
+    see charcnn.run_float32; the Conv1d kernels of --char_conv1d are also slower in bfloat16.
+    :param model: The nn module.
+    :return: Number of embedding tables stored in bfloat16.
+    """
+    converted = 0
+    for module in model.modules():
+        if isinstance(module, torch.nn.Embedding) and not module.weight.requires_grad:
+            module.weight.data = module.weight.data.to(torch.bfloat16)
+            module.register_forward_hook(_upcast_output)
+            converted += 1
+        elif hasattr(module, "float32_convs"):
+            module.float32_convs = True
+    return converted
+
+
+def get_dataloader(data, model, batch_size, shuffle, bucket=False, workers=1, prefetch=2, persistent_workers=False,
+                   same_length=False, shard=False):
+    """
+    Get a DataLoader over the data, batches are padded up to their longest sentence.
+    :param data: PytorchDataset containing data, or StreamingDataset streaming it.
+    :param model: The model that is going to be fed the batches.
+    :param batch_size: Size of the batches.
+    :param shuffle: If the data should be shuffled, ignored for a StreamingDataset, which shuffles its own samples.
+    :param bucket: If sentences of similar length should be grouped in the same batches, ignored for a
+    StreamingDataset.
+    :param workers: Number of worker processes preparing batches, 0 to prepare them in the main process.
+    :param prefetch: Number of batches prepared in advance by each worker.
+    :param persistent_workers: If workers should be kept alive between iterations over the data.
+    :param same_length: If batches should only contain sentences of the same length, so that they are not padded,
+    needs bucket to be True.
+    :param shard: If the data should be split among the processes of a distributed run, each one getting its share,
+    not supported for a StreamingDataset; call set_epoch on the sampler of the loader before each epoch.
+    :return: DataLoader.
+    """
+    # the attention model can not attend to more than its max length
+    max_length = model.max_length if isinstance(model, attention.Attention) else None
+    collate = data_manager.PadCollate(data.init_transform, max_length, data.batch_transform, data.char_table)
+    # pinned memory only speeds up copies to the gpu
+    options = {"num_workers": workers, "collate_fn": collate, "pin_memory": model.device.type == "cuda"}
+    if workers > 0:
+        options.update(prefetch_factor=prefetch, persistent_workers=persistent_workers, worker_init_fn=worker_init)
+    if isinstance(data, IterableDataset):
+        return DataLoader(data, batch_size, **options)
+    replicas, rank = (distributed.world_size(), distributed.rank()) if shard else (1, 0)
+    if bucket:
+        sampler = data_manager.BucketBatchSampler(data.lengths, batch_size, shuffle, same_length=same_length,
+                                                  num_replicas=replicas, rank=rank, seed=1337)
+        return DataLoader(data, batch_sampler=sampler, **options)
+    if replicas > 1:
+        sampler = DistributedSampler(data, replicas, rank, shuffle=shuffle, seed=1337)
+        return DataLoader(data, batch_size, sampler=sampler, drop_last=False, **options)
+    return DataLoader(data, batch_size, shuffle=shuffle, drop_last=False, **options)
+
+
+class TrainingStep(torch.nn.Module):
+    """
+    Computes the training loss of a model in its forward; DistributedDataParallel only synchronizes gradients of
+    outputs of the module it wraps, so this is the module that is wrapped, also for models whose loss is not computed
+    by their forward (i.e. LstmCrf.neg_log_likelihood).
     """
-    Use the model to predict on data.
+
+    def __init__(self, model):
+        super(TrainingStep, self).__init__()
+        self.model = model
+
+    def forward(self, batch):
+        """
+        :param batch: Batch of samples as returned by data_manager.PadCollate.
+        :return: Loss, predicted scores of each class for each token and labels, the last two are None for LstmCrf.
+        """
+        if isinstance(self.model, lstmcrf.LstmCrf):
+            return self.model.neg_log_likelihood(batch), None, None
+        predicted, labels = self.model(batch)
+        return torch.nn.functional.nll_loss(predicted.float(), labels, ignore_index=-1), predicted, labels
+
+
+class PredictionAccumulator(object):
+    """
+    Accumulates the predictions and labels of batches as tensors, on the device where they were computed, without
+    padding; they are moved to the cpu and scored only once, when all the batches have been seen.
+    """
+
+    def __init__(self):
+        self.predictions = []
+        self.labels = []
+        self.lengths = []
+
+    def add(self, predictions, labels, lengths):
+        """
+        :param predictions: Predicted class indexes, size = (batch * padded length).
+        :param labels: True class indexes, padded with -1, size = (batch * padded length).
+        :param lengths: Length of each sentence, size = (batch).
+        """
+        mask = labels != -1
+        self.predictions.append(predictions[mask])
+        self.labels.append(labels[mask])
+        self.lengths.append(lengths)
+
+    def gather(self):
+        """
+        Move the predictions accumulated by all the processes of a distributed run to the accumulator of rank 0, all
+        processes must call this.
+        """
+        parts = distributed.gather([torch.cat(values).cpu() for values in [self.predictions, self.labels,
+                                                                            self.lengths]])
+        if parts is not None:
+            self.predictions, self.labels, self.lengths = [list(values) for values in zip(*parts)]
+
+    def print_scores(self, class_dict):
+        """
+        Print the number of phrases and the accuracy, precision, recall and f1 score of the predictions, as the first
+        two lines of the report of conlleval.pl.
+        :param class_dict: Dict mapping concepts to indices.
+        :return: Precision, recall and f1 score.
+        """
+        tags = sorted(class_dict, key=class_dict.get)
+        predictions = torch.cat(self.predictions).cpu().numpy()
+        labels = torch.cat(self.labels).cpu().numpy()
+        lengths = torch.cat(self.lengths).cpu().numpy()
+        counts = conlleval.count_chunks(labels, predictions, lengths, tags)
+        print("\n".join(counts.report()[:2]))
+        return counts.overall()
+
+
+def predict(model, data_to_predict, batch_size=256, loader_options=None, precision="fp32"):
+    """
+    Use the model to predict on data, without tracking gradients.
     :param model: The nn module (or equivalent, implementing zero_grad() and being callable).
     :param data_to_predict: PytorchDataset containing data.
-    :return:
+    :param batch_size: Number of sentences predicted at once.
+    :param loader_options: Dict of extra arguments of get_dataloader (workers, prefetch, persistent_workers).
+    :param precision: Precision of the forward pass, see autocast.
+    :return: List with an array of predicted class indexes for each sentence, in the order of the data.
     """
-    y_predicted = []
+    predictions = []
+    lengths = []
 
-    dataloader = DataLoader(data_to_predict, 1, shuffle=False, num_workers=1, drop_last=False, pin_memory=True,
-                            collate_fn=lambda x: x, worker_init_fn=worker_init)
-    for batch in dataloader:
-        current = []
+    # sentences sorted by length, batches are not padded so that predictions do not depend on the batch size
+    dataloader = get_dataloader(data_to_predict, model, batch_size, False, bucket=True, same_length=True,
+                                **(loader_options or {}))
+    with torch.inference_mode():
+        for batch in dataloader:
+            with autocast(model, precision):
+                predicted, labels = model(batch)
 
-        # predict and check error
-        predicted, _ = model(batch)
+            # needed because other models return a score for each possible tag class
+            if not isinstance(model, lstmcrf.LstmCrf):
+                predicted = torch.argmax(predicted, dim=1)
+
+            predictions.append(predicted[labels != -1])
+            lengths.append(batch["lengths"])
+    predictions = torch.cat(predictions).cpu().numpy()
+    lengths = torch.cat(lengths).numpy()
+
+    # put sentences back in their order, the sampler does not shuffle so it returns the batches of the loop again
+    order = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.asarray(batch) for batch in dataloader.batch_sampler])
+    assert len(order) == len(lengths), "the sampler returned other batches than the ones predicted"
+    sentences = np.split(predictions, np.cumsum(lengths)[:-1])
+    y_predicted = [None] * len(sentences)
+    for idx, sentence in zip(order.tolist(), sentences):
+        y_predicted[idx] = sentence
+    return y_predicted
 
-        # needed because other models return a score for each possible tag class
-        if not isinstance(model, lstmcrf.LstmCrf):
-            predicted = torch.argmax(predicted, dim=1)
 
-        for i in predicted:
-            current.append(i.item())
-        y_predicted.append(current)
-    return y_predicted
+def fill_predictions(predictions, lengths, class_dict):
+    """
+    Complete the predictions of sentences longer than the max length of the attention model, which are cut when
+    predicting, with the "O" class, so that their remaining tokens are scored as not being part of any concept.
+    :param predictions: List with an array of predicted class indexes for each sentence, as returned by predict.
+    :param lengths: Length of each sentence.
+    :param class_dict: Dict mapping concepts to indices.
+    :return: List with an array of predicted class indexes for each sentence, one for each of its tokens.
+    """
+    return [np.pad(sentence, (0, length - len(sentence)), constant_values=class_dict["O"])
+            for sentence, length in zip(predictions, lengths)]
 
 
 def write_predictions(tokens, labels, predictions, path, is_indexes, class_dict):
@@ -72,7 +255,7 @@ def write_predictions(tokens, labels, predictions, path, is_indexes, class_dict)
             file.write("\n")
 
 
-def evaluate_model(dev_data, model, class_dict, batch_size):
+def evaluate_model(dev_data, model, class_dict, batch_size, loader_options=None, precision="fp32"):
     """
     Test a model on data and print the error, precision, recall and f1 score.
 
@@ -80,54 +263,50 @@ def evaluate_model(dev_data, model, class_dict, batch_size):
     :param model: The nn module (or equivalent, implementing zero_grad() and being callable).
     :param class_dict: Dict mapping indices to concepts.
     :param batch_size: Size of the training batch.
+    :param loader_options: Dict of extra arguments of get_dataloader (workers, prefetch, persistent_workers).
+    :param precision: Precision of the forward pass, see autocast.
+    :return: F1 score.
     """
-    error = []
-    y_predicted = []
-    y_true = []
-
-    dataloader = DataLoader(dev_data, batch_size, shuffle=False, num_workers=1, drop_last=False, pin_memory=True,
-                            collate_fn=lambda x: x, worker_init_fn=worker_init)
-
-    for batch in dataloader:
-
-        # predict and check error
-        predicted, labels = model(batch)
-
-        # needed because other models return a score for each possible tag class
-        if not isinstance(model, lstmcrf.LstmCrf):
-            loss = torch.nn.functional.nll_loss(predicted, labels, ignore_index=-1)
-            # update current epoch dev_data
-            error.append(loss.item())
-            predicted = torch.argmax(predicted, dim=1)
-
-        # add labels and predictions to list
-        tmp_pred = []
-        tmp_true = []
-        for index, label in zip(predicted, labels):
-            ival = index.item()
-            labelval = label.item()
-            if labelval != -1:
-                tmp_pred.append(ival)
-                tmp_true.append(labelval)
-            else:
-                y_predicted.append(tmp_pred)
-                y_true.append(tmp_true)
-                tmp_pred, tmp_true = [], []
+    # sum of the losses of the batches, kept on the device to not wait for each batch
+    error = 0
+    batches = 0
+    accumulator = PredictionAccumulator()
+
+    # sentences sorted by length, to minimize padding
+    dataloader = get_dataloader(dev_data, model, batch_size, False, bucket=True, **(loader_options or {}))
+
+    with torch.inference_mode():
+        for batch in dataloader:
+
+            # predict and check error
+            with autocast(model, precision):
+                predicted, labels = model(batch)
+
+            # needed because other models return a score for each possible tag class
+            if not isinstance(model, lstmcrf.LstmCrf):
+                loss = torch.nn.functional.nll_loss(predicted.float(), labels, ignore_index=-1)
+                # update current epoch dev_data
+                error = error + loss.double()
+                predicted = torch.argmax(predicted, dim=1)
+
+            accumulator.add(predicted, labels, batch["lengths"])
+            batches += 1
 
     if not isinstance(model, lstmcrf.LstmCrf):
-        print("Dev   error: %f" % np.mean(error))
+        print("Dev   error: %f" % (float(error) / batches))
 
-    # evaluate by calling the evaluation script then clean up
     print("Dev stats:")
-    write_predictions(y_true, y_true, y_predicted, "../output/dev_pred.txt", True, class_dict)
-    os.system("../output/conlleval.pl < ../output/dev_pred.txt | head -n2")
-    os.system("rm ../output/dev_pred.txt")
+    return accumulator.print_scores(class_dict)[2]
 
 
-def train_model(train_data, model, class_dict, dev_data, batch_size, lr, epochs, decay=0.0):
+def train_model(train_data, model, class_dict, dev_data, batch_size, lr, epochs, decay=0.0, bucket=False,
+                loader_options=None, train_stats=True, checkpoint_path=None, checkpoint_every=1, resume=False,
+                patience=None, precision="fp32"):
     """
     Trains a model and prints error, precision, recall and f1 while doing so, if dev data is passed
     the model is going to be evaluated on it every epoch.
+    In a distributed run (see distributed.launch) each process trains on its share of the batches and gradients are
+    averaged among them; rank 0 evaluates on the dev data, writes checkpoints and prints the stats of all processes.
     :param train_data: Data on which to train.
     :param model: The nn module (or equivalent, implementing zero_grad() and being callable).
     :param class_dict: Dict mapping indices to concepts.
@@ -137,22 +316,62 @@ def train_model(train_data, model, class_dict, dev_data, batch_size, lr, epochs,
     :param lr: Learning rate.
     :param epochs: Epochs on the data set.
     :param decay: L2 norm decay to be used, default is 0.
+    :param bucket: If sentences of similar length should be grouped in the same batches, default is False.
+    :param loader_options: Dict of extra arguments of get_dataloader (workers, prefetch, persistent_workers).
+    :param train_stats: If precision, recall and f1 should be computed on the train data every epoch, default is True.
+    :param checkpoint_path: Path where to write checkpoints of the training state, None to not write them.
+    :param checkpoint_every: Number of epochs between checkpoints, a checkpoint is also written after the last epoch.
+    :param resume: If training should resume from the checkpoint at checkpoint_path, if there is one.
+    :param patience: Number of epochs without improvements of the dev f1 after which training is stopped, the model
+    is then restored to the epoch with the best dev f1; None to always train for all the epochs.
+    :param precision: Precision of the forward pass, see autocast; the backward pass follows the forward precision.
+    :return: Best dev f1 score, None if there is no dev data.
     """
     optimizer = torch.optim.Adam(filter(lambda p: p.requires_grad, model.parameters()), lr=lr, amsgrad=True,
                                  weight_decay=decay)
     # to adjust the lr
     scheduler = ReduceLROnPlateau(optimizer, 'min', patience=2)
 
-    starting_time = time.time()
+    rank = distributed.rank()
+
+    # state needed to resume training
+    state = {"epoch": -1, "best_f1": None, "best_epoch": -1, "best_model": None, "stopped": False}
+    if resume and checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        saved = checkpoint.load(checkpoint_path, model.device)
+        model.load_state_dict(saved["model"])
+        optimizer.load_state_dict(saved["optimizer"])
+        scheduler.load_state_dict(saved["scheduler"])
+        # distributed runs save the state of the random number generators of each process
+        if isinstance(saved["rng"], list):
+            assert len(saved["rng"]) == distributed.world_size(), "the checkpoint was written by %i processes" % \
+                                                                   len(saved["rng"])
+            checkpoint.set_rng_state(saved["rng"][rank])
+        else:
+            checkpoint.set_rng_state(saved["rng"])
+        state = {key: saved[key] for key in state}
+        print("resuming from the checkpoint of epoch %i" % state["epoch"])
+    writer = checkpoint.CheckpointWriter(checkpoint_path) if checkpoint_path is not None and rank == 0 else None
 
-    dataloader = DataLoader(train_data, batch_size, shuffle=True, num_workers=1, drop_last=False, pin_memory=True,
-                            collate_fn=lambda x: x, worker_init_fn=worker_init)
+    starting_time = time.time()
 
-    for epoch in range(epochs):
-        # setup current epoch train_data
-        error = []
-        y_predicted = []
-        y_true = []
+    step = TrainingStep(model)
+    if distributed.is_distributed():
+        # frozen tables are the same in every process, broadcasting them would write their shared pages
+        frozen = [name + ".weight" for name, module in step.named_modules()
+                  if isinstance(module, data_manager.FrozenEmbedding)]
+        DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(step, frozen)
+        step = DistributedDataParallel(step)
+    dataloader = get_dataloader(train_data, model, batch_size, True, bucket, shard=distributed.is_distributed(),
+                                **(loader_options or {}))
+
+    for epoch in range(state["epoch"] + 1, epochs if not state["stopped"] else 0):
+        for sampler in [dataloader.sampler, dataloader.batch_sampler]:
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(epoch)
+        # setup current epoch train_data, the error is the sum of the losses of the batches, kept on the device
+        error = 0
+        batches = 0
+        accumulator = PredictionAccumulator()
 
         start = time.time()
 
@@ -160,56 +379,72 @@ def train_model(train_data, model, class_dict, dev_data, batch_size, lr, epochs,
         model.zero_grad()
         for batch in dataloader:
 
-            # predict and check error
-            if isinstance(model, lstmcrf.LstmCrf):
-                loss = model.neg_log_likelihood(batch)
-            else:
-                predicted, labels = model(batch)
-                loss = torch.nn.functional.nll_loss(predicted, labels, ignore_index=-1)
-                indices = torch.argmax(predicted, dim=1)
-
-                # add labels and predictions to list
-                tmp_pred = []
-                tmp_true = []
-                for index, label in zip(indices, labels):
-                    ival = index.item()
-                    labelval = label.item()
-                    if labelval != -1:
-                        tmp_pred.append(ival)
-                        tmp_true.append(labelval)
-                    else:
-                        y_predicted.append(tmp_pred)
-                        y_true.append(tmp_true)
-                        tmp_pred, tmp_true = [], []
+            # predict and check error, gradients are computed outside of autocast
+            with autocast(model, precision):
+                loss, predicted, labels = step(batch)
+            if train_stats and predicted is not None:
+                accumulator.add(torch.argmax(predicted.detach(), dim=1), labels, batch["lengths"])
 
             loss.backward()
             optimizer.step()
             model.zero_grad()
             # update current epoch train_data
-            error.append(loss.item())
+            error = error + loss.detach().double()
+            batches += 1
 
-        scheduler.step(np.mean(error))
+        error, batches = distributed.sum_over_processes([float(error), batches])
+        error = error / batches
+        scheduler.step(error)
 
         print("----- Training epoch stats for epoch %i -----" % epoch)
         print("Seconds for epoch: % f" % (time.time() - start))
 
-        print("Train error: %f" % np.mean(error))
-        if not isinstance(model, lstmcrf.LstmCrf):
-            print("Train stats:")
-            # evaluate by calling the evaluation script then clean up
-            write_predictions(y_true, y_true, y_predicted, "../output/train_pred.txt", True,
-                              class_dict)
-            os.system("../output/conlleval.pl < ../output/train_pred.txt | head -n2")
-            os.system("rm ../output/train_pred.txt")
+        print("Train error: %f" % error)
+        if train_stats and not isinstance(model, lstmcrf.LstmCrf):
+            if distributed.is_distributed():
+                accumulator.gather()
+            if rank == 0:
+                print("Train stats:")
+                accumulator.print_scores(class_dict)
 
         # if we passed dev train_data to it evaluate on it and report, else keep training
+        stop = False
         if dev_data is not None:
-            model.eval()
-            evaluate_model(dev_data, model, class_dict, batch_size)
-            model.train()
+            f1 = None
+            if rank == 0:
+                model.eval()
+                f1 = evaluate_model(dev_data, model, class_dict, batch_size, loader_options, precision)
+                model.train()
+            # all processes need the f1 to stop at the same epoch
+            f1 = distributed.broadcast(f1)
+            if state["best_f1"] is None or f1 > state["best_f1"]:
+                state["best_f1"], state["best_epoch"] = f1, epoch
+                if patience is not None:
+                    state["best_model"] = checkpoint.snapshot(model.state_dict())
+            stop = patience is not None and epoch - state["best_epoch"] >= patience
+
+        state["epoch"] = epoch
+        state["stopped"] = stop
+        if checkpoint_path is not None and ((epoch + 1) % checkpoint_every == 0 or epoch == epochs - 1 or stop):
+            rng = checkpoint.rng_state()
+            if distributed.is_distributed():
+                rng = distributed.gather(rng)
+            if writer is not None:
+                writer.save(dict(state, model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                 scheduler=scheduler.state_dict(), rng=rng))
+        if stop:
+            print("early stopping, no dev f1 improvements for %i epochs" % patience)
+            break
+
+    if state["best_model"] is not None:
+        print("restoring the model of epoch %i, dev f1 %.2f" % (state["best_epoch"], state["best_f1"]))
+        model.load_state_dict(state["best_model"])
+    if writer is not None:
+        writer.close()
 
     print("total time")
     print(time.time() - starting_time)
+    return state["best_f1"]
 
 
 def explain_usage(models):
@@ -224,10 +459,15 @@ def explain_usage(models):
     print("--write_results=<path> to save the prediction on test data to the specified position, in 1 word per line "
           "format")
     print("--save_model=<path> to save the trained model to the specified position")
-    print("--dev to check F1, precision, recall, error on the test set after every epoch")
+    print("--cache=<dir> to cache the preprocessed data in the specified directory, later runs on the same data "
+          "and embeddings are going to load it from there")
+    print("--dev=<path to dev pickle> to check F1, precision, recall, error on the dev data after every epoch, the "
+          "dev data must not be the test data")
     print("--help to repeat this message")
     print("Arguments that can also be used (hyperparameters):")
     print("--batch=<batch size>, defaults to 20")
+    print("--bucket to group sentences of similar length in the same batches, so that batches need less padding, "
+          "default is false")
     print("--bidirectional to make it so that recurrent layers will be bidirectional, default is false")
     print("--unfreeze to make it so that w2v embeddings are trained/modified during training, default is false")
     print("--decay=<decay>, decay for l2 normalization, default is 0.0")
@@ -237,6 +477,34 @@ def explain_usage(models):
     print("--epochs=<number of epochs>, defaults to 20")
     print("--hidden_size=<hidden_size>, hidden size for the recurrent layer of any model, default is 200")
     print("--lr=<learning rate>, defaults is 0.001")
+    print("--train_shards=<glob of train files in 1 word per line format, used in place of --train, the files are "
+          "streamed instead of being loaded in memory>")
+    print("--workers=<number of processes preparing batches, 0 to prepare them in the main process, default is 1>")
+    print("--prefetch=<number of batches prepared in advance by each worker, default is 2>")
+    print("--persistent_workers, to keep the workers alive between epochs")
+    print("--no_train_stats, to not compute precision, recall and f1 on the train data every epoch")
+    print("--predict_batch=<number of sentences predicted at once when testing, default is 256>")
+    print("--checkpoint=<path where to write checkpoints of the training state>")
+    print("--checkpoint_every=<number of epochs between checkpoints, default is 1>")
+    print("--resume, to resume training from the checkpoint, if it exists")
+    print("--patience=<number of epochs without dev f1 improvements after which training stops, needs --dev, "
+          "the model of the epoch with the best dev f1 is kept>")
+    print("--precision=<fp32 or bf16, with bf16 the forward and backward passes run in bfloat16 where it is safe, "
+          "while the trained weights are kept in float32 and the frozen embeddings are stored in bfloat16, "
+          "default is fp32>")
+    print("--nprocs=<number of local processes training the model in parallel, each one on its share of every epoch's "
+          "batches, gradients are averaged among them so each step sees nprocs batches, default is 1>")
+    print("--seed=<seed of the random number generators, i.e. to train the same model many times for error bars, "
+          "by default python and numpy are seeded with 1337 and pytorch with 999>")
+    print("--unpacked, to run the recurrent layers and the tag heads also on the padding of the batches, as the "
+          "models originally did, instead of packing the sentences and running them only on their real tokens")
+    print("--char_conv1d, to convolve on the characters of words with Conv1d layers, with the char embeddings as "
+          "channels, instead of the equivalent Conv2d layers with kernels as wide as the char embeddings")
+    print("--char_cache=<number of words whose char features are cached when evaluating and testing, besides the "
+          "words of the test data, whose features are computed once before testing, 0 to not cache them, default is "
+          "10000>")
+    print("--shuffle_buffer=<number of sentences buffered to shuffle the streamed train data, 0 to not shuffle it, "
+          "default is 10000>")
 
 
 def parse_args(args):
@@ -247,9 +515,13 @@ def parse_args(args):
     """
     try:
         opts, args = getopt.getopt(args, "",
-                                   ["train=", "test=", "w2v=", "model=", "c2v=", "write_results=", "save_model=", "dev",
-                                    "help", "batch=", "bidirectional", "unfreeze", "decay=", "drop=", "embedding_norm=",
-                                    "epochs=", "hidden_size=", "lr="])
+                                   ["train=", "test=", "w2v=", "model=", "c2v=", "write_results=", "save_model=",
+                                    "cache=", "dev=", "help", "batch=", "bucket", "bidirectional", "unfreeze", "decay=",
+                                    "drop=", "embedding_norm=", "epochs=", "hidden_size=", "lr=", "train_shards=",
+                                    "shuffle_buffer=", "workers=", "prefetch=", "persistent_workers",
+                                    "no_train_stats", "predict_batch=", "checkpoint=", "checkpoint_every=",
+                                    "resume", "patience=", "precision=", "nprocs=", "seed=", "unpacked",
+                                    "char_conv1d", "char_cache="])
     except getopt.GetoptError as err:
         # print help information and exit:
         print(err)
@@ -264,8 +536,18 @@ def parse_args(args):
         exit(0)
 
     # check args
-    train = opts.get("--train", "")
-    assert os.path.isfile(train), "train pickle is not there"
+    train_shards = None
+    if "--train_shards" in opts:
+        train = None
+        train_shards = sorted(glob.glob(opts["--train_shards"]))
+        assert len(train_shards) > 0, "no train shards match %s" % opts["--train_shards"]
+        assert "--cache" not in opts, "--cache can not be used with --train_shards"
+    else:
+        train = opts.get("--train", "")
+        assert os.path.isfile(train), "train pickle is not there"
+
+    shuffle_buffer = int(opts.get("--shuffle_buffer", 10000))
+    assert shuffle_buffer >= 0, "shuffle buffer should be greater or equal to 0"
 
     test = opts.get("--test", "")
     assert os.path.isfile(test), "test pickle is not there"
@@ -282,11 +564,17 @@ def parse_args(args):
 
     save_model = opts.get("--save_model", None)
     write_results = opts.get("--write_results", None)
-    dev = "--dev" in opts
+    cache = opts.get("--cache", None)
+    dev = opts.get("--dev", None)
+    if dev is not None:
+        assert os.path.isfile(dev), "dev pickle is not there"
+        # the dev data picks the best epoch, choosing it on the test data would bias the test scores
+        assert os.path.realpath(dev) != os.path.realpath(test), "the dev data should not be the test data"
 
     batch = int(opts.get("--batch", 20))
     assert batch > 0, "batch size should be greater than 0"
 
+    bucket = "--bucket" in opts
     bidirectional = "--bidirectional" in opts
     unfreeze = "--unfreeze" in opts
 
@@ -310,16 +598,58 @@ def parse_args(args):
     lr = float(opts.get("--lr", 0.001))
     assert lr > 0, "learning rate should be greater than 0"
 
+    workers = int(opts.get("--workers", 1))
+    assert workers >= 0, "number of workers should be greater or equal to 0"
+
+    prefetch = int(opts.get("--prefetch", 2))
+    assert prefetch > 0, "prefetch should be greater than 0"
+
+    persistent_workers = "--persistent_workers" in opts
+    train_stats = "--no_train_stats" not in opts
+
+    predict_batch = int(opts.get("--predict_batch", 256))
+    assert predict_batch > 0, "predict batch size should be greater than 0"
+
+    checkpoint_path = opts.get("--checkpoint", None)
+    checkpoint_every = int(opts.get("--checkpoint_every", 1))
+    assert checkpoint_every > 0, "checkpoint_every should be greater than 0"
+
+    resume = "--resume" in opts
+    assert checkpoint_path is not None or not resume, "--resume needs --checkpoint"
+
+    patience = int(opts["--patience"]) if "--patience" in opts else None
+    assert patience is None or patience > 0, "patience should be greater than 0"
+    assert patience is None or dev is not None, "--patience needs --dev"
+    assert workers > 0 or not persistent_workers, "--persistent_workers needs at least 1 worker"
+
+    precision = opts.get("--precision", "fp32")
+    assert precision in ["fp32", "bf16"], "precision should be either fp32 or bf16"
+
+    nprocs = int(opts.get("--nprocs", 1))
+    assert nprocs > 0, "number of processes should be greater than 0"
+    assert nprocs == 1 or train_shards is None, "--nprocs can not be used with --train_shards"
+
+    seed = int(opts["--seed"]) if "--seed" in opts else None
+    packed = "--unpacked" not in opts
+    char_conv1d = "--char_conv1d" in opts
+    assert not char_conv1d or c2v is not None, "--char_conv1d needs --c2v"
+    char_cache = int(opts.get("--char_cache", 10000))
+    assert char_cache >= 0, "char_cache should be at least 0"
+
     res = dict()
     res["train"] = train
+    res["train_shards"] = train_shards
+    res["shuffle_buffer"] = shuffle_buffer
     res["test"] = test
     res["w2v"] = w2v
     res["model"] = model
     res["c2v"] = c2v
     res["save_model"] = save_model
     res["write_results"] = write_results
+    res["cache"] = cache
     res["dev"] = dev
     res["batch"] = batch
+    res["bucket"] = bucket
     res["bidirectional"] = bidirectional
     res["unfreeze"] = unfreeze
     res["decay"] = decay
@@ -328,6 +658,21 @@ def parse_args(args):
     res["epochs"] = epochs
     res["hidden_size"] = hidden_size
     res["lr"] = lr
+    res["workers"] = workers
+    res["prefetch"] = prefetch
+    res["persistent_workers"] = persistent_workers
+    res["train_stats"] = train_stats
+    res["predict_batch"] = predict_batch
+    res["checkpoint"] = checkpoint_path
+    res["checkpoint_every"] = checkpoint_every
+    res["resume"] = resume
+    res["patience"] = patience
+    res["precision"] = precision
+    res["nprocs"] = nprocs
+    res["seed"] = seed
+    res["packed"] = packed
+    res["char_conv1d"] = char_conv1d
+    res["char_cache"] = char_cache
 
     print("-------------")
     print("Running with the following params:")
@@ -337,89 +682,154 @@ def parse_args(args):
     return res
 
 
-def generate_class_dict(train_df, test_df):
+def generate_class_dict(train_df, test_df, dev_df=None):
     """
     Given the train and test dataframe, containing "concepts" columns, where every entry is a list of strings representing
     the concepts or classes we are trying to predict, return a dictionary mapping a concept to a index.
     :param train_df: Train dataframe, must contain the "concepts" column.
     :param test_df: Test dataframe, must contain the "concepts" column.
+    :param dev_df: Dev dataframe, must contain the "concepts" column, or None.
     :return:
     """
     class_dict = dict()
-    # make a set of concepts by merging the sets obtained by concepts from train and test dataframes
+    # make a set of concepts by merging the sets obtained by concepts from train, test and dev dataframes
     concepts = set(itertools.chain(*train_df["concepts"].values)) | set(itertools.chain(*test_df["concepts"].values))
+    if dev_df is not None:
+        concepts |= set(itertools.chain(*dev_df["concepts"].values))
     # add to dict and return
     for concept in sorted(concepts):
         class_dict[concept] = len(class_dict)
     return class_dict
 
 
-def generate_model_and_transformers(params, class_dict):
+def load_data(params):
+    """
+    Load the class dict, the embeddings and the train, dev and test data encoded as EncodedCorpus objects, if a cache
+    directory is in the params the data is loaded from the cache when possible, otherwise it is computed and saved
+    to the cache. If the train data is going to be streamed from shards "train" is None, without --dev "dev" is None.
+    :param params: Dict of params, see parse_args.
+    :return: Dict with keys "class_dict", "w2v_vocab", "w2v_weights", "c2v_vocab", "c2v_weights", "train", "dev",
+    "test".
+    """
+    cache, key = None, None
+    if params["cache"] is not None:
+        cache = data_manager.DataCache(params["cache"])
+        key = cache.key([params["train"], params["test"], params["w2v"], params["c2v"], params["dev"]],
+                        sentence_length_cap=PADDED_SENTENCE_LENGTH, word_length_cap=PADDED_WORD_LENGTH)
+        data = cache.load(key)
+        if data is not None:
+            print("loaded preprocessed data from cache entry %s" % key)
+            return data
+
+    data = dict()
+    test_df = pd.read_pickle(params["test"])
+    if params["train_shards"] is not None:
+        # the train data is streamed later, only its distinct concepts are needed now, as a one row dataframe
+        concepts = set(itertools.chain.from_iterable(concepts for shard in params["train_shards"]
+                                                     for _, concepts in data_manager.read_conll(shard)))
+        train_df = pd.DataFrame({"concepts": [sorted(concepts)]})
+    else:
+        train_df = pd.read_pickle(params["train"])
+    dev_df = pd.read_pickle(params["dev"]) if params["dev"] is not None else None
+    data["class_dict"] = generate_class_dict(train_df, test_df, dev_df)
+    data["w2v_vocab"], data["w2v_weights"] = w2v_matrix_vocab_generator(params["w2v"])
+    data["c2v_vocab"], data["c2v_weights"] = None, None
+    if params["c2v"] is not None:
+        data["c2v_vocab"], data["c2v_weights"] = w2v_matrix_vocab_generator(params["c2v"])
+
+    init_data_transform = data_manager.InitTransform(data["w2v_vocab"], data["class_dict"], data["c2v_vocab"],
+                                                     PADDED_SENTENCE_LENGTH, PADDED_WORD_LENGTH)
+    data["train"] = init_data_transform.encode_corpus(train_df) if params["train_shards"] is None else None
+    data["dev"] = init_data_transform.encode_corpus(dev_df) if dev_df is not None else None
+    data["test"] = init_data_transform.encode_corpus(test_df)
+    print("w2v lookups of distinct words: %s" % init_data_transform.w2v_resolver)
+
+    if cache is not None:
+        cache.save(key, **data)
+        print("saved preprocessed data to cache entry %s" % key)
+    return data
+
+
+def trial_data(data):
+    """
+    :param data: Data as returned by load_data, shared by many runs of the same process.
+    :return: Shallow copy of the data with its own embedding matrices, so that whatever a run writes in them (i.e.
+    loading a checkpoint into the frozen tables wrapping them) does not reach the next runs; copy on write memory maps
+    are mapped again from their file, so that the frozen tables of every run share their pages (see
+    data_manager.pretrained_embedding).
+    """
+    res = dict(data)
+    for name in ["w2v_weights", "c2v_weights"]:
+        weights = data[name]
+        if isinstance(weights, np.memmap) and weights.mode == "c":
+            res[name] = np.load(weights.filename, mmap_mode="c")
+        elif weights is not None:
+            res[name] = np.array(weights)
+    return res
+
+
+def generate_model_and_transformers(params, class_dict, w2v_vocab, w2v_weights, c2v_vocab=None, c2v_weights=None):
     """
     Pick and construct the model and the init and drop transformers given the params, the init transformer
     makes it so that the data in the PytorchDataset is in the tensors of shape and sizes needed, the drop transformer
-    randomly drops tokens at run time when a sample is returned from the dataset, to simulate unknown words.
+    randomly drops tokens of the batches at run time, to simulate unknown words.
     Also deals with selecting the right device and putting the model on that device, GPU is preferred if available.
     :return: model, data transformer at dataset initialization, data transformer at run time
     """
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    w2v_vocab, w2v_weights = w2v_matrix_vocab_generator(params["w2v"])
-    c2v_vocab = None
-    c2v_weights = None
-
-    if params["c2v"] is not None:
-        c2v_vocab, c2v_weights = w2v_matrix_vocab_generator(params["c2v"])
 
-    init_data_transform = data_manager.InitTransform(w2v_vocab, class_dict, c2v_vocab)
+    init_data_transform = data_manager.InitTransform(w2v_vocab, class_dict, c2v_vocab, PADDED_SENTENCE_LENGTH,
+                                                     PADDED_WORD_LENGTH)
     drop_data_transform = data_manager.DropTransform(0.001, w2v_vocab["<UNK>"], w2v_vocab["<padding>"])
-
-    # needed for some models, given their architecture, i.e. CONV
-    padded_sentence_length = 50
-    # needed by models when using c2v embeddings
-    padded_word_length = 30
     if params["model"] == "lstm":
         model = lstm.LSTM(device, w2v_weights, params["hidden_size"], len(class_dict),
                           params["drop"],
                           params["bidirectional"], not params["unfreeze"], params["embedding_norm"],
-                          c2v_weights, padded_word_length)
+                          c2v_weights, PADDED_WORD_LENGTH, params["packed"], params["char_conv1d"],
+                          params["char_cache"])
     elif params["model"] == "gru":
         model = gru.GRU(device, w2v_weights, params["hidden_size"], len(class_dict),
                         params["drop"],
                         params["bidirectional"], not params["unfreeze"], params["embedding_norm"],
-                        c2v_weights, padded_word_length)
+                        c2v_weights, PADDED_WORD_LENGTH, params["packed"], params["char_conv1d"],
+                        params["char_cache"])
     elif params["model"] == "rnn":
         model = rnn.RNN(device, w2v_weights, params["hidden_size"], len(class_dict),
                         params["drop"],
                         params["bidirectional"], not params["unfreeze"], params["embedding_norm"],
-                        c2v_weights, padded_word_length)
+                        c2v_weights, PADDED_WORD_LENGTH, params["packed"], params["char_conv1d"],
+                        params["char_cache"])
     elif params["model"] == "lstm2ch":
         model = lstm2ch.LSTM2CH(device, w2v_weights, params["hidden_size"], len(class_dict), params["drop"],
-                                params["bidirectional"], params["embedding_norm"])
+                                params["bidirectional"], params["embedding_norm"], params["packed"])
     elif params["model"] == "encoder":
         tag_embedding_size = 20
         model = encoder.EncoderDecoderRNN(device, w2v_weights, tag_embedding_size, params["hidden_size"],
                                           len(class_dict), params["drop"], params["bidirectional"],
                                           not params["unfreeze"], params["embedding_norm"],
-                                          params["embedding_norm"])
+                                          params["embedding_norm"], params["packed"])
     elif params["model"] == "attention":
         tag_embedding_size = 20
         model = attention.Attention(device, w2v_weights, tag_embedding_size, params["hidden_size"],
                                     len(class_dict), params["drop"], params["bidirectional"], not params["unfreeze"],
                                     params["embedding_norm"], params["embedding_norm"],
-                                    padded_sentence_length=padded_sentence_length)
+                                    padded_sentence_length=PADDED_SENTENCE_LENGTH, packed=params["packed"])
     elif params["model"] == "conv":
-        model = conv.CONV(device, w2v_weights, params["hidden_size"], len(class_dict), padded_sentence_length,
+        model = conv.CONV(device, w2v_weights, params["hidden_size"], len(class_dict), PADDED_SENTENCE_LENGTH,
                           params["drop"], params["bidirectional"], not params["unfreeze"],
-                          params["embedding_norm"])
+                          params["embedding_norm"], params["packed"])
     elif params["model"] == "fcinit":
-        model = fcinit.FCINIT(device, w2v_weights, params["hidden_size"], len(class_dict), padded_sentence_length,
-                              params["drop"], params["bidirectional"], not params["unfreeze"], params["embedding_norm"])
+        model = fcinit.FCINIT(device, w2v_weights, params["hidden_size"], len(class_dict), PADDED_SENTENCE_LENGTH,
+                              params["drop"], params["bidirectional"], not params["unfreeze"], params["embedding_norm"],
+                              params["packed"])
     elif params["model"] == "lstmcrf":
         model = lstmcrf.LstmCrf(device, w2v_weights, class_dict, params["hidden_size"], params["drop"],
                                 params["bidirectional"], not params["unfreeze"], params["embedding_norm"], c2v_weights,
-                                padded_word_length)
+                                PADDED_WORD_LENGTH, params["packed"], params["char_conv1d"], params["char_cache"])
 
     model = model.to(device)
+    if params["precision"] == "bf16":
+        print("frozen embedding tables stored in bf16: %i" % prepare_bf16(model))
 
     model_parameters = filter(lambda p: p.requires_grad, model.parameters())
     params = sum([np.prod(p.size()) for p in model_parameters])
@@ -427,38 +837,84 @@ def generate_model_and_transformers(params, class_dict):
     return model, init_data_transform, drop_data_transform
 
 
-if __name__ == "__main__":
-    random.seed(1337)
-    np.random.seed(1337)
-    params = parse_args(sys.argv[1:])
-
-    # load data
-    print("loading data")
-    train_df = pd.read_pickle(params["train"])
-    test_df = pd.read_pickle(params["test"])
-    class_dict = generate_class_dict(train_df, test_df)
+def run(params, data, rank=0):
+    """
+    Build the model described by params, train it and test it, printing stats, writing the predictions and saving the
+    model if requested. In a distributed run every process calls this, only rank 0 tests the model.
+    :param params: Dict of params, see parse_args.
+    :param data: Data as returned by load_data.
+    :param rank: Rank of the process in a distributed run.
+    :return: Dict with the best "dev_f1" (None without --dev), the "test_f1" of the trained model and the "seconds"
+    taken, None on ranks other than 0.
+    """
+    starting_time = time.time()
+    random.seed(1337 if params["seed"] is None else params["seed"])
+    np.random.seed(1337 if params["seed"] is None else params["seed"])
+    # dropout differs among processes, the weights are the same since the ones of rank 0 are broadcast to the others
+    torch.manual_seed((999 if params["seed"] is None else params["seed"]) + rank)
+    class_dict = data["class_dict"]
 
     # build model and data transformers based on arguments
-    model, init_data_transform, run_data_transform = generate_model_and_transformers(params, class_dict)
+    model, init_data_transform, run_data_transform = generate_model_and_transformers(
+        params, class_dict, data["w2v_vocab"], data["w2v_weights"], data["c2v_vocab"], data["c2v_weights"])
 
-    train_data = PytorchDataset(train_df, init_data_transform, run_data_transform)
-    test_data = PytorchDataset(test_df, init_data_transform)  # notice that there is no run_data_transform for test data
-
-    if params["dev"]:
-        print("training in dev mode")
-        train_model(train_data, model, class_dict, test_data, params["batch"], params["lr"], params["epochs"],
-                    params["decay"])
+    if params["train_shards"] is not None:
+        train_data = StreamingDataset(params["train_shards"], init_data_transform, params["shuffle_buffer"],
+                                      batch_transform=run_data_transform)
     else:
-        print("training")
-        train_model(train_data, model, class_dict, None, params["batch"], params["lr"], params["epochs"],
-                    params["decay"])
-
+        train_data = PytorchDataset(data["train"], init_data_transform, batch_transform=run_data_transform)
+    # notice that there is no run_data_transform for dev and test data
+    dev_data = PytorchDataset(data["dev"], init_data_transform) if data["dev"] is not None else None
+    test_data = PytorchDataset(data["test"], init_data_transform)
+
+    loader_options = {"workers": params["workers"], "prefetch": params["prefetch"],
+                      "persistent_workers": params["persistent_workers"]}
+    print("training in dev mode" if dev_data is not None else "training")
+    dev_f1 = train_model(train_data, model, class_dict, dev_data, params["batch"], params["lr"], params["epochs"],
+                         params["decay"], params["bucket"], loader_options, params["train_stats"],
+                         params["checkpoint"], params["checkpoint_every"], params["resume"], params["patience"],
+                         params["precision"])
+
+    if rank != 0:
+        return None
     print("testing")
     model.eval()
-    predictions = predict(model, test_data)
+    if getattr(model, "char_cnn", None) is not None and params["char_cache"] > 0:
+        # char features of the words of the test data are computed once, batches only gather them
+        model.char_cnn.precompute(data["test"].char_table)
+    predictions = fill_predictions(predict(model, test_data, params["predict_batch"], loader_options,
+                                           params["precision"]), data["test"].lengths, class_dict)
+    tags = sorted(class_dict, key=class_dict.get)
+    counts = conlleval.count_chunks(data["test"].concepts, np.concatenate(predictions), data["test"].lengths, tags)
+    print("Test stats:")
+    print("\n".join(counts.report()[:2]))
     if params["write_results"] is not None:
+        test_df = pd.read_pickle(params["test"])
         write_predictions(test_df["tokens"].values, test_df["concepts"].values, predictions,
                           params["write_results"], False, class_dict)
 
     if params["save_model"] is not None:
         torch.save(model.state_dict(), params["save_model"])
+    return {"dev_f1": dev_f1, "test_f1": counts.overall()[2], "seconds": time.time() - starting_time}
+
+
+def main(args):
+    """
+    Parse the arguments, load the data, then train and test a model, see run.
+    :param args: List of arguments, see the "explain_usage" function.
+    :return: Dict of metrics returned by run.
+    """
+    params = parse_args(args)
+
+    # load data
+    print("loading data")
+    data = load_data(params)
+
+    if params["nprocs"] > 1:
+        print("training with %i processes" % params["nprocs"])
+        return distributed.launch(run, params["nprocs"], params, data)
+    return run(params, data)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+import os
+import sys
+import math
+import json
+import time
+import random
+import getopt
+import sqlite3
+import hashlib
+import itertools
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+import run_model
+
+"""
+Script to run a hyperparameter sweep over the options of run_model.py: trials are run in parallel by a pool of
+processes, each one limited to a few threads, and their results are written to a SQLite file as soon as they end.
+Each trial is identified by a hash of its parsed params, trials whose hash already has a result in the file are
+skipped, so an interrupted sweep is resumed by running it again, and sweeps sharing trials share their results.
+
+The sweep is described by a JSON spec, options are the ones of run_model.py without the leading "--", true means
+that a flag is passed and false that it is not:
+{
+    "base": {"train": "../data/atis/train.pickle", "test": "../data/atis/test.pickle",
+             "w2v": "../data/atis/w2v_trimmed.pickle", "dev": "../data/atis/dev.pickle", "epochs": 10, "workers": 0},
+    "grid": {"model": ["lstm", "gru"], "lr": [0.001, 0.005], "bidirectional": [true, false]},
+    "random": {"trials": 20, "seed": 1337,
+               "params": {"drop": {"uniform": [0.0, 0.9]}, "lr": {"log_uniform": [0.0001, 0.01]},
+                          "hidden_size": {"int_uniform": [50, 300]}, "batch": [10, 20, 100]}}
+}
+Every combination of the grid is run; if "random" is there, for each combination of the grid "trials" trials are
+run with params drawn from lists (uniformly) or from the given distributions. Both "grid" and "random" are optional.
+
+With a "halving" entry, i.e. "halving": {"min_epochs": 1, "max_epochs": 27, "eta": 3}, the trials are pruned by
+successive halving instead: all of them are trained for min_epochs, the best 1 / eta by f1 on the "dev" pickle (so it
+must be in "base", and not be the test pickle) are trained up to eta times more epochs, and so on until max_epochs.
+Each trial writes a checkpoint, so promoted trials resume training from where they stopped instead of restarting. With
+"hyperband": true in the "halving" entry, the successive halving is repeated in the brackets of hyperband, from many
+trials starting with few epochs to few trials trained for max_epochs from the start, the number of trials of each
+bracket overrides "trials" of "random".
+"""
+
+# params that do not change the results of a trial, left out of its hash
+UNHASHED_PARAMS = {"write_results", "save_model", "cache", "workers", "prefetch", "persistent_workers",
+                   "predict_batch", "checkpoint", "checkpoint_every", "resume", "char_cache"}
+
+# data loaded by each process of the pool, trials on the same files share it
+_data = dict()
+
+
+def to_args(options):
+    """
+    Convert a dict of options to run_model.py arguments.
+    :param options: Dict mapping an option name (without "--") to its value, True for flags, False to not pass them.
+    :return: List of arguments.
+    """
+    args = []
+    for name, value in sorted(options.items()):
+        if value is True:
+            args.append("--%s" % name)
+        elif value is not False and value is not None:
+            args.append("--%s=%s" % (name, value))
+    return args
+
+
+def parse_trial(options):
+    """
+    Parse the options of a trial as run_model.py does, without printing them.
+    :param options: Dict of options, see to_args.
+    :return: Dict of params, see run_model.parse_args.
+    """
+    with open(os.devnull, "w") as out, contextlib.redirect_stdout(out):
+        return run_model.parse_args(to_args(options))
+
+
+def config_hash(params, exclude=()):
+    """
+    :param params: Dict of params, see run_model.parse_args.
+    :param exclude: Other params to leave out of the hash, i.e. "epochs" to identify a trial at any number of epochs.
+    :return: Hex digest identifying the params that change the results of a trial.
+    """
+    config = {name: value for name, value in params.items() if name not in UNHASHED_PARAMS and name not in exclude}
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _draw(distribution, rand):
+    if isinstance(distribution, list):
+        return rand.choice(distribution)
+    (kind, (low, high)), = distribution.items()
+    if kind == "uniform":
+        return rand.uniform(low, high)
+    if kind == "log_uniform":
+        return 10 ** rand.uniform(math.log10(low), math.log10(high))
+    if kind == "int_uniform":
+        return rand.randint(low, high)
+    raise ValueError("unknown distribution %s" % kind)
+
+
+def generate_trials(spec):
+    """
+    Generate the options of each trial of a sweep.
+    :param spec: Dict describing the sweep, see the module docstring.
+    :return: List of dicts of options.
+    """
+    base = spec.get("base", dict())
+    grid = spec.get("grid", dict())
+    names = sorted(grid)
+    random_spec = spec.get("random", None)
+    rand = random.Random(random_spec.get("seed", 1337) if random_spec is not None else None)
+
+    trials = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        options = dict(base, **dict(zip(names, values)))
+        if random_spec is None:
+            trials.append(options)
+            continue
+        for _ in range(random_spec.get("trials", 1)):
+            drawn = {name: _draw(distribution, rand) for name, distribution in sorted(random_spec["params"].items())}
+            trials.append(dict(options, **drawn))
+    return trials
+
+
+class ResultStore(object):
+    """SQLite file storing the result of each trial, keyed by the hash of its params."""
+
+    def __init__(self, path):
+        """
+        :param path: Path of the SQLite file, created if it does not exist.
+        """
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS trials (hash TEXT PRIMARY KEY, options TEXT, "
+                                "dev_f1 REAL, test_f1 REAL, seconds REAL, error TEXT, finished TEXT)")
+        self.connection.commit()
+
+    def done(self):
+        """
+        :return: Set of the hashes of the trials that ended without errors.
+        """
+        return set(row[0] for row in self.connection.execute("SELECT hash FROM trials WHERE error IS NULL"))
+
+    def get(self, key):
+        """
+        :param key: Hash of the params of a trial.
+        :return: Dict with the "dev_f1", "test_f1" and "seconds" of the trial, None if it has no result.
+        """
+        row = self.connection.execute("SELECT dev_f1, test_f1, seconds FROM trials WHERE hash = ? AND error IS NULL",
+                                      (key,)).fetchone()
+        return dict(zip(["dev_f1", "test_f1", "seconds"], row)) if row is not None else None
+
+    def save(self, key, options, metrics=None, error=None):
+        """
+        Save the result of a trial, replacing any previous result.
+        :param key: Hash of the params of the trial.
+        :param options: Dict of options of the trial.
+        :param metrics: Dict of metrics returned by run_model.run, None if the trial failed.
+        :param error: Error message if the trial failed.
+        """
+        metrics = metrics or dict()
+        self.connection.execute("INSERT OR REPLACE INTO trials VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (key, json.dumps(options, sort_keys=True), metrics.get("dev_f1"),
+                                 metrics.get("test_f1"), metrics.get("seconds"), error,
+                                 time.strftime("%Y-%m-%d %H:%M:%S")))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def _init_process(threads):
+    torch.set_num_threads(threads)
+
+
+def run_trial(options, log=None):
+    """
+    Run a trial in this process, the data is loaded once per process for each set of data files and each trial gets
+    its own copy of the embeddings, see run_model.trial_data.
+    :param options: Dict of options of the trial.
+    :param log: Path of the file where the output of run_model is written, None to discard it.
+    :return: Dict of metrics, see run_model.run.
+    """
+    with open(log if log is not None else os.devnull, "w") as out, contextlib.redirect_stdout(out):
+        params = run_model.parse_args(to_args(options))
+        assert params["nprocs"] == 1, "trials can not use --nprocs"
+        key = (params["train"], params["dev"], params["test"], params["w2v"], params["c2v"], params["cache"])
+        if key not in _data:
+            _data.clear()
+            _data[key] = run_model.load_data(params)
+        return run_model.run(params, run_model.trial_data(_data[key]))
+
+
+def run_trials(trials, procs, threads, logs=None):
+    """
+    Run trials in a pool of processes.
+    :param trials: Dict mapping a key (i.e. the hash of the trial, used to name its log) to the options of a trial.
+    :param procs: Number of trials run in parallel.
+    :param threads: Number of threads of each process.
+    :param logs: Directory where the output of each trial is written (as <key>.log), None to discard it.
+    :return: Generator of (key, metrics, error) tuples, in the order in which trials end; metrics is the dict returned
+    by run_model.run and error is None, or metrics is None and error is the exception raised by the trial.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(procs, mp_context=context, initializer=_init_process, initargs=(threads,)) as pool:
+        futures = {pool.submit(run_trial, options, os.path.join(logs, key + ".log") if logs else None): key
+                   for key, options in trials.items()}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as err:
+                yield futures[future], None, err
+
+
+def valid_trials(trials, exclude=()):
+    """
+    Hash trials, skipping the ones whose options are not valid for run_model.py (i.e. an odd hidden size with
+    --bidirectional).
+    :param trials: List of dicts of options.
+    :param exclude: Params left out of the hash, see config_hash.
+    :return: Dict mapping the hash of each trial to its options.
+    """
+    res = dict()
+    for options in trials:
+        try:
+            res[config_hash(parse_trial(options), exclude)] = options
+        except AssertionError as err:
+            print("skipping trial %s: %s" % (" ".join(to_args(options)), err))
+    return res
+
+
+def run_missing(trials, store, procs, threads, logs=None):
+    """
+    Run the trials that do not have a result yet and store their results.
+    :param trials: Dict mapping the hash of each trial to its options.
+    :param store: ResultStore.
+    :param procs: Number of trials run in parallel.
+    :param threads: Number of threads of each process.
+    :param logs: Directory where the output of each trial is written (as <hash>.log), None to discard it.
+    :return: Dict mapping the hash of each trial to its metrics, see ResultStore.get; failed trials are left out.
+    """
+    results = {key: store.get(key) for key in trials}
+    pending = {key: options for key, options in trials.items() if results[key] is None}
+    print("%i trials to run, %i already have a result" % (len(pending), len(trials) - len(pending)))
+
+    for i, (key, metrics, error) in enumerate(run_trials(pending, procs, threads, logs)):
+        if error is None:
+            store.save(key, pending[key], metrics)
+            results[key] = metrics
+            print("[%i/%i] %s dev f1 %s test f1 %.2f in %.0fs: %s" %
+                  (i + 1, len(pending), key[:10], "-" if metrics["dev_f1"] is None else "%.2f" % metrics["dev_f1"],
+                   metrics["test_f1"], metrics["seconds"], " ".join(to_args(pending[key]))))
+        else:
+            store.save(key, pending[key], error=repr(error))
+            print("[%i/%i] %s failed: %r" % (i + 1, len(pending), key[:10], error))
+        sys.stdout.flush()
+    return {key: metrics for key, metrics in results.items() if metrics is not None}
+
+
+def successive_halving(trials, store, min_epochs, max_epochs, eta, procs, threads, checkpoints, logs=None):
+    """
+    Train all trials for min_epochs, then keep training the best 1 / eta of them by dev f1 for eta times more epochs,
+    and so on, until max_epochs. Trials resume from their checkpoint, named after the hash of their options without
+    the epochs, so each epoch of a trial is trained once.
+    :param trials: Dict mapping the hash of each trial (without the epochs) to its options, they must use --dev,
+    which run_model.py checks not to be the test data.
+    :param store: ResultStore, each rung of a trial is stored as a trial with its number of epochs.
+    :param min_epochs: Epochs of the first rung.
+    :param max_epochs: Epochs of the last rung.
+    :param eta: Fraction of trials promoted from one rung to the next, and increase of the epochs.
+    :param procs: Number of trials run in parallel.
+    :param threads: Number of threads of each process.
+    :param checkpoints: Directory where checkpoints are written.
+    :param logs: Directory where the output of each trial is written, None to discard it.
+    :return: List of (dev f1, options) of the trials of the last rung, sorted from the best.
+    """
+    epochs = min_epochs
+    while True:
+        rung = dict()
+        for key, options in trials.items():
+            options = dict(options, epochs=epochs, checkpoint=os.path.join(checkpoints, key + ".pt"), resume=True)
+            rung[config_hash(parse_trial(options))] = key, options
+        print("rung of %i trials with %i epochs" % (len(rung), epochs))
+        results = run_missing({rung_key: options for rung_key, (_, options) in rung.items()}, store, procs, threads,
+                              logs)
+        ranked = sorted([(results[rung_key]["dev_f1"], key) for rung_key, (key, _) in rung.items()
+                         if rung_key in results], reverse=True)
+        if epochs >= max_epochs or len(ranked) <= 1:
+            return [(f1, dict(trials[key], epochs=epochs)) for f1, key in ranked]
+        trials = {key: trials[key] for _, key in ranked[:max(1, len(ranked) // eta)]}
+        print("promoting %i trials, dev f1 from %.2f to %.2f" % (len(trials), ranked[0][0],
+                                                                 ranked[len(trials) - 1][0]))
+        epochs = min(epochs * eta, max_epochs)
+
+
+def hyperband_brackets(min_epochs, max_epochs, eta):
+    """
+    :param min_epochs: Minimum epochs a trial is trained for.
+    :param max_epochs: Maximum epochs a trial is trained for.
+    :param eta: Fraction of trials promoted from one rung to the next.
+    :return: List of (number of trials, epochs of the first rung) of each bracket of hyperband, from the most
+    exploratory one.
+    """
+    s_max = int(math.floor(math.log(max_epochs / min_epochs, eta) + 1e-9))
+    return [(int(math.ceil((s_max + 1) / (s + 1) * eta ** s)), max(min_epochs, int(round(max_epochs * eta ** -s))))
+            for s in range(s_max, -1, -1)]
+
+
+def sweep(spec, db, procs, threads, logs=None, checkpoints=None):
+    """
+    Run the trials of a sweep that do not have a result yet and store their results.
+    :param spec: Dict describing the sweep, see the module docstring.
+    :param db: Path of the SQLite file.
+    :param procs: Number of trials run in parallel.
+    :param threads: Number of threads of each process.
+    :param logs: Directory where the output of each trial is written (as <hash>.log), None to discard it.
+    :param checkpoints: Directory where the checkpoints of the trials are written with "halving", <db>.checkpoints by
+    default.
+    """
+    store = ResultStore(db)
+    halving = spec.get("halving", None)
+    if halving is None:
+        run_missing(valid_trials(generate_trials(spec)), store, procs, threads, logs)
+        store.close()
+        return
+
+    # trials are ranked on the dev data, ranking them on the test data would tune them on it
+    assert isinstance(spec.get("base", dict()).get("dev", None), str), "halving needs a \"dev\" pickle in base"
+    min_epochs, max_epochs, eta = halving.get("min_epochs", 1), halving["max_epochs"], halving.get("eta", 3)
+    assert 0 < min_epochs <= max_epochs, "min_epochs should be greater than 0 and at most max_epochs"
+    assert eta > 1, "eta should be greater than 1"
+    checkpoints = checkpoints if checkpoints is not None else db + ".checkpoints"
+    os.makedirs(checkpoints, exist_ok=True)
+
+    if halving.get("hyperband", False):
+        assert "random" in spec, "hyperband needs \"random\" params to draw the trials of each bracket"
+        brackets = []
+        for i, (trials, epochs) in enumerate(hyperband_brackets(min_epochs, max_epochs, eta)):
+            # each bracket draws its own trials, from a different seed
+            random_spec = dict(spec["random"], trials=trials, seed=spec["random"].get("seed", 1337) + i)
+            brackets.append((epochs, generate_trials(dict(spec, random=random_spec))))
+    else:
+        brackets = [(min_epochs, generate_trials(spec))]
+
+    best = []
+    for i, (epochs, trials) in enumerate(brackets):
+        print("bracket %i/%i: %i trials starting with %i epochs" % (i + 1, len(brackets), len(trials), epochs))
+        best += successive_halving(valid_trials(trials, exclude=("epochs",)), store, epochs, max_epochs, eta, procs,
+                                   threads, checkpoints, logs)[:1]
+    store.close()
+    if len(best) > 0:
+        f1, options = max(best, key=lambda item: item[0])
+        print("best trial, dev f1 %.2f: %s" % (f1, " ".join(to_args(options))))
+
+
+if __name__ == "__main__":
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "", ["spec=", "db=", "procs=", "threads=", "logs=", "checkpoints=",
+                                                       "help"])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    opts = dict(opts)
+    if "--help" in opts or "--spec" not in opts or "--db" not in opts:
+        print("Usage: \n./sweep.py --spec=<sweep spec json> --db=<results sqlite file> [--procs=<trials run in "
+              "parallel, default is the number of cores>] [--threads=<threads of each trial, default is 1>] "
+              "[--logs=<directory where the output of each trial is written>] [--checkpoints=<directory where the "
+              "checkpoints of the trials are written with halving, default is <db>.checkpoints>]\nSee the docstring "
+              "of sweep.py for the format of the spec; trials whose params already have a result in the SQLite file "
+              "are skipped.")
+        exit()
+
+    assert os.path.isfile(opts["--spec"]), "spec file is not there"
+    with open(opts["--spec"], "r") as file:
+        spec = json.load(file)
+    procs = int(opts.get("--procs", os.cpu_count()))
+    assert procs > 0, "number of processes should be greater than 0"
+    threads = int(opts.get("--threads", 1))
+    assert threads > 0, "number of threads should be greater than 0"
+    logs = opts.get("--logs", None)
+    if logs is not None:
+        os.makedirs(logs, exist_ok=True)
+    sweep(spec, opts["--db"], procs, threads, logs, opts.get("--checkpoints", None))
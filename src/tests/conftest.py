@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+"""
+Fixtures shared by the tests, run with python -m pytest from src.
+"""
+
+
+@pytest.fixture
+def corpus(tmp_path, request):
+    """
+    Write a tiny train, dev and test corpus and their w2v embeddings as pickles; parametrize it indirectly with False
+    to not write the dev split, whose sentences then go to the test split.
+    :return: Dict mapping the run_model.py options "train", "dev" (if written), "test" and "w2v" to the pickles.
+    """
+    dev = getattr(request, "param", True)
+    rand = np.random.RandomState(1337)
+    words = ["flight", "to", "boston", "from", "denver", "on", "monday"]
+    concepts = {"boston": "B-toloc", "denver": "B-fromloc", "monday": "B-day"}
+    sentences = [list(rand.choice(words, rand.randint(2, 6))) for _ in range(30)]
+    df = pd.DataFrame({"tokens": sentences, "concepts": [[concepts.get(w, "O") for w in s] for s in sentences]})
+    w2v = pd.DataFrame({"token": words, "vector": list(rand.randn(len(words), 8).astype(np.float32))})
+    splits = [("train", df[:20]), ("dev", df[20:25]), ("test", df[25:])] if dev else [("train", df[:20]),
+                                                                                        ("test", df[20:])]
+    options = dict()
+    for name, frame in splits + [("w2v", w2v)]:
+        options[name] = os.path.join(str(tmp_path), name + ".pickle")
+        frame.to_pickle(options[name])
+    return options
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # to make campaign visible from here
+import sweep
+import campaign
+
+"""
+Tests of campaign, run with python -m pytest from src.
+"""
+
+
+@pytest.mark.parametrize("corpus", [False], indirect=True)
+def test_runs_start_from_the_embeddings_of_the_files(tmp_path, corpus):
+    args = dict(corpus, epochs=2, workers=0, unfreeze=True, lr=0.1, hidden_size=8, batch=5)
+    args["cache"] = os.path.join(str(tmp_path), "cache")
+    options, = campaign.campaign_runs(args, ["lstm"], None, [1], str(tmp_path)).values()
+    os.makedirs(os.path.join(str(tmp_path), "lstm"))
+
+    # both runs are in this process, as two runs of a campaign scheduled on the same process of the pool
+    first = sweep.run_trial(options)
+    weights = [data["w2v_weights"] for data in sweep._data.values()]
+    second = sweep.run_trial(options)
+    assert first["test_f1"] == second["test_f1"]
+    np.testing.assert_array_equal(weights[0], np.load(os.path.join(args["cache"], os.listdir(args["cache"])[0],
+                                                                   "w2v.npy")))
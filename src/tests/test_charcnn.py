@@ -0,0 +1,97 @@
+import os
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # to make models visible from here
+from models import charcnn
+
+"""
+Tests of the CharCNN shared by the models using c2v embeddings, run with python -m pytest from src.
+"""
+
+
+def test_conv1d_loads_conv2d_weights_and_matches_their_features():
+    torch.manual_seed(999)
+    c2v_weights = np.random.RandomState(1337).randn(30, 8).astype(np.float32)
+    conv2d = nn.ModuleDict({"char_cnn": charcnn.CharCNN(c2v_weights, 0.5)})
+    conv1d = nn.ModuleDict({"char_cnn": charcnn.CharCNN(c2v_weights, 0.5, conv1d=True)})
+    # the weights of a model containing the Conv2d CharCNN, as saved by --save_model
+    conv1d.load_state_dict(conv2d.state_dict())
+    conv2d.eval()
+    conv1d.eval()
+
+    char_data = torch.randint(0, 30, (3, 1, 5, 16), generator=torch.Generator().manual_seed(1337))
+    mask = torch.tensor([[True] * 5, [True] * 2 + [False] * 3, [True] * 4 + [False]])
+    with torch.no_grad():
+        for m in [None, mask]:
+            torch.testing.assert_close(conv1d["char_cnn"](char_data, m), conv2d["char_cnn"](char_data, m))
+
+
+def test_float32_convs_run_in_float32_under_autocast():
+    torch.manual_seed(999)
+    c2v_weights = np.random.RandomState(1337).randn(30, 8).astype(np.float32)
+    char_cnn = charcnn.CharCNN(c2v_weights, 0.5, float32_convs=True)
+    char_cnn.eval()
+    chars = torch.randint(0, 30, (6, 16), generator=torch.Generator().manual_seed(1337))
+    c = char_cnn.char_embedding(chars).unsqueeze(1)
+    with torch.no_grad(), torch.autocast("cpu", dtype=torch.bfloat16):
+        output = charcnn.run_float32(char_cnn.ngram1, c)
+        assert charcnn.run_float32(char_cnn.ngram1, c, enabled=False).dtype == torch.bfloat16
+    assert output.dtype == torch.float32
+    with torch.no_grad():
+        torch.testing.assert_close(output, char_cnn.ngram1(c))
+
+
+def cached_char_cnn(cache_size):
+    """
+    :param cache_size: Number of words cached besides the precomputed ones.
+    :return: CharCNN in eval mode and a generator.
+    """
+    torch.manual_seed(999)
+    c2v_weights = np.random.RandomState(1337).randn(30, 8).astype(np.float32)
+    char_cnn = charcnn.CharCNN(c2v_weights, 0.5, cache_size=cache_size)
+    char_cnn.eval()
+    return char_cnn, torch.Generator().manual_seed(1337)
+
+
+def test_cached_features_match_the_computed_ones_under_eviction():
+    char_cnn, generator = cached_char_cnn(4)
+    # 12 distinct words, 3 of them precomputed
+    words = torch.randint(1, 30, (12, 16), generator=generator)
+    with torch.no_grad():
+        expected = char_cnn.word_features(words)
+        char_cnn.precompute(words[:3])
+        known = dict(char_cnn.known)
+        for step in range(20):
+            # batches of words with repetitions, more than the cache holds
+            idxs = torch.randint(0, 12, (6,), generator=generator)
+            char_data = words[idxs].view(2, 1, 3, 16)
+            torch.testing.assert_close(char_cnn(char_data), expected[idxs].view(2, 3, -1))
+            assert len(char_cnn.recent) <= 4
+            # precomputed words are never evicted and their rows are never reused
+            assert char_cnn.known == known
+            assert set(char_cnn.recent.values()).isdisjoint(known.values())
+    assert char_cnn.table.size(0) == 3 + 4
+
+
+def test_cache_is_cleared_by_train_and_load_state_dict():
+    char_cnn, generator = cached_char_cnn(4)
+    words = torch.randint(1, 30, (6, 16), generator=generator)
+    with torch.no_grad():
+        for clear in [lambda: char_cnn.train(), lambda: char_cnn.load_state_dict(char_cnn.state_dict())]:
+            char_cnn.eval()
+            char_cnn.precompute(words[:3])
+            char_cnn(words[3:].view(1, 1, 3, 16))
+            assert len(char_cnn.known) == 3 and len(char_cnn.recent) == 3
+            clear()
+            assert len(char_cnn.known) == 0 and len(char_cnn.recent) == 0 and char_cnn.table is None
+
+        # features computed with the old weights are not served after new ones are loaded
+        char_cnn.eval()
+        char_cnn(words.view(2, 1, 3, 16))
+        state = {name: value + 1 for name, value in char_cnn.state_dict().items()}
+        char_cnn.load_state_dict(state)
+        torch.testing.assert_close(char_cnn(words.view(2, 1, 3, 16)), char_cnn.word_features(words).view(2, 3, -1))
@@ -0,0 +1,96 @@
+import os
+import sys
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # to make conlleval visible from here
+import conlleval
+
+"""
+Tests of conlleval, run with python -m pytest from src; the reports are compared with the ones of output/conlleval.pl,
+so perl is needed.
+"""
+
+OUTPUT = os.path.join(os.path.dirname(__file__), "..", "..", "output")
+
+PREDICTION_FILES = ["atis/crf.txt", "atis/fst_4_kneser_ney.txt", "atis/svm/svm.txt",
+                    "atis/error_bars/attention/attention_0.txt", "atis/error_bars/lstmcrf/lstmcrf_0.txt",
+                    "movies/crf_embeddings.txt"]
+
+EDGE_CASES = {
+    # I after O and at the start of a sentence start a chunk
+    "i_after_o": "a O O\nb I-city I-city\nc O I-city\nd I-city O\n\ne I-day I-day\nf I-day B-day\n\n",
+    # the type changes inside a chunk
+    "type_change": "a B-city B-city\nb I-city I-state\nc I-state I-state\nd I-city O\n\n",
+    # -X- lines are boundaries, whatever their tags
+    "boundaries": "a B-city B-city\n-X- B-city I-city\nb I-city I-city\nc B-day B-day\n-X- O O\nd I-day I-day\n\n",
+    # hyphens in the types, the type is what follows the first one
+    "hyphenated": "a B-fromloc.city-name B-fromloc.city-name\nb I-fromloc.city-name I-toloc.city-name\n"
+                  "c B-depart-date.day-name B-depart-date.day-name\nd O B-a-b\n\n",
+    # perl treats a "0" type as false
+    "zero_type": "a B-0 B-0\nb I-0 B-x\nc B-x I-0\nd O B-0\n\n",
+    # the last sentence is not followed by an empty line
+    "no_final_blank": "a B-city B-city\nb O O\n\nc B-day I-day\nd I-day I-day",
+}
+
+
+def perl_report(path):
+    with open(path, "r") as file:
+        return subprocess.run(["perl", os.path.join(OUTPUT, "conlleval.pl")], stdin=file, stdout=subprocess.PIPE,
+                              universal_newlines=True, check=True).stdout
+
+
+requires_perl = pytest.mark.skipif(shutil.which("perl") is None, reason="perl is needed to run conlleval.pl")
+
+
+@requires_perl
+@pytest.mark.parametrize("name", PREDICTION_FILES)
+def test_report_of_prediction_files_is_the_one_of_conlleval_pl(name):
+    path = os.path.join(OUTPUT, name)
+    with open(path, "r") as file:
+        assert "\n".join(conlleval.count_lines(file).report()) + "\n" == perl_report(path)
+
+
+@requires_perl
+@pytest.mark.parametrize("name", sorted(EDGE_CASES))
+def test_report_of_edge_cases_is_the_one_of_conlleval_pl(tmp_path, name):
+    path = os.path.join(str(tmp_path), name + ".txt")
+    with open(path, "w") as file:
+        file.write(EDGE_CASES[name])
+    assert "\n".join(conlleval.evaluate_file(path).report()) + "\n" == perl_report(path)
+
+
+@requires_perl
+def test_report_of_random_tags_is_the_one_of_conlleval_pl(tmp_path):
+    rand = np.random.RandomState(1337)
+    tags = ["O", "B-city", "I-city", "B-to-loc", "I-to-loc", "B-0", "I-0", "E-city", "S-city", "[-city", "]-city",
+            "B-date", "I-date"]
+    path = os.path.join(str(tmp_path), "random.txt")
+    with open(path, "w") as file:
+        for _ in range(200):
+            for i in range(rand.randint(1, 12)):
+                file.write("w%i %s %s\n" % (i, tags[rand.randint(len(tags))], tags[rand.randint(len(tags))]))
+            file.write("\n")
+    assert "\n".join(conlleval.evaluate_file(path).report()) + "\n" == perl_report(path)
+
+
+@pytest.mark.parametrize("name", PREDICTION_FILES)
+def test_count_chunks_matches_count_lines(name):
+    with open(os.path.join(OUTPUT, name), "r") as file:
+        lines = file.readlines()
+    tags = dict()
+    correct, guessed, lengths = [], [], [0]
+    for line in lines:
+        features = line.split()
+        if len(features) == 0:
+            lengths.append(0)
+            continue
+        correct.append(tags.setdefault(features[-2], len(tags)))
+        guessed.append(tags.setdefault(features[-1], len(tags)))
+        lengths[-1] += 1
+    lengths = [length for length in lengths if length > 0]
+    expected = conlleval.count_lines(lines).report()
+    assert conlleval.count_chunks(correct, guessed, lengths, list(tags)).report() == expected
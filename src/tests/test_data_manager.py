@@ -0,0 +1,100 @@
+import os
+import sys
+import collections
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # to make data_manager visible from here
+import data_manager
+
+"""
+Tests of data_manager, run with python -m pytest from src.
+"""
+
+
+def write_shards(directory, shards, sentences):
+    """
+    Write shards in 1 word per line format, the ith sentence of the corpus is the single token "w<i>".
+    :param directory: Directory where the shards are written.
+    :param shards: Number of shards.
+    :param sentences: Number of sentences of each shard.
+    :return: List of paths of the shards and InitTransform encoding them, the token of the ith sentence has index i.
+    """
+    paths = []
+    for shard in range(shards):
+        path = os.path.join(str(directory), "shard%i.data" % shard)
+        with open(path, "w") as file:
+            for i in range(shard * sentences, (shard + 1) * sentences):
+                file.write("w%i O\n\n" % i)
+        paths.append(path)
+    vocab = {"w%i" % i: i for i in range(shards * sentences)}
+    vocab["<UNK>"] = len(vocab)
+    return paths, data_manager.InitTransform(vocab, {"O": 0})
+
+
+@pytest.mark.parametrize("shards,workers,shuffle_buffer,persistent", [
+    (4, 2, 3, False),
+    (4, 2, 3, True),
+    (5, 2, 3, False),
+    (2, 3, 3, False),  # fewer shards than workers
+    (4, 2, 0, False),
+])
+def test_streaming_dataset_reads_each_sentence_once(tmp_path, shards, workers, shuffle_buffer, persistent):
+    paths, transform = write_shards(tmp_path, shards, 5)
+    dataset = data_manager.StreamingDataset(paths, transform, shuffle_buffer)
+    loader = DataLoader(dataset, batch_size=None, num_workers=workers, persistent_workers=persistent)
+    for _ in range(3):
+        counts = collections.Counter(int(sample["tokens"][0]) for sample in loader)
+        assert counts == collections.Counter(range(shards * 5))
+
+
+def test_cache_key_changes_with_the_vocab_of_npy_embeddings(tmp_path):
+    path = os.path.join(str(tmp_path), "w2v.npy")
+    cache = data_manager.DataCache(os.path.join(str(tmp_path), "cache"))
+    data_manager.save_embeddings(path, {"a": 0, "b": 1}, [[0., 1.], [2., 3.]])
+    key = cache.key([path, None], padding=25)
+    assert cache.key([path, None], padding=25) == key
+    # same matrix, rows mapped to other tokens
+    data_manager.save_embeddings(path, {"b": 0, "a": 1}, [[0., 1.], [2., 3.]])
+    assert cache.key([path, None], padding=25) != key
+
+
+def test_frozen_embedding_shares_the_memory_map_and_matches_max_norm(tmp_path):
+    path = os.path.join(str(tmp_path), "w2v.npy")
+    weights = np.random.RandomState(1337).randn(6, 4).astype(np.float32) * 3
+    data_manager.save_embeddings(path, {"w%i" % i: i for i in range(6)}, weights)
+    _, mapped = data_manager.load_embeddings(path)
+    frozen = data_manager.pretrained_embedding(mapped, max_norm=2.)
+    trained = data_manager.pretrained_embedding(mapped, freeze=False, max_norm=2.)
+    assert frozen.weight.data_ptr() == mapped.ctypes.data
+    assert trained.weight.data_ptr() != mapped.ctypes.data
+
+    indexes = torch.tensor([[0, 1, 2], [3, 4, 5]])
+    expected = torch.nn.Embedding.from_pretrained(torch.tensor(weights), max_norm=2.)(indexes)
+    torch.testing.assert_close(frozen(indexes), expected)
+    torch.testing.assert_close(trained(indexes), expected)
+    # only the trained embedding renormalized its own copy of the rows
+    np.testing.assert_array_equal(mapped, weights)
+    np.testing.assert_array_equal(frozen.weight.numpy(), weights)
+
+
+@pytest.mark.parametrize("lengths,batch_size,num_replicas", [
+    ([3, 4, 5], 20, 3),  # fewer batches than processes
+    ([3, 4, 5, 6, 7], 2, 4),
+    (list(range(1, 40)), 4, 3),
+    (list(range(1, 40)), 5, 2),
+])
+def test_bucket_batches_are_split_evenly_among_processes(lengths, batch_size, num_replicas):
+    samplers = [data_manager.BucketBatchSampler(lengths, batch_size, num_replicas=num_replicas, rank=rank, seed=3)
+                for rank in range(num_replicas)]
+    for epoch in range(2):
+        seen = set()
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+            batches = list(sampler)
+            assert len(batches) == len(sampler)
+            seen.update(i for batch in batches for i in batch)
+        assert seen == set(range(len(lengths)))
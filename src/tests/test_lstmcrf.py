@@ -0,0 +1,92 @@
+import os
+import sys
+import itertools
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # to make models visible from here
+from models import lstmcrf
+
+"""
+Tests of the CRF of lstmcrf, run with python -m pytest from src.
+"""
+
+
+def random_batch(generator, lengths, n_labels):
+    """
+    :param generator: Torch generator.
+    :param lengths: List with the length of each sentence, in no particular order.
+    :param n_labels: Number of labels, including start and stop.
+    :return: Label scores padded to the longest sentence, size = (batch, padded length, n_labels), with random values
+    also in the padding, and the lengths as a tensor.
+    """
+    logits = torch.randn(len(lengths), max(lengths), n_labels, generator=generator)
+    return logits, torch.tensor(lengths)
+
+
+def path_score(logits, transitions, path, start_idx, stop_idx):
+    """
+    :return: Score of a path of labels of a sentence, whose label scores are logits.
+    """
+    labels = [start_idx] + list(path) + [stop_idx]
+    score = sum(logits[i, label] for i, label in enumerate(path))
+    return score + sum(transitions[j, i] for i, j in zip(labels[:-1], labels[1:]))
+
+
+def test_forward_and_viterbi_match_enumerating_the_paths():
+    generator = torch.Generator().manual_seed(1337)
+    crf = lstmcrf.CRF("cpu", 3)
+    with torch.no_grad():
+        crf.transitions.copy_(torch.randn(5, 5, generator=generator))
+    # padded, not sorted by length, with a sentence of length 1
+    logits, lengths = random_batch(generator, [3, 1, 4, 2, 4], crf.n_labels)
+
+    with torch.no_grad():
+        norm = crf(logits, lengths)
+        scores, paths = crf.viterbi_decode(logits, lengths)
+    for b, length in enumerate(lengths.tolist()):
+        all_paths = list(itertools.product(range(crf.n_labels), repeat=length))
+        all_scores = torch.stack([path_score(logits[b], crf.transitions.detach(), path, crf.start_idx, crf.stop_idx)
+                                  for path in all_paths])
+        torch.testing.assert_close(norm[b], torch.logsumexp(all_scores, 0))
+        best = int(torch.argmax(all_scores))
+        torch.testing.assert_close(scores[b], all_scores[best])
+        assert paths[b, :length].tolist() == list(all_paths[best])
+        # the padding repeats the last label
+        assert (paths[b, length:] == paths[b, length - 1]).all()
+
+
+def plain_log_partition(logits, transitions, lengths, start_idx, stop_idx):
+    """
+    :return: Log partition function of each sentence, computed one sentence at a time with the forward algorithm, so
+    that autograd differentiates it.
+    """
+    norms = []
+    for b, length in enumerate(lengths.tolist()):
+        alpha = torch.full_like(logits[b, 0], -10000).index_fill(0, torch.tensor(start_idx), 0)
+        for step in range(length):
+            alpha = torch.logsumexp(alpha.unsqueeze(0) + transitions, dim=1) + logits[b, step]
+        norms.append(torch.logsumexp(alpha + transitions[stop_idx], dim=0))
+    return torch.stack(norms)
+
+
+def test_log_partition_gradients():
+    generator = torch.Generator().manual_seed(1337)
+    # padded, not sorted by length, with a sentence of length 1
+    logits, lengths = random_batch(generator, [3, 1, 5, 2, 5, 4], 6)
+    logits = logits.double().requires_grad_()
+    transitions = torch.randn(6, 6, generator=generator, dtype=torch.double, requires_grad=True)
+
+    assert torch.autograd.gradcheck(lambda l, t: lstmcrf.LogPartition.apply(l, t, lengths, 4, 5), (logits, transitions))
+
+    weights = torch.randn(len(lengths), generator=generator, dtype=torch.double)
+    norm = lstmcrf.LogPartition.apply(logits, transitions, lengths, 4, 5)
+    reference = plain_log_partition(logits, transitions, lengths, 4, 5)
+    torch.testing.assert_close(norm, reference)
+    grads = torch.autograd.grad((norm * weights).sum(), [logits, transitions])
+    reference_grads = torch.autograd.grad((reference * weights).sum(), [logits, transitions])
+    for grad, reference_grad in zip(grads, reference_grads):
+        torch.testing.assert_close(grad, reference_grad)
+    # the padding gets no gradient
+    for b, length in enumerate(lengths.tolist()):
+        assert (grads[0][b, length:] == 0).all()
@@ -0,0 +1,223 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # to make run_model visible from here
+import run_model
+import checkpoint
+import data_manager
+
+"""
+Tests of run_model, run with python -m pytest from src.
+"""
+
+
+def corpus_args(corpus):
+    """
+    :param corpus: Options written by the corpus fixture.
+    :return: List of run_model.py arguments pointing to the corpus.
+    """
+    return ["--%s=%s" % option for option in corpus.items()]
+
+
+def test_trial_data_copies_embeddings(tmp_path):
+    path = os.path.join(str(tmp_path), "w2v.npy")
+    np.save(path, np.arange(12, dtype=np.float32).reshape(4, 3))
+    data = {"w2v_weights": np.load(path, mmap_mode="c"), "c2v_weights": np.ones((3, 2), dtype=np.float32),
+            "class_dict": {"O": 0}}
+    for _ in range(2):
+        trial = run_model.trial_data(data)
+        assert trial["class_dict"] is data["class_dict"]
+        assert isinstance(trial["w2v_weights"], np.memmap)
+        np.testing.assert_array_equal(trial["w2v_weights"], np.arange(12).reshape(4, 3))
+        np.testing.assert_array_equal(trial["c2v_weights"], 1)
+        # as a run training its embeddings would
+        trial["w2v_weights"] += 1
+        trial["c2v_weights"] += 1
+    np.testing.assert_array_equal(np.load(path), np.arange(12).reshape(4, 3))
+
+
+def test_trial_data_without_c2v():
+    data = {"w2v_weights": np.zeros((2, 2), dtype=np.float32), "c2v_weights": None}
+    assert run_model.trial_data(data)["c2v_weights"] is None
+
+
+def test_fill_predictions_completes_cut_sentences_with_o():
+    class_dict = {"B-city": 0, "O": 1}
+    predictions = [np.array([0, 0]), np.array([0]), np.array([], dtype=np.int64)]
+    filled = run_model.fill_predictions(predictions, np.array([2, 3, 1]), class_dict)
+    assert [sentence.tolist() for sentence in filled] == [[0, 0], [0, 1, 1], [1]]
+
+
+@pytest.mark.parametrize("corpus", [False], indirect=True)
+def test_patience_needs_a_dev_set_that_is_not_the_test_set(corpus):
+    args = corpus_args(corpus) + ["--model=lstm", "--patience=2"]
+    with pytest.raises(AssertionError):
+        run_model.parse_args(args)
+    test = [arg for arg in args if arg.startswith("--test=")][0]
+    with pytest.raises(AssertionError):
+        run_model.parse_args(args + ["--dev=" + test[len("--test="):]])
+
+
+def test_dev_data_is_loaded_and_cached(tmp_path, corpus):
+    args = corpus_args(corpus) + ["--model=lstm", "--cache=%s" % os.path.join(str(tmp_path), "cache")]
+    params = run_model.parse_args(args)
+    for _ in range(2):
+        data = run_model.load_data(params)
+        assert len(data["dev"]) == 5
+        assert len(data["test"]) == 5
+    params = run_model.parse_args([arg for arg in args if not arg.startswith("--dev=")])
+    assert run_model.load_data(params)["dev"] is None
+
+
+def train(corpus, directory, monkeypatch, dev_f1s, options):
+    """
+    Train and test an lstm, with the dev f1 of each epoch scripted instead of computed.
+    :param corpus: Options written by the corpus fixture.
+    :param directory: Directory where the model is saved.
+    :param monkeypatch: Pytest monkeypatch fixture.
+    :param dev_f1s: Dev f1 of each evaluated epoch.
+    :param options: Other run_model.py arguments.
+    :return: Metrics returned by run_model.run, state dict of the model when it was evaluated at each epoch and state
+    dict of the trained model.
+    """
+    snapshots = []
+    scores = iter(dev_f1s)
+
+    def evaluate_model(dev_data, model, *args, **kwargs):
+        snapshots.append(checkpoint.snapshot(model.state_dict()))
+        return next(scores)
+
+    monkeypatch.setattr(run_model, "evaluate_model", evaluate_model)
+    path = os.path.join(str(directory), "model.pt")
+    args = corpus_args(corpus) + ["--model=lstm", "--workers=0", "--hidden_size=8", "--batch=5", "--no_train_stats",
+                                  "--save_model=" + path] + options
+    params = run_model.parse_args(args)
+    metrics = run_model.run(params, run_model.load_data(params))
+    return metrics, snapshots, torch.load(path)
+
+
+def assert_same_weights(first, second):
+    assert first.keys() == second.keys()
+    for name in first:
+        torch.testing.assert_close(first[name], second[name], rtol=0, atol=0)
+
+
+def test_early_stopping_restores_the_best_epoch_on_the_dev_data(tmp_path, corpus, monkeypatch):
+    metrics, snapshots, model = train(corpus, tmp_path, monkeypatch, [10., 30., 20., 25., 40., 50.],
+                                      ["--epochs=6", "--patience=2"])
+    assert metrics["dev_f1"] == 30.
+    # no improvements in epochs 2 and 3
+    assert len(snapshots) == 4
+    assert_same_weights(model, snapshots[1])
+    assert not all(torch.equal(model[name], snapshots[3][name]) for name in model)
+
+
+def test_resumed_training_continues_as_if_never_stopped(tmp_path, corpus, monkeypatch):
+    f1s = [10., 30., 20., 25., 40., 50.]
+    _, snapshots, model = train(corpus, tmp_path, monkeypatch, f1s, ["--epochs=6", "--patience=2"])
+
+    options = ["--patience=2", "--checkpoint=" + os.path.join(str(tmp_path), "checkpoint.pt"), "--resume"]
+    _, interrupted, _ = train(corpus, tmp_path, monkeypatch, f1s, options + ["--epochs=3"])
+    metrics, resumed, resumed_model = train(corpus, tmp_path, monkeypatch, f1s[3:], options + ["--epochs=6"])
+    assert len(interrupted) == 3
+    # only epoch 3 is trained again, then training stops and the best epoch is restored from the checkpoint
+    assert len(resumed) == 1
+    assert metrics["dev_f1"] == 30.
+    for first, second in zip(snapshots, interrupted + resumed):
+        assert_same_weights(first, second)
+    assert_same_weights(resumed_model, model)
+
+
+@pytest.mark.parametrize("model", ["lstm", "lstmcrf"])
+def test_predictions_are_returned_in_the_order_of_the_data(corpus, model):
+    params = run_model.parse_args(corpus_args(corpus) + ["--model=" + model, "--hidden_size=8", "--bidirectional"])
+    data = run_model.load_data(params)
+    torch.manual_seed(999)
+    net, init_transform, _ = run_model.generate_model_and_transformers(
+        params, data["class_dict"], data["w2v_vocab"], data["w2v_weights"])
+    net.eval()
+    dataset = run_model.PytorchDataset(data["train"], init_transform)
+    # the sentences have lengths from 2 to 5 in no particular order, so batches of 3 mix them
+    assert len(set(dataset.lengths[:6].tolist())) > 2
+    predictions = run_model.predict(net, dataset, 3, {"workers": 0})
+
+    collate = data_manager.PadCollate(init_transform)
+    with torch.inference_mode():
+        for i, predicted in enumerate(predictions):
+            expected, labels = net(collate([dataset[i]]))
+            if model != "lstmcrf":
+                expected = torch.argmax(expected, dim=1)
+            np.testing.assert_array_equal(predicted, expected[labels != -1].numpy())
+
+
+def test_same_length_batches_can_not_be_shuffled():
+    with pytest.raises(AssertionError):
+        data_manager.BucketBatchSampler([3, 4, 3], 2, shuffle=True, same_length=True)
+    sampler = data_manager.BucketBatchSampler([3, 4, 3, 5, 3, 3], 2, shuffle=False, same_length=True)
+    assert len(list(sampler)) == len(sampler) == 4
+
+
+def bf16_model(corpus, model, options=()):
+    """
+    :param corpus: Options written by the corpus fixture.
+    :param model: Name of the model.
+    :param options: Other run_model.py arguments.
+    :return: Model prepared for bf16 (see run_model.prepare_bf16) and a batch of its train data.
+    """
+    params = run_model.parse_args(corpus_args(corpus) + ["--model=" + model, "--hidden_size=8", "--precision=bf16"] +
+                                  list(options))
+    data = run_model.load_data(params)
+    torch.manual_seed(999)
+    net, init_transform, _ = run_model.generate_model_and_transformers(
+        params, data["class_dict"], data["w2v_vocab"], data["w2v_weights"])
+    assert run_model.prepare_bf16(net) == 1
+    dataset = run_model.PytorchDataset(data["train"], init_transform)
+    return net, next(iter(run_model.get_dataloader(dataset, net, 5, False, workers=0)))
+
+
+@pytest.mark.parametrize("model", ["lstm", "conv", "lstmcrf"])
+def test_bf16_train_step_keeps_trained_weights_and_gradients_in_float32(corpus, model):
+    net, batch = bf16_model(corpus, model)
+    with run_model.autocast(net, "bf16"):
+        loss, _, _ = run_model.TrainingStep(net)(batch)
+    assert loss.dtype == torch.float32
+    loss.backward()
+    trained = [parameter for parameter in net.parameters() if parameter.requires_grad]
+    assert len(trained) > 0
+    for parameter in trained:
+        assert parameter.dtype == torch.float32
+        assert parameter.grad is not None and parameter.grad.dtype == torch.float32
+
+
+def test_bf16_stores_frozen_tables_in_bf16_with_float32_outputs(corpus):
+    net, batch = bf16_model(corpus, "lstm")
+    assert net.embedding.weight.dtype == torch.bfloat16
+    with run_model.autocast(net, "bf16"):
+        assert net.embedding(batch["tokens"]).dtype == torch.float32
+
+    # trained tables are left in float32
+    net, batch = bf16_model(corpus, "lstm2ch")
+    assert net.embedding_static.weight.dtype == torch.bfloat16
+    assert net.embedding_dyn.weight.dtype == torch.float32
+
+
+def test_bf16_crf_scores_are_float32(corpus):
+    net, batch = bf16_model(corpus, "lstmcrf")
+    dtypes = []
+    net.crf.register_forward_hook(lambda module, inputs, output: dtypes.append((inputs[0].dtype, output.dtype)))
+    with run_model.autocast(net, "bf16"):
+        net.neg_log_likelihood(batch)
+        logits = torch.randn(2, 3, net.crf.n_labels, dtype=torch.bfloat16)
+        lengths = torch.tensor([3, 2])
+        norm = net.crf(logits, lengths)
+        scores, _ = net.crf.viterbi_decode(logits, lengths)
+    # the features of the recurrent layer reach the crf in float32
+    assert dtypes[0] == (torch.float32, torch.float32)
+    # bf16 scores are summed in float32, as if they were float32 scores
+    with torch.no_grad():
+        torch.testing.assert_close(norm, net.crf(logits.float(), lengths))
+        torch.testing.assert_close(scores, net.crf.viterbi_decode(logits.float(), lengths)[0])
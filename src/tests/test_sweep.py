@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))  # to make sweep visible from here
+import sweep
+
+"""
+Tests of sweep, run with python -m pytest from src.
+"""
+
+
+@pytest.mark.parametrize("base", [{"epochs": 1}, {"epochs": 1, "dev": True}])
+def test_halving_needs_a_dev_pickle(tmp_path, base):
+    spec = {"base": base, "halving": {"max_epochs": 3}}
+    with pytest.raises(AssertionError):
+        sweep.sweep(spec, os.path.join(str(tmp_path), "sweep.sqlite"), 1, 1)
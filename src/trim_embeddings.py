@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+import os
+import gzip
+import sys
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from data_manager import save_embeddings
+
+"""
+Script to trim the full word2vec embeddings (i.e. the google news binary file, optionally gzipped) down to the
+vocabulary of some corpora; the binary file is streamed, so it is never loaded in memory as a whole.
+For each token of the corpora the token itself and its title case version are kept, together with the "number" token,
+mirroring the fallbacks used by data_manager.InitTransform when looking up words.
+The output is either a .npy matrix + .vocab file (see convert_embeddings.py) or a pickle containing a dataframe with
+"token" and "vector" columns, based on the extension of the output file.
+"""
+
+
+def corpus_vocabulary(files):
+    """
+    Collect the tokens that are going to be looked up in the embeddings for some corpora.
+    :param files: Paths of the corpora, either pickles containing a dataframe with a "tokens" column or files in
+    1 word per line format (first column is the token).
+    :return: Set of tokens.
+    """
+    vocabulary = {"number"}
+    for file in files:
+        if file.endswith(".pickle"):
+            words = set(itertools.chain(*pd.read_pickle(file)["tokens"].values))
+        else:
+            with open(file, "r") as f:
+                words = set(line.split()[0] for line in f if len(line.split()) > 0)
+        vocabulary.update(words)
+        vocabulary.update(word.title() for word in words)
+    return vocabulary
+
+
+def stream_word2vec(path, chunk_size=1 << 24):
+    """
+    Iterate over the embeddings of a word2vec binary file, without loading the whole file.
+    :param path: Path of the binary file, if it ends with .gz it is decompressed on the fly.
+    :param chunk_size: Bytes read from the file at a time.
+    :return: Generator of (token, raw vector bytes) pairs, use np.frombuffer(raw, dtype=np.float32) to get the vector;
+    the first value generated is instead the (vocabulary size, embedding size) pair from the header.
+    """
+    with (gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")) as file:
+        size, dim = map(int, file.readline().split())
+        yield size, dim
+        vector_bytes = dim * np.dtype(np.float32).itemsize
+
+        buffer = b""
+        pos = 0
+        eof = False
+        for _ in range(size):
+            # make sure that the buffer contains a whole entry (token, space, vector)
+            space = buffer.find(b" ", pos)
+            while (space == -1 or len(buffer) < space + 1 + vector_bytes) and not eof:
+                chunk = file.read(chunk_size)
+                eof = len(chunk) == 0
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                space = buffer.find(b" ")
+            if space == -1 or len(buffer) < space + 1 + vector_bytes:
+                raise EOFError("%s is truncated" % path)
+
+            # tokens might be preceded by the newline ending the previous vector
+            token = buffer[pos:space].lstrip(b"\n").decode("utf-8", errors="ignore")
+            pos = space + 1 + vector_bytes
+            yield token, buffer[space + 1:pos]
+
+
+def trim(embeddings, output, corpora):
+    """
+    Trim the embeddings to the vocabulary of the corpora and write them to output.
+    :param embeddings: Path of the word2vec binary file.
+    :param output: Path of the output, a .npy or a .pickle file.
+    :param corpora: Paths of the corpora.
+    """
+    vocabulary = corpus_vocabulary(corpora)
+    print("%i tokens to look up" % len(vocabulary))
+
+    tokens = []
+    vectors = []
+    stream = stream_word2vec(embeddings)
+    size, dim = next(stream)
+    for token, raw in stream:
+        if token in vocabulary:
+            vocabulary.remove(token)
+            tokens.append(token)
+            vectors.append(np.frombuffer(raw, dtype=np.float32))
+            # no need to go through the rest of the file
+            if len(vocabulary) == 0:
+                break
+    stream.close()
+    print("found %i tokens among %i embeddings" % (len(tokens), size))
+    if "number" in vocabulary:
+        print("warning: \"number\" is not in the embeddings, it is needed by data_manager.InitTransform")
+
+    if output.endswith(".pickle"):
+        df = pd.DataFrame({"token": tokens, "vector": vectors})
+        df.to_pickle(output)
+    else:
+        # +2 for the unknown and padding tokens, as in data_manager.w2v_matrix_vocab_generator
+        weights = np.zeros((len(tokens) + 2, dim), dtype=np.float32)
+        if len(vectors) > 0:
+            np.stack(vectors, out=weights[:-2])
+        vocab = dict(zip(tokens, range(len(tokens))))
+        vocab["<UNK>"] = len(weights) - 2
+        vocab["<padding>"] = len(weights) - 1
+        save_embeddings(output, vocab, weights)
+    print("written to %s" % output)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: \n./trim_embeddings.py embeddings.bin output corpus [corpus ...]\nWhere embeddings.bin is a "
+              "word2vec binary file (i.e. GoogleNews-vectors-negative300.bin.gz), output is either a .npy file (the "
+              "vocabulary is written next to it as a .vocab file) or a .pickle file, and each corpus is either a pickle "
+              "with a \"tokens\" column or a file in 1 word per line format.")
+        exit()
+    else:
+        embeddings, output, corpora = sys.argv[1], sys.argv[2], sys.argv[3:]
+        assert os.path.isfile(embeddings), "embeddings file is not there"
+        assert output.endswith(".npy") or output.endswith(".pickle"), "output should be a .npy or a .pickle file"
+        for corpus in corpora:
+            assert os.path.isfile(corpus), "%s is not there" % corpus
+        trim(embeddings, output, corpora)